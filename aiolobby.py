@@ -0,0 +1,282 @@
+# asyncio front end of the lobby, see lobbycore for the protocol logic.
+#
+# Serves the registration and query ports and the pages of the web port like lobby.py,
+# on the standard asyncio event loop or, with --uvloop, on uvloop. Multiple processes
+# (--workers) and replication between nodes (--peer) are only available in lobby.py.
+#
+# Replies are handed to the transport in one piece; unlike lobby.py, there is no shared
+# budget for the reply bytes buffered for slow clients. The query connection limits are
+# enforced by closing connections beyond them right away, asyncio cannot pause accepting.
+
+import os, time, signal, asyncio, argparse, mimetypes, http, banlist, floodcontrol, reachability, snapshot, statuspage
+from serverlist import GameServerList
+from connlimit import TimeoutWheel
+from metrics import METRICS
+from lobbylog import LOG, LEVELS
+import lobbycore
+from lobbycore import (Write, Close, SendDatagram, CheckReachability, LegacyQuery, NewStyleQuery, LegacyRegistration, NewStyleRegistration,
+                       LEGACY_PORT, NEWSTYLE_PORT, WEB_PORT, SERVER_DURATION, QUERY_TIMEOUT, BANS)
+
+class DelayedCall:
+    """ A timer of an AsyncioClock, with the methods of a Twisted DelayedCall that the lobby uses. """
+    def __init__(self, loop, delay, func, args, kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._called = False
+        self._handle = loop.call_later(delay, self._run)
+
+    def _run(self):
+        self._called = True
+        self._func(*self._args, **self._kwargs)
+
+    def active(self):
+        return not (self._called or self._handle.cancelled())
+
+    def cancel(self):
+        self._handle.cancel()
+
+class AsyncioClock:
+    """ The part of the Twisted reactor's interface used by expirationset, ReachabilityChecker and BanFile. """
+    def __init__(self, loop):
+        self._loop = loop
+
+    def seconds(self):
+        return time.time()
+
+    def callLater(self, delay, func, *args, **kwargs):
+        return DelayedCall(self._loop, delay, func, args, kwargs)
+
+    def callFromThread(self, func, *args):
+        self._loop.call_soon_threadsafe(func, *args)
+
+async def probe(loop, host, port, timeout, done):
+    try:
+        transport, protocol = await asyncio.wait_for(loop.create_connection(asyncio.Protocol, host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        done(False)
+        return
+    transport.close()
+    done(True)
+
+def perform(actions, transport, serverList, reachability):
+    """ Carry out the actions returned by lobbycore on an asyncio transport. """
+    for action in actions:
+        kind = type(action)
+        if(kind is Write):
+            transport.writelines(action.parts)
+        elif(kind is Close):
+            transport.close()
+        elif(kind is SendDatagram):
+            transport.sendto(action.data, action.addr)
+        elif(kind is CheckReachability):
+            reachability.check_many(action.servers, action.host, serverList)
+
+class QueryProtocol(asyncio.Protocol):
+    """ A TCP query connection, handled by a lobbycore query class. Connections from banned
+        addresses and beyond the connection limits are refused. """
+    def __init__(self, serverList, query_class, reachability, timeouts):
+        self.serverList = serverList
+        self.query_class = query_class
+        self.reachability = reachability
+        self.timeouts = timeouts
+        self.host = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        host = transport.get_extra_info("peername")[0]
+        if(not lobbycore.accept_query(host)):
+            transport.abort()
+            return
+        self.host = host
+        self.query = self.query_class(self.serverList)
+        self.timeouts.add(self, self.timed_out)
+
+    def timed_out(self):
+        # close() waits until the reply is flushed, which a client that stopped reading never lets happen
+        if(self.transport.get_write_buffer_size()):
+            self.transport.abort()
+        else:
+            self.transport.close()
+
+    def data_received(self, data):
+        perform(self.query.data_received(data), self.transport, self.serverList, self.reachability)
+
+    def connection_lost(self, exc):
+        if(self.host is not None):
+            self.timeouts.remove(self)
+            lobbycore.release_query(self.host)
+
+class RegistrationProtocol(asyncio.DatagramProtocol):
+    """ A UDP port handled by a lobbycore registration object. """
+    def __init__(self, serverList, registration, reachability):
+        self.serverList = serverList
+        self.registration = registration
+        self.reachability = reachability
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        perform(self.registration.datagram_received(data, addr), self.transport, self.serverList, self.reachability)
+
+class WebProtocol(asyncio.Protocol):
+    """ The web port: one GET request per connection, answered from pages or the static files in httpdocs. """
+    MAX_REQUEST_LENGTH = 8192
+    STATIC_DIR = "httpdocs"
+
+    def __init__(self, pages):
+        self.pages = pages  # path -> function(request headers) returning (status code, headers, body)
+        self.buffered = b""
+        self.timeout = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.timeout = asyncio.get_running_loop().call_later(QUERY_TIMEOUT, transport.close)
+
+    def connection_lost(self, exc):
+        self.timeout.cancel()
+
+    def data_received(self, data):
+        self.buffered += data
+        end = self.buffered.find(b"\r\n\r\n")
+        if(end < 0):
+            if(len(self.buffered) > WebProtocol.MAX_REQUEST_LENGTH): self.transport.close()
+            return
+        lines = self.buffered[:end].split(b"\r\n")
+        request = lines[0].split(b" ")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+
+        if(len(request) != 3):
+            code, response_headers, body = 400, [], b""
+        elif(request[0] not in (b"GET", b"HEAD")):
+            code, response_headers, body = 405, [(b"allow", b"GET, HEAD")], b""
+        else:
+            code, response_headers, body = self.respond(request[1].split(b"?", 1)[0], headers)
+        self.send_response(code, response_headers, b"" if request[0] == b"HEAD" else body, len(body))
+        self.transport.close()
+
+    def respond(self, path, headers):
+        page = self.pages.get(path)
+        if(page is not None):
+            return page(headers)
+        name = path.decode("utf-8", "replace").lstrip("/")
+        if(name and "/" not in name and not name.startswith(".")):
+            try:
+                with open(os.path.join(WebProtocol.STATIC_DIR, name), "rb") as f:
+                    body = f.read()
+            except OSError:
+                pass
+            else:
+                content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                return 200, [(b"content-type", content_type.encode("ascii"))], body
+        return 404, [(b"content-type", b"text/plain")], b"Not Found"
+
+    def send_response(self, code, headers, body, length):
+        lines = [b"HTTP/1.1 %u %s" % (code, http.HTTPStatus(code).phrase.encode("ascii"))]
+        lines += [name + b": " + value for (name, value) in headers]
+        if(code != 304):
+            lines.append(b"content-length: %u" % length)
+        lines.append(b"connection: close")
+        self.transport.writelines([b"\r\n".join(lines), b"\r\n\r\n", body])
+
+def status_page(page):
+    def respond(headers):
+        code, response_headers, body = page.respond(headers.get(b"accept-encoding"), headers.get(b"if-none-match"))
+        return code, [(b"content-type", b"text/html")] + response_headers, body
+    return respond
+
+async def save_snapshots(serverList, path, interval, stop):
+    """ Save a snapshot every interval seconds until stop is set. Only the records are taken
+        on the event loop, encoding and writing them runs on a thread. """
+    loop = asyncio.get_running_loop()
+    while(True):
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await loop.run_in_executor(None, snapshot.write_records, serverList.get_servers_with_regtime(), path)
+        except OSError as e:
+            LOG.error("snapshot_failed", path=path, error=e.strerror)
+
+async def serve(args):
+    loop = asyncio.get_running_loop()
+    clock = AsyncioClock(loop)
+    if(args.ban_file):
+        banlist.BanFile(BANS, args.ban_file, clock).install_sighup()
+    serverList = GameServerList(duration=SERVER_DURATION, clock=clock)
+    checker = reachability.from_arguments(args, clock, lambda host, port, timeout, done: loop.create_task(probe(loop, host, port, timeout, done)))
+    lobbycore.register_metrics(serverList, checker)
+    timeouts = TimeoutWheel(clock, QUERY_TIMEOUT)
+    METRICS.counter_function("lobby_query_timeouts_total", "Query connections closed because they were open too long",
+                             lambda: timeouts.expired)
+    stop = asyncio.Event()
+    snapshots = None
+    if(args.snapshot):
+        LOG.info("snapshot_restored", servers=snapshot.load_snapshot(serverList, args.snapshot), path=args.snapshot)
+        snapshots = loop.create_task(save_snapshots(serverList, args.snapshot, args.snapshot_interval, stop))
+
+    offset = args.port_offset
+    await loop.create_datagram_endpoint(lambda: RegistrationProtocol(serverList, LegacyRegistration(serverList), checker),
+                                        local_addr=("0.0.0.0", LEGACY_PORT+offset))
+    await loop.create_datagram_endpoint(lambda: RegistrationProtocol(serverList, NewStyleRegistration(serverList), checker),
+                                        local_addr=("0.0.0.0", NEWSTYLE_PORT+offset))
+    await loop.create_server(lambda: QueryProtocol(serverList, LegacyQuery, checker, timeouts), "0.0.0.0", LEGACY_PORT+offset)
+    await loop.create_server(lambda: QueryProtocol(serverList, NewStyleQuery, checker, timeouts), "0.0.0.0", NEWSTYLE_PORT+offset)
+    pages = {b"/status": status_page(statuspage.StatusPage(serverList, clock=clock)),
+             b"/metrics": lambda headers: statuspage.metrics_response(METRICS)}
+    await loop.create_server(lambda: WebProtocol(pages), "0.0.0.0", WEB_PORT+offset)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+    if(snapshots is not None):
+        # Let a save in progress finish, both write the same temporary file
+        await snapshots
+        snapshot.write_snapshot(serverList, args.snapshot)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Game server lobby on asyncio")
+    parser.add_argument("--uvloop", action="store_true", help="run on uvloop instead of the standard asyncio event loop")
+    parser.add_argument("--snapshot", metavar="PATH",
+                        help="restore the server list from this file on startup, and save it there periodically and on shutdown")
+    parser.add_argument("--snapshot-interval", type=float, default=30, metavar="SECONDS",
+                        help="how often to save the snapshot (default: 30)")
+    parser.add_argument("--port-offset", type=int, default=0,
+                        help="add this number to all listening ports, e.g. to run several nodes on one host (default: 0)")
+    parser.add_argument("--ban-file", metavar="PATH",
+                        help="ignore registrations and queries from the addresses and CIDR ranges in this file, "
+                             "reloaded when it changes or on SIGHUP (see bans.example)")
+    parser.add_argument("--max-query-connections", type=int, default=1000, metavar="N",
+                        help="open connections to the query ports, beyond which new ones are closed (default: 1000)")
+    parser.add_argument("--max-query-connections-per-ip", type=int, default=32, metavar="N",
+                        help="open connections to the query ports from one address (default: 32)")
+    floodcontrol.add_arguments(parser)
+    reachability.add_arguments(parser)
+    parser.add_argument("--log-level", choices=sorted(LEVELS, key=LEVELS.get), default="info",
+                        help="only log events of at least this level (default: info)")
+    args = parser.parse_args()
+    LOG.set_level(LEVELS[args.log_level])
+    lobbycore.FLOOD_CONTROL = floodcontrol.from_arguments(args)
+    lobbycore.QUERY_LIMITS.total = args.max_query_connections
+    lobbycore.QUERY_LIMITS.per_ip = args.max_query_connections_per_ip
+
+    if(args.uvloop):
+        try:
+            import uvloop
+        except ImportError:
+            parser.error("--uvloop needs the uvloop package (pip install uvloop)")
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve(args))
+    finally:
+        loop.close()
+        LOG.close()
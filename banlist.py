@@ -0,0 +1,104 @@
+# IPv4 and IPv6 ban lists with CIDR ranges, loaded from a file and reloaded while running.
+#
+# Ban file format: one address or CIDR range per line, e.g. "10.0.0.0/8" or "2001:db8::/32".
+# A leading "!" exempts a range from a larger banned one ("!10.1.2.0/24"), the most
+# specific matching line decides. Everything after a "#" is a comment.
+#
+# Ranges are kept in one hash table per prefix length, so a lookup costs at most one
+# dict lookup per prefix length that actually occurs in the list, longest first,
+# independent of the number of ranges.
+
+import os, signal, socket, ipaddress
+from lobbylog import LOG
+
+IPV4_MAPPED_PREFIX = bytes(10) + b"\xff\xff"
+
+class BanList:
+    def __init__(self, lines=()):
+        self.invalid_lines = 0
+        self.load(lines)
+
+    def load(self, lines):
+        """ Replace the ranges with those in lines, see the file format above. Invalid lines are skipped. """
+        tables = {4: {}, 6: {}}    # version -> {prefix length -> {network >> host bits: banned}}
+        invalid = 0
+        count = 0
+        for line in lines:
+            line = line.split("#", 1)[0].strip()
+            if(not line):
+                continue
+            banned = not line.startswith("!")
+            try:
+                network = ipaddress.ip_network(line.lstrip("!").strip(), strict=False)
+            except ValueError:
+                invalid += 1
+                continue
+            hostbits = network.max_prefixlen-network.prefixlen
+            tables[network.version].setdefault(network.prefixlen, {})[int(network.network_address) >> hostbits] = banned
+            count += 1
+
+        # The old tables stay in use until the new ones are complete
+        self._v4 = [(32-length, table) for (length, table) in sorted(tables[4].items(), reverse=True)]
+        self._v6 = [(128-length, table) for (length, table) in sorted(tables[6].items(), reverse=True)]
+        self.count = count
+        self.invalid_lines = invalid
+
+    def banned(self, packed):
+        """ Check whether the packed (4 or 16 byte) address is banned. """
+        if(len(packed) == 16 and packed.startswith(IPV4_MAPPED_PREFIX)):
+            packed = packed[12:]
+        value = int.from_bytes(packed, "big")
+        for hostbits, table in (self._v4 if len(packed) == 4 else self._v6):
+            verdict = table.get(value >> hostbits)
+            if(verdict is not None):
+                return verdict
+        return False
+
+    __contains__ = banned
+
+    def banned_host(self, host):
+        """ Like banned, for an address in text form. """
+        try:
+            packed = socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host)
+        except OSError:
+            return False
+        return self.banned(packed)
+
+class BanFile:
+    """ Keeps a BanList loaded from a file, reloading it when the file changes or on SIGHUP. """
+    def __init__(self, banlist, path, clock, poll_interval=5):
+        self.banlist = banlist
+        self.path = path
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self._stat = None
+        self.reload()
+        self._poll_call = clock.callLater(poll_interval, self._poll)
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def reload(self):
+        """ Load the file again. If it cannot be read, the current bans stay in effect. """
+        self._stat = self._file_stat()
+        try:
+            with open(self.path, encoding="utf-8", errors="replace") as f:
+                lines = f.readlines()
+        except OSError as e:
+            LOG.error("banlist_unreadable", path=self.path, error=e.strerror)
+            return
+        self.banlist.load(lines)
+        LOG.info("banlist_loaded", path=self.path, ranges=self.banlist.count, invalid_lines=self.banlist.invalid_lines)
+
+    def _poll(self):
+        if(self._file_stat() != self._stat):
+            self.reload()
+        self._poll_call = self._clock.callLater(self.poll_interval, self._poll)
+
+    def install_sighup(self):
+        """ Reload on SIGHUP. The handler only schedules the reload in the reactor thread. """
+        signal.signal(signal.SIGHUP, lambda signum, frame: self._clock.callFromThread(self.reload))
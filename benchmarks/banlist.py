@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Measures loading and lookups of a ban list with 100k random IPv4 and IPv6 ranges,
+# compared with checking the address against every range with the ipaddress module.
+
+import os, sys, time, random, ipaddress
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import banlist
+
+RANGES = 100000
+LOOKUPS = 100000
+LINEAR_LOOKUPS = 20
+
+def random_ranges(rng, count):
+    lines = []
+    for i in range(count):
+        if(rng.random() < 0.8):
+            length = rng.choice((16, 20, 24, 24, 24, 28, 32, 32))
+            address = ipaddress.IPv4Address(rng.getrandbits(32))
+        else:
+            length = rng.choice((32, 48, 56, 64, 64, 128))
+            address = ipaddress.IPv6Address(rng.getrandbits(128))
+        lines.append("%s/%u" % (address, length))
+    return lines
+
+def main():
+    rng = random.Random(1)
+    lines = random_ranges(rng, RANGES)
+    start = time.perf_counter()
+    bans = banlist.BanList(lines)
+    print("load %u ranges: %.2f s" % (RANGES, time.perf_counter()-start))
+
+    # Half of the addresses fall into a banned range
+    addresses = []
+    for i in range(LOOKUPS):
+        if(i % 2):
+            network = ipaddress.ip_network(rng.choice(lines), strict=False)
+            addresses.append(network[rng.randrange(network.num_addresses)].packed)
+        else:
+            addresses.append(rng.getrandbits(32).to_bytes(4, "big") if rng.random() < 0.8 else rng.getrandbits(128).to_bytes(16, "big"))
+
+    start = time.perf_counter()
+    hits = sum(1 for address in addresses if address in bans)
+    elapsed = time.perf_counter()-start
+    print("BanList lookups: %7.0f ns/lookup (%u of %u banned)" % (elapsed*1e9/LOOKUPS, hits, LOOKUPS))
+
+    networks = [ipaddress.ip_network(line, strict=False) for line in lines]
+    start = time.perf_counter()
+    for address in addresses[:LINEAR_LOOKUPS]:
+        ip = ipaddress.ip_address(address)
+        any(ip.version == network.version and ip in network for network in networks)
+    elapsed = time.perf_counter()-start
+    print("linear scan:     %7.0f ns/lookup" % (elapsed*1e9/LINEAR_LOOKUPS))
+
+    start = time.perf_counter()
+    for i in range(LOOKUPS):
+        bans.banned_host("203.0.113.%u" % (i % 256))
+    elapsed = time.perf_counter()-start
+    print("banned_host:     %7.0f ns/lookup (text address, as in the query factories)" % (elapsed*1e9/LOOKUPS))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Simulates a fleet of server browsers refreshing a lobby with churning servers and
+# compares bytes sent and CPU time for the full list protocol and the delta protocol.
+
+import os, sys, time, uuid, random, contextlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lobbycore, lobbylog
+from serverlist import GameServer
+from list_query import written, make_server_list
+
+SERVERS = 2000
+BROWSERS = 200
+ROUNDS = 20
+CHANGES_PER_ROUND = 40      # Servers whose player count changes between two refreshes
+REPLACED_PER_ROUND = 5      # Servers which go away and are replaced by new ones
+
+def churn(serverList, rng):
+    servers = list(serverList.get_servers_in_lobby(lobbycore.GG2_LOBBY_ID))
+    for server in rng.sample(servers, CHANGES_PER_ROUND):
+        newserver = GameServer(server.server_id, server.lobby_id)
+        newserver.ipv4_endpoint = server.ipv4_endpoint
+        newserver.name = server.name
+        newserver.slots, newserver.players = server.slots, (server.players+1) % server.slots
+        newserver.infos = server.infos
+        serverList.put(newserver)
+    for server in rng.sample(servers, REPLACED_PER_ROUND):
+        serverList.remove(server.server_id)
+        newserver = GameServer(uuid.uuid4(), server.lobby_id)
+        newserver.ipv4_endpoint = server.ipv4_endpoint
+        newserver.name = server.name
+        newserver.slots = server.slots
+        newserver.infos = server.infos
+        serverList.put(newserver)
+
+def run(delta):
+    rng = random.Random(42)
+    serverList = make_server_list(SERVERS)
+    query = lobbycore.NewStyleQuery(serverList)
+    handler = lobbycore.NewStyleQuery.LIST_PROTOCOLS[lobbycore.DeltaListHandler.LIST_PROTOCOL_ID]
+    tokens = [bytes(12)] * BROWSERS
+    sent = 0
+    cpu = 0.0
+    for round in range(ROUNDS):
+        churn(serverList, rng)
+        start = time.process_time()
+        for browser in range(BROWSERS):
+            if(delta):
+                actions = handler.handle(query, lobbycore.DeltaListHandler.LIST_PROTOCOL_ID.bytes + lobbycore.GG2_LOBBY_ID.bytes + tokens[browser])
+                tokens[browser] = actions[0].parts[1]
+            else:
+                actions = query.reply(lobbycore.GG2_LOBBY_ID)
+            sent += written(actions)
+        cpu += time.process_time()-start
+    return sent, cpu
+
+def main():
+    lobbycore.LOG.set_level(lobbylog.OFF)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        full_bytes, full_cpu = run(False)
+        delta_bytes, delta_cpu = run(True)
+    queries = BROWSERS*ROUNDS
+    print("%u servers, %u browsers, %u refreshes each, %u changed + %u replaced servers per refresh" % (
+        SERVERS, BROWSERS, ROUNDS, CHANGES_PER_ROUND, REPLACED_PER_ROUND))
+    print("full list: %10.0f bytes/query %8.1f us/query" % (full_bytes/queries, full_cpu/queries*1e6))
+    print("delta:     %10.0f bytes/query %8.1f us/query" % (delta_bytes/queries, delta_cpu/queries*1e6))
+
+if __name__ == "__main__":
+    main()
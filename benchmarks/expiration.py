@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# Compares on-access and timer-driven expiration in expirationset at 100k entries.
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from twisted.internet.task import Clock
+from expirationset import expirationset
+
+ENTRIES = 100000
+RETENTION = 70
+
+def run(clock):
+    expired = []
+    s = expirationset(RETENTION, lambda key, was_expired: expired.append(key), clock)
+    start = time.perf_counter()
+    for i in range(ENTRIES):
+        s.add(i)
+    add_time = time.perf_counter()-start
+
+    start = time.perf_counter()
+    for i in range(ENTRIES):
+        i in s
+    contains_time = time.perf_counter()-start
+
+    # Let every entry expire, then measure one full sweep
+    if(clock is None):
+        s._time = lambda: time.time()+RETENTION
+        start = time.perf_counter()
+        s.cleanup_stale()
+    else:
+        start = time.perf_counter()
+        clock.advance(RETENTION)
+        while(len(s)):
+            clock.advance(0)
+        s.stop()
+    sweep_time = time.perf_counter()-start
+    assert len(expired) == ENTRIES
+    return add_time, contains_time, sweep_time
+
+def main():
+    for name, clock in (("on-access", None), ("timer-driven", Clock())):
+        add_time, contains_time, sweep_time = run(clock)
+        print("%-12s add: %8.0f ns/op  contains: %8.0f ns/op  expire all: %7.1f ms" % (
+            name, add_time/ENTRIES*1e9, contains_time/ENTRIES*1e9, sweep_time*1e3))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# Compares reply size and build time of a filtered list query (one protocol_id, not full,
+# only name and map) with the full newstyle list the client would otherwise filter, and
+# with the same filter applied by scanning the whole lobby instead of using the index.
+
+import os, sys, uuid
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lobbycore, lobbylog
+from list_query import make_server_list, queries_per_sec, PROTOCOL_VERSIONS
+
+def main():
+    lobbycore.LOG.set_level(lobbylog.OFF)
+    handler = lobbycore.FilteredListHandler()
+    protocol_id = uuid.UUID(int=lobbycore.GG2_BASE_UUID.int+1).bytes
+    flags = lobbycore.FilteredListHandler.EXCLUDE_FULL
+    filters = ((b"protocol_id", protocol_id),)
+    keys = (b"name", b"map")
+    for count in (1000, 10000):
+        serverList = make_server_list(count)
+        full = lobbycore.NewStyleQuery(serverList).buildReply(serverList.get_servers_in_lobby(lobbycore.GG2_LOBBY_ID))
+        filtered = handler.buildReply(serverList.get_servers_by_info(lobbycore.GG2_LOBBY_ID, b"protocol_id", protocol_id), flags, filters, keys)
+        indexed = queries_per_sec(lambda: handler.buildReply(
+            serverList.get_servers_by_info(lobbycore.GG2_LOBBY_ID, b"protocol_id", protocol_id), flags, filters, keys))
+        scanned = queries_per_sec(lambda: handler.buildReply(
+            serverList.get_servers_in_lobby(lobbycore.GG2_LOBBY_ID), flags, filters, keys))
+        print("%6u servers, %u protocol versions: full list %8u bytes, filtered %7u bytes; uncached filtered replies/s: %8.1f from index, %8.1f scanning"
+              % (count, PROTOCOL_VERSIONS, len(full), len(filtered), indexed, scanned))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Measures NewStyleQuery and LegacyQuery throughput with and without the reply caches.
+
+import os, sys, time, uuid, contextlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lobbycore, lobbylog
+from serverlist import GameServer, GameServerList
+
+def written(actions):
+    """ Number of bytes the Write actions returned by a lobbycore query would send. """
+    return sum(sum(map(len, action.parts)) for action in actions if type(action) is lobbycore.Write)
+
+PROTOCOL_VERSIONS = 10
+
+def make_server_list(count):
+    serverList = GameServerList()
+    for i in range(count):
+        server = GameServer(uuid.uuid4(), lobbycore.GG2_LOBBY_ID)
+        server.ipv4_endpoint = (i.to_bytes(4, "big"), 8190)
+        server.name = b"Benchmark server %u" % i
+        server.slots, server.players = 24, i % 24
+        server.infos[b"game"] = b"Gang Garrison 2"
+        server.infos[b"game_short"] = b"gg2"
+        server.infos[b"map"] = b"ctf_truefort"
+        server.infos[b"protocol_id"] = uuid.UUID(int=lobbycore.GG2_BASE_UUID.int+1+i%PROTOCOL_VERSIONS).bytes
+        serverList.put(server)
+    return serverList
+
+def queries_per_sec(func, seconds=1.0):
+    count = 0
+    start = time.perf_counter()
+    while(time.perf_counter()-start < seconds):
+        func()
+        count += 1
+    return count/(time.perf_counter()-start)
+
+def main():
+    lobbycore.LOG.set_level(lobbylog.OFF)
+    for count in (1000, 10000):
+        serverList = make_server_list(count)
+        query = lobbycore.NewStyleQuery(serverList)
+
+        def uncached():
+            query.buildReply(serverList.get_servers_in_lobby(lobbycore.GG2_LOBBY_ID))
+
+        def cached():
+            query.reply(lobbycore.GG2_LOBBY_ID)
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            before = queries_per_sec(uncached)
+            after = queries_per_sec(cached)
+        print("%6u servers: %10.1f newstyle queries/s uncached, %10.1f queries/s cached" % (count, before, after))
+
+        legacy = lobbycore.LegacyQuery(serverList)
+        protocol_id = uuid.UUID(int=lobbycore.GG2_BASE_UUID.int+1)
+
+        def legacy_scan():
+            servers = serverList.get_servers_in_lobby(lobbycore.GG2_LOBBY_ID)
+            legacy.buildReply([server for server in servers if server.infos.get(b"protocol_id")==protocol_id.bytes])
+
+        def legacy_cached():
+            legacy.reply(protocol_id)
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            before = queries_per_sec(legacy_scan)
+            after = queries_per_sec(legacy_cached)
+        print("%6u servers: %10.1f legacy queries/s scanning, %10.1f queries/s cached" % (count, before, after))
+
+if __name__ == "__main__":
+    main()
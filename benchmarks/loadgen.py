@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# Drives a local lobby with synthetic game servers and browsers, and reports how it copes.
+#
+# A lobby is started with --port-offset (unless --no-spawn is given), then:
+# - every synthetic server sends a heartbeat every --interval seconds, new-style (TCP
+#   protocol) or legacy, from its own source port. Each legacy server and each group of
+#   --servers-per-host new-style servers gets its own 127.x.y.1 source address, so they are
+#   flood controlled like separate hosts. TCP listeners on the wildcard address, one per
+#   game port of a host, answer the reachability checks for all of them.
+# - --clients concurrent browsers run newstyle, legacy and /status queries back to back.
+#
+# After a warmup until all servers are listed, both run for --duration seconds. The report
+# shows throughput and latency percentiles per query type, client errors, registrations
+# dropped by the lobby (from /metrics), and the lobby's memory use. --output saves it as
+# JSON for comparing versions. --frontend asyncio or uvloop tests aiolobby.py instead of lobby.py.
+
+import os, sys, math, time, uuid, json, struct, socket, random, asyncio, argparse, resource, subprocess
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+GG2_BASE_UUID = uuid.UUID("dea41970-4cea-a588-df40-62faef6f1738")
+LEGACY_MAGIC = bytes([4, 8, 15, 16, 23, 42])
+LEGACY_PORT, NEWSTYLE_PORT, WEB_PORT = 29942, 29944, 29950
+
+def source_address(i):
+    # One /24 per host, so the per-prefix flood limit is not what is being measured
+    return "127.%u.%u.1" % (1 + i//256, i%256)
+
+def newstyle_heartbeat(server_id, port, i):
+    kvpairs = [(b"name", b"Load test server %u" % i), (b"game", b"Gang Garrison 2"), (b"game_short", b"gg2"),
+               (b"map", b"ctf_map%u" % (i%20)), (b"protocol_id", uuid.UUID(int=GG2_BASE_UUID.int+1+i%5).bytes)]
+    packet = REG_PROTOCOL_ID.bytes + struct.pack(">16s16sBHHHHHH", server_id.bytes, GG2_LOBBY_ID.bytes, 0, port,
+                                                 24, i%25, 0, 0, len(kvpairs))
+    return packet + b"".join([bytes([len(k)]) + k + struct.pack(">H", len(v)) + v for (k, v) in kvpairs])
+
+def legacy_heartbeat(port, i):
+    infostr = b"[ctf_map%u] Legacy load test server %u [%u/24]" % (i%20, i, i%25)
+    return LEGACY_MAGIC + bytes([1 + i%5]) + struct.pack("<H", port) + bytes([len(infostr)]) + infostr
+
+class SyntheticServers:
+    def __init__(self, count, legacy_fraction, interval, game_ports, port_offset):
+        self.interval = interval
+        self.sent = 0
+        self.send_errors = 0
+        self.servers = []
+        # Legacy servers are identified by address and game port, they cannot share a host here
+        legacy_count = int(math.ceil(count*legacy_fraction))
+        for i in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            if(i < legacy_count):
+                sock.bind((source_address(i), 0))
+                self.servers.append((sock, legacy_heartbeat(game_ports[0], i), ("127.0.0.1", LEGACY_PORT+port_offset)))
+            else:
+                # Servers on the same host need different game ports
+                host, index = divmod(i-legacy_count, len(game_ports))
+                sock.bind((source_address(legacy_count + host), 0))
+                self.servers.append((sock, newstyle_heartbeat(uuid.uuid4(), game_ports[index], i), ("127.0.0.1", NEWSTYLE_PORT+port_offset)))
+
+    async def run(self):
+        # Spread the heartbeats evenly over the interval, in ticks of 10ms
+        tick = 0.01
+        per_tick = max(1, int(len(self.servers)*tick/self.interval))
+        index = 0
+        next_tick = time.monotonic()
+        while(True):
+            for i in range(per_tick):
+                sock, packet, dest = self.servers[index]
+                index = (index+1) % len(self.servers)
+                try:
+                    sock.sendto(packet, dest)
+                    self.sent += 1
+                except OSError:
+                    self.send_errors += 1
+            next_tick += tick
+            await asyncio.sleep(max(0, next_tick-time.monotonic()))
+
+    def close(self):
+        for sock, packet, dest in self.servers:
+            sock.close()
+
+async def read_to_end(reader):
+    while(await reader.read(65536)):
+        pass
+
+def query_request(kind):
+    if(kind == "newstyle"):
+        return LIST_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes, NEWSTYLE_PORT
+    if(kind == "legacy"):
+        return bytes([1]), LEGACY_PORT
+    return b"GET /status HTTP/1.0\r\nAccept-Encoding: gzip\r\n\r\n", WEB_PORT
+
+class QueryStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+async def browser(kinds, stats, port_offset, deadline):
+    while(time.monotonic() < deadline):
+        kind = random.choice(kinds)
+        request, port = query_request(kind)
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port+port_offset), 5)
+            writer.write(request)
+            await asyncio.wait_for(read_to_end(reader), 5)
+            writer.close()
+            stats[kind].latencies.append(time.perf_counter()-start)
+        except (OSError, asyncio.TimeoutError):
+            stats[kind].errors += 1
+
+async def http_get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET %s HTTP/1.0\r\n\r\n" % path)
+    response = await reader.read()
+    writer.close()
+    return response.split(b"\r\n\r\n", 1)[1].decode("utf-8")
+
+async def fetch_metrics(port_offset):
+    samples = {}
+    for line in (await http_get(WEB_PORT+port_offset, b"/metrics")).splitlines():
+        if(line and not line.startswith("#")):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+def rss_kb(pid):
+    """ Current and peak resident memory of pid and its child processes, in kB. """
+    current = peak = 0
+    pids = [pid]
+    try:
+        with open("/proc/%u/task/%u/children" % (pid, pid)) as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open("/proc/%u/status" % p) as f:
+                for line in f:
+                    if(line.startswith("VmRSS:")):
+                        current += int(line.split()[1])
+                    elif(line.startswith("VmHWM:")):
+                        peak += int(line.split()[1])
+        except OSError:
+            pass
+    return current, peak
+
+def percentile(sorted_values, fraction):
+    if(not sorted_values):
+        return None
+    return sorted_values[int(fraction*(len(sorted_values)-1))]
+
+def summarize_queries(stats, seconds):
+    result = {}
+    for kind, s in stats.items():
+        latencies = sorted(s.latencies)
+        result[kind] = {
+            "queries": len(latencies),
+            "queries_per_sec": len(latencies)/seconds,
+            "errors": s.errors,
+            "p50_ms": None if not latencies else percentile(latencies, 0.5)*1000,
+            "p99_ms": None if not latencies else percentile(latencies, 0.99)*1000,
+            "max_ms": None if not latencies else latencies[-1]*1000,
+        }
+    return result
+
+def metric_delta(before, after, prefix):
+    return {name: after[name]-before.get(name, 0) for name in after if name.startswith(prefix) and after[name] != before.get(name, 0)}
+
+async def run(args, lobby_pid):
+    # Answer the reachability checks for all synthetic servers, one game port per server on a host
+    listeners = [await asyncio.start_server(lambda reader, writer: writer.close(), "0.0.0.0", 0) for i in range(args.servers_per_host)]
+    game_ports = [listener.sockets[0].getsockname()[1] for listener in listeners]
+
+    servers = SyntheticServers(args.servers, args.legacy_fraction, args.interval, game_ports, args.port_offset)
+    heartbeats = asyncio.ensure_future(servers.run())
+
+    warmup_start = time.monotonic()
+    listed = 0
+    while(time.monotonic()-warmup_start < args.warmup_timeout):
+        await asyncio.sleep(0.5)
+        listed = (await fetch_metrics(args.port_offset)).get("lobby_servers", 0)
+        if(listed >= args.servers):
+            break
+    warmup = time.monotonic()-warmup_start
+    print("Warmup: %u of %u servers listed after %.1f s" % (listed, args.servers, warmup))
+
+    kinds = []
+    for part in args.mix.split(","):
+        kind, weight = part.split("=")
+        kinds += [kind]*int(weight)
+    stats = {kind: QueryStats() for kind in set(kinds)}
+
+    before = await fetch_metrics(args.port_offset)
+    sent_before = servers.sent
+    start = time.monotonic()
+    await asyncio.gather(*[browser(kinds, stats, args.port_offset, start+args.duration) for i in range(args.clients)])
+    elapsed = time.monotonic()-start
+    after = await fetch_metrics(args.port_offset)
+
+    heartbeats.cancel()
+    servers.close()
+    for listener in listeners:
+        listener.close()
+
+    rss, peak_rss = rss_kb(lobby_pid) if lobby_pid is not None else (None, None)
+    return {
+        "parameters": vars(args),
+        "version": git_version(),
+        "warmup_sec": warmup,
+        "servers_listed": after.get("lobby_servers"),
+        "duration_sec": elapsed,
+        "heartbeats_sent": servers.sent-sent_before,
+        "heartbeats_per_sec": (servers.sent-sent_before)/elapsed,
+        "heartbeat_send_errors": servers.send_errors,
+        "registrations_received": metric_delta(before, after, "lobby_registration_packets_total"),
+        "registrations_dropped": metric_delta(before, after, "lobby_registration_dropped_total"),
+        "reachability_requests": metric_delta(before, after, "lobby_reachability_requests_total"),
+        "queries": summarize_queries(stats, elapsed),
+        "lobby_rss_kb": rss,
+        "lobby_peak_rss_kb": peak_rss,
+    }
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic()+timeout
+    while(time.monotonic() < deadline):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def print_report(result):
+    print("%u servers, %.1f heartbeats/s, %u send errors" % (result["parameters"]["servers"], result["heartbeats_per_sec"], result["heartbeat_send_errors"]))
+    for name, count in sorted(result["registrations_dropped"].items()):
+        print("  dropped %-60s %u" % (name, count))
+    if(not result["registrations_dropped"]):
+        print("  no registrations dropped")
+    for kind, q in sorted(result["queries"].items()):
+        if(q["queries"]):
+            print("%-8s %8.1f queries/s  p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms  %u errors"
+                  % (kind, q["queries_per_sec"], q["p50_ms"], q["p99_ms"], q["max_ms"], q["errors"]))
+        else:
+            print("%-8s no successful queries, %u errors" % (kind, q["errors"]))
+    if(result["lobby_rss_kb"] is not None):
+        print("lobby RSS %u kB, peak %u kB" % (result["lobby_rss_kb"], result["lobby_peak_rss_kb"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a local lobby")
+    parser.add_argument("--servers", type=int, default=2000, help="number of synthetic game servers (default: 2000)")
+    parser.add_argument("--legacy-fraction", type=float, default=0.25, help="fraction of servers using the legacy protocol (default: 0.25)")
+    parser.add_argument("--servers-per-host", type=int, default=1,
+                        help="new-style servers sharing one source address, like a host running many servers (default: 1)")
+    parser.add_argument("--interval", type=float, default=5, help="heartbeat interval of each server in seconds (default: 5)")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent query clients (default: 20)")
+    parser.add_argument("--mix", default="newstyle=6,legacy=3,status=1", help="query mix as kind=weight pairs (default: newstyle=6,legacy=3,status=1)")
+    parser.add_argument("--duration", type=float, default=20, help="measurement time in seconds (default: 20)")
+    parser.add_argument("--warmup-timeout", type=float, default=60, help="maximum time to wait for all servers to be listed (default: 60)")
+    parser.add_argument("--port-offset", type=int, default=1000, help="port offset of the lobby under test (default: 1000)")
+    parser.add_argument("--workers", type=int, default=1, help="--workers for the spawned lobby (default: 1)")
+    parser.add_argument("--frontend", choices=("twisted", "asyncio", "uvloop"), default="twisted",
+                        help="spawn lobby.py (twisted) or aiolobby.py, with or without --uvloop (default: twisted)")
+    parser.add_argument("--no-spawn", action="store_true", help="test an already running lobby instead of starting one")
+    parser.add_argument("--output", metavar="PATH", help="save the results as JSON")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if(args.servers+args.clients+100 > hard):
+        parser.error("--servers needs one socket per server, but only %u files may be open" % hard)
+
+    lobby = None
+    if(not args.no_spawn):
+        if(args.frontend == "twisted"):
+            command = ["lobby.py", "--workers", str(args.workers)]
+        elif(args.workers != 1):
+            parser.error("--workers is only supported by the twisted frontend")
+        else:
+            command = ["aiolobby.py"] + (["--uvloop"] if args.frontend == "uvloop" else [])
+        # All clients connect from 127.0.0.1, so the per-IP connection limit must allow all of them
+        lobby = subprocess.Popen([sys.executable] + command + ["--port-offset", str(args.port_offset), "--log-level", "warning",
+                                                               "--max-query-connections-per-ip", str(max(32, 2*args.clients))],
+                                 cwd=REPO_ROOT)
+    try:
+        if(not wait_for_port(WEB_PORT+args.port_offset)):
+            sys.exit("Lobby is not listening on port %u" % (WEB_PORT+args.port_offset))
+        result = asyncio.run(run(args, None if lobby is None else lobby.pid))
+    finally:
+        if(lobby is not None):
+            lobby.terminate()
+            lobby.wait(timeout=10)
+
+    print_report(result)
+    if(args.output):
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Measures newstyle query throughput with logging disabled, with the buffered logger,
+# and with synchronous print() as before, both to /dev/null and to a stalling stream.
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lobbycore, lobbylog
+from list_query import make_server_list, queries_per_sec
+
+class StallingStream:
+    """ A stream like a terminal or pipe nobody reads fast enough. """
+    def __init__(self, delay=0.001):
+        self.delay = delay
+
+    def write(self, data):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+def main():
+    newstyle = lobbycore.NewStyleQuery(make_server_list(10))
+
+    def query():
+        newstyle.reply(lobbycore.GG2_LOBBY_ID)
+
+    def query_print(stream):
+        def run():
+            newstyle.reply(lobbycore.GG2_LOBBY_ID)
+            print("Received newstyle query for Lobby %s, returned %u Servers." % (lobbycore.GG2_LOBBY_ID.hex, 10), file=stream)
+        return run
+
+    with open(os.devnull, "w") as devnull:
+        for name, stream in (("/dev/null", devnull), ("stalling stream", StallingStream())):
+            lobbycore.LOG = lobbylog.Logger(stream, level=lobbylog.OFF)
+            disabled = queries_per_sec(query)
+            lobbycore.LOG = lobbylog.Logger(stream)
+            limited = queries_per_sec(query)
+            lobbycore.LOG.close()
+            lobbycore.LOG = lobbylog.Logger(stream, rate_limit=10**9)
+            unlimited = queries_per_sec(query)
+            lobbycore.LOG.close()
+            lobbycore.LOG = lobbylog.Logger(stream, level=lobbylog.OFF)
+            printed = queries_per_sec(query_print(stream), seconds=1.0)
+            print("%-15s: %9.1f queries/s logging off, %9.1f rate-limited, %9.1f every query, %9.1f with print()"
+                  % (name, disabled, limited, unlimited, printed))
+
+if __name__ == "__main__":
+    main()
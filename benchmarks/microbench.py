@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# Microbenchmarks for the inner loops of the lobby: registration parsing, server
+# serialization, the server list and expirationset, the query timeout wheel, and the
+# status page rows.
+#
+# Every benchmark runs at several scales on generated data (fixed random seed) and
+# reports the best time per operation over several repeats. --output saves a JSON report,
+# --compare prints the change against an earlier report.
+
+import os, sys, time, uuid, json, random, struct, argparse, platform, subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from twisted.internet.task import Clock
+import legacyinfo, lobbycore, lobbylog, regparser, statuspage
+from serverlist import GameServer, GameServerList, INFO_INTERN
+from expirationset import expirationset
+from connlimit import TimeoutWheel
+from floodcontrol import FloodControl
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+BULK_REG_PROTOCOL_ID = uuid.UUID("6d3f8a21-5c47-4b9e-8e12-a04f7c9b3d58")
+BULK_SERVERS = 50
+SCALES = (100, 1000, 10000)
+MAPS = [b"ctf_truefort", b"ctf_2dfort", b"cp_dirtbowl", b"koth_harvest", b"arena_montane", b"gen_destroy", b"ctf_eiger"]
+WORDS = [b"Bacon", b"Town", b"24/7", b"Pro", b"Only", b"Noobs", b"Welcome", b"Fun", b"Server", b"GG2", b"EU", b"US", b"Vanilla"]
+MODS = [None, None, None, b"OHU", b"Nitro Mod 1.4", b"Randomizer"]
+
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+def server_name(rng):
+    return b" ".join(rng.choice(WORDS) for i in range(rng.randint(1, 5)))
+
+def make_server(rng, i, lobby_id=lobbycore.GG2_LOBBY_ID):
+    server = GameServer(uuid.UUID(int=rng.getrandbits(128)), lobby_id)
+    server.ipv4_endpoint = (struct.pack(">L", 0x0a000000+i), 8190)
+    server.name = server_name(rng)
+    server.slots = rng.choice((8, 16, 24, 32))
+    server.players = rng.randint(0, server.slots)
+    server.bots = rng.choice((0, 0, 0, 2))
+    server.passworded = rng.random() < 0.1
+    server.infos = INFO_INTERN.intern_infos({
+        b"game": b"Gang Garrison 2", b"game_short": b"gg2", b"game_ver": b"v2.3.7",
+        b"map": rng.choice(MAPS), b"protocol_id": uuid.UUID(int=lobbycore.GG2_BASE_UUID.int+rng.randint(1, 5)).bytes})
+    return server
+
+def make_servers(rng, count):
+    return [make_server(rng, i) for i in range(count)]
+
+def info_string(rng):
+    parts = []
+    if(rng.random() < 0.1): parts.append(b"!private!")
+    parts.append(b"[%s] " % rng.choice(MAPS))
+    parts.append(server_name(rng))
+    slots = rng.choice((8, 16, 24))
+    parts.append(b" [%u/%u]" % (rng.randint(0, slots), slots))
+    mod = rng.choice(MODS)
+    if(mod is not None): parts.append(b" - " + mod)
+    return b"".join(parts)
+
+def registration_datagram(rng):
+    kvpairs = [(b"name", server_name(rng)), (b"game", b"Gang Garrison 2"), (b"game_short", b"gg2"),
+               (b"game_ver", b"v2.3.7"), (b"map", rng.choice(MAPS)),
+               (b"protocol_id", uuid.UUID(int=lobbycore.GG2_BASE_UUID.int+rng.randint(1, 5)).bytes)]
+    header = REG_PROTOCOL_ID.bytes + uuid.UUID(int=rng.getrandbits(128)).bytes + lobbycore.GG2_LOBBY_ID.bytes
+    header += struct.pack(">BHHHHHH", 1, rng.randint(1024, 65535), 24, rng.randint(0, 24), 0, 0, len(kvpairs))
+    return header + b"".join([bytes([len(k)]) + k + struct.pack(">H", len(v)) + v for (k, v) in kvpairs])
+
+def bulk_registration_datagram(rng, count):
+    def kvtable(kvpairs):
+        return struct.pack(">H", len(kvpairs)) + b"".join([bytes([len(k)]) + k + struct.pack(">H", len(v)) + v for (k, v) in kvpairs])
+    shared = [(b"game", b"Gang Garrison 2"), (b"game_short", b"gg2"), (b"game_ver", b"v2.3.7"),
+              (b"protocol_id", uuid.UUID(int=lobbycore.GG2_BASE_UUID.int+rng.randint(1, 5)).bytes)]
+    parts = [BULK_REG_PROTOCOL_ID.bytes, lobbycore.GG2_LOBBY_ID.bytes, bytes([1]), kvtable(shared), struct.pack(">H", count)]
+    for i in range(count):
+        parts.append(uuid.UUID(int=rng.getrandbits(128)).bytes + struct.pack(">HHHHH", 1024+i, 24, rng.randint(0, 24), 0, 0))
+        parts.append(kvtable([(b"name", server_name(rng)), (b"map", rng.choice(MAPS))]))
+    return b"".join(parts)
+
+# Each benchmark returns (function running all operations once, number of operations).
+# Setup which must be repeated for every run goes into a prepare function, returned as
+# a third element, which is called before every timed run.
+
+@benchmark("info_pattern_match")
+def bench_info_pattern(rng, scale):
+    strings = [info_string(rng) for i in range(scale)]
+    match = legacyinfo.INFO_PATTERN.match
+    def run():
+        for s in strings:
+            match(s)
+    return run, scale
+
+@benchmark("legacy_info_cache_parse")
+def bench_legacy_info_cache(rng, scale):
+    strings = [info_string(rng) for i in range(scale)]
+    cache = legacyinfo.InfoCache(max_entries=scale)
+    for s in strings:
+        cache.parse(s)
+    parse = cache.parse
+    def run():
+        for s in strings:
+            parse(s)
+    return run, scale
+
+@benchmark("parse_registration")
+def bench_parse_registration(rng, scale):
+    datagrams = [registration_datagram(rng) for i in range(scale)]
+    parse = regparser.parse_registration
+    def run():
+        for d in datagrams:
+            parse(d)
+    return run, scale
+
+@benchmark("gg2reghandler_handle")
+def bench_reg_handler(rng, scale):
+    datagrams = [(registration_datagram(rng), ("10.%u.%u.1" % (i//256, i%256), 8190)) for i in range(scale)]
+    handler = lobbycore.GG2RegHandler()
+    serverList = GameServerList()
+    def run():
+        for data, addr in datagrams:
+            handler.handle(data, addr, serverList)
+    return run, scale
+
+@benchmark("bulkreghandler_handle_per_server")
+def bench_bulk_reg_handler(rng, scale):
+    datagrams = [(bulk_registration_datagram(rng, BULK_SERVERS), ("10.%u.%u.1" % (i//256, i%256), 8190))
+                 for i in range(scale//BULK_SERVERS)]
+    handler = lobbycore.GG2BulkRegHandler()
+    serverList = GameServerList()
+    def run():
+        for data, addr in datagrams:
+            handler.handle(data, addr, serverList)
+    return run, len(datagrams)*BULK_SERVERS
+
+@benchmark("newstyle_format_server")
+def bench_newstyle_format(rng, scale):
+    servers = make_servers(rng, scale)
+    format = lobbycore.NewStyleQuery(None).formatServerData
+    def run():
+        for server in servers:
+            format(server)
+    return run, scale
+
+@benchmark("legacy_format_server")
+def bench_legacy_format(rng, scale):
+    servers = make_servers(rng, scale)
+    format = lobbycore.LegacyQuery(None).formatServerData
+    def run():
+        for server in servers:
+            format(server)
+    return run, scale
+
+@benchmark("serverlist_put_new")
+def bench_put_new(rng, scale):
+    servers = make_servers(rng, scale)
+    state = {}
+    def prepare():
+        state["list"] = GameServerList()
+    def run():
+        put = state["list"].put
+        for server in servers:
+            put(server)
+    return run, scale, prepare
+
+@benchmark("serverlist_put_heartbeat")
+def bench_put_heartbeat(rng, scale):
+    servers = make_servers(rng, scale)
+    serverList = GameServerList()
+    for server in servers:
+        serverList.put(server)
+    heartbeats = [GameServer(server.server_id, server.lobby_id) for server in servers]
+    for heartbeat, server in zip(heartbeats, servers):
+        for attr in ("ipv4_endpoint", "name", "slots", "players", "bots", "passworded", "infos"):
+            setattr(heartbeat, attr, getattr(server, attr))
+    def run():
+        for heartbeat in heartbeats:
+            serverList.put(heartbeat)
+    return run, scale
+
+@benchmark("serverlist_get_servers_in_lobby")
+def bench_get_servers(rng, scale):
+    serverList = GameServerList()
+    for server in make_servers(rng, scale):
+        serverList.put(server)
+    def run():
+        serverList.get_servers_in_lobby(lobbycore.GG2_LOBBY_ID)
+    return run, 1
+
+@benchmark("expirationset_add")
+def bench_expiration_add(rng, scale):
+    state = {}
+    def prepare():
+        state["set"] = expirationset(70)
+    def run():
+        add = state["set"].add
+        for i in range(scale):
+            add(i)
+    return run, scale, prepare
+
+@benchmark("expirationset_add_timer")
+def bench_expiration_add_timer(rng, scale):
+    state = {}
+    def prepare():
+        state["set"] = expirationset(70, clock=Clock())
+    def run():
+        add = state["set"].add
+        for i in range(scale):
+            add(i)
+    return run, scale, prepare
+
+@benchmark("timeout_wheel_add_remove")
+def bench_timeout_wheel(rng, scale):
+    wheel = TimeoutWheel(Clock(), 5)
+    keys = [object() for i in range(scale)]
+    def run():
+        add, remove = wheel.add, wheel.remove
+        for key in keys:
+            add(key, None)
+        for key in keys:
+            remove(key)
+    return run, scale
+
+@benchmark("expirationset_contains")
+def bench_expiration_contains(rng, scale):
+    s = expirationset(70)
+    for i in range(scale):
+        s.add(i)
+    def run():
+        for i in range(scale):
+            i in s
+    return run, scale
+
+@benchmark("expirationset_cleanup")
+def bench_expiration_cleanup(rng, scale):
+    state = {}
+    def prepare():
+        # Timer mode, so adding the already stale entries does not expire them yet
+        s = state["set"] = expirationset(70, callback=lambda key, expired: None, clock=Clock())
+        for i in range(scale):
+            s.add(i, -100)
+    def run():
+        state["set"].cleanup_stale()
+    return run, scale, prepare
+
+@benchmark("status_format_server")
+def bench_format_server(rng, scale):
+    servers = make_servers(rng, scale)
+    format = statuspage.StatusPage(GameServerList())._format_server
+    def run():
+        for server in servers:
+            format(server)
+    return run, scale
+
+def measure(func, ops, prepare=None, min_time=0.2, min_repeats=5, max_wall_time=2.0):
+    """ Best time per operation in nanoseconds, over at least min_repeats runs and min_time
+        seconds, unless the runs including their preparation take longer than max_wall_time. """
+    best = None
+    total = 0
+    repeats = 0
+    wall_start = time.perf_counter()
+    while(repeats < min_repeats or (total < min_time and time.perf_counter()-wall_start < max_wall_time)):
+        if(prepare is not None):
+            prepare()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter()-start
+        total += elapsed
+        repeats += 1
+        if(best is None or elapsed < best):
+            best = elapsed
+    return best*1e9/ops
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the lobby microbenchmarks")
+    parser.add_argument("--scales", default=",".join(map(str, SCALES)), help="comma-separated data sizes (default: %s)" % ",".join(map(str, SCALES)))
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", metavar="PATH", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="compare with the results in an earlier JSON report")
+    args = parser.parse_args()
+
+    lobbylog.LOG.set_level(lobbylog.OFF)
+    # Every datagram comes from its own address, but the runs repeat them quickly
+    lobbycore.FLOOD_CONTROL = FloodControl(endpoint_rate=1e9, endpoint_burst=1e9, ip_rate=1e9, ip_burst=1e9, prefix_rate=1e9, prefix_burst=1e9)
+
+    previous = {}
+    if(args.compare):
+        with open(args.compare) as f:
+            previous = {(r["name"], r["scale"]): r["ns_per_op"] for r in json.load(f)["results"]}
+
+    results = []
+    for name, func in BENCHMARKS:
+        if(args.filter not in name):
+            continue
+        for scale in map(int, args.scales.split(",")):
+            setup = func(random.Random(scale), scale)
+            ns = measure(*setup)
+            results.append({"name": name, "scale": scale, "ns_per_op": ns})
+            line = "%-32s %6u %12.1f ns/op" % (name, scale, ns)
+            if((name, scale) in previous):
+                line += "  %+6.1f%%" % ((ns/previous[name, scale]-1)*100)
+            print(line)
+
+    if(args.output):
+        report = {"version": git_version(), "python": platform.python_version(), "machine": platform.machine(), "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Measures NewStyleList query throughput of a local lobby for a growing number of
+# worker processes (lobby.py --workers N). Uses the default lobby ports, so no other
+# lobby may be running.
+
+import os, sys, time, uuid, struct, socket, subprocess, multiprocessing
+from contextlib import closing
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+SERVERS = 500
+CLIENTS = 8
+SECONDS = 5
+
+def register_servers():
+    for i in range(SERVERS):
+        kvtable = bytes([4]) + b"name" + struct.pack(">H", 16) + b"Benchmark %6u" % i
+        packet = REG_PROTOCOL_ID.bytes + uuid.uuid4().bytes + GG2_LOBBY_ID.bytes
+        packet += struct.pack(">BHHHHHH", 1, 8190, 24, i % 24, 0, 0, 1) + kvtable
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # Spread the sources over loopback addresses to stay within the flood control limits
+            sock.bind(("127.0.%u.%u" % (i // 200, i % 200 + 1), 0))
+            sock.sendto(packet, ("127.0.0.1", 29944))
+
+def query_loop(deadline):
+    count = 0
+    while(time.time() < deadline):
+        with closing(socket.create_connection(("127.0.0.1", 29944), timeout=5)) as sock:
+            sock.sendall(LIST_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes)
+            while(sock.recv(65536)):
+                pass
+        count += 1
+    return count
+
+def wait_for_port(port):
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Lobby did not start")
+
+def measure(workers):
+    lobby = subprocess.Popen([sys.executable, "lobby.py", "--workers", str(workers)], cwd=REPO_ROOT,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(29944)
+        time.sleep(1)
+        register_servers()
+        time.sleep(1)
+        deadline = time.time()+SECONDS
+        with multiprocessing.Pool(CLIENTS) as pool:
+            total = sum(pool.map(query_loop, [deadline]*CLIENTS))
+        return total/SECONDS
+    finally:
+        lobby.terminate()
+        lobby.wait()
+
+def main():
+    print("%u CPUs, %u servers, %u query clients" % (os.cpu_count(), SERVERS, CLIENTS))
+    for workers in (1, 2, 4):
+        print("%u worker(s): %8.1f queries/s" % (workers, measure(workers)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Compares registration datagram parsing throughput of regparser against the old
+# slicing parser for a typical small datagram and a maximum-size one with many keys.
+
+import os, sys, time, uuid, struct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import regparser
+
+REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+MAX_DATAGRAM = 65507
+
+def make_datagram(kvpairs):
+    header = REG_PROTOCOL_ID.bytes + uuid.uuid4().bytes + uuid.uuid4().bytes
+    header += struct.pack(">BHHHHHH", 1, 8190, 24, 10, 0, 0, len(kvpairs))
+    return header + b"".join([bytes([len(k)]) + k + struct.pack(">H", len(v)) + v for (k, v) in kvpairs])
+
+def small_datagram():
+    return make_datagram([(b"name", b"Bacon Town 24/7"), (b"game", b"Gang Garrison 2"), (b"game_short", b"gg2"),
+                          (b"game_ver", b"v2.3.7"), (b"map", b"ctf_truefort"), (b"protocol_id", uuid.uuid4().bytes)])
+
+def large_datagram():
+    kvpairs = [(b"name", b"Bacon Town 24/7")]
+    size = len(make_datagram(kvpairs))
+    i = 0
+    while(True):
+        pair = (b"x-key%u" % i, b"value %u" % i)
+        pairsize = 3 + len(pair[0]) + len(pair[1])
+        if(size + pairsize > MAX_DATAGRAM): break
+        kvpairs.append(pair)
+        size += pairsize
+        i += 1
+    return make_datagram(kvpairs)
+
+def old_parse(data):
+    # The parser GG2RegHandler.handle used before regparser existed
+    if(len(data) < 61): return None
+    server_id = uuid.UUID(bytes=data[16:32])
+    lobby_id = uuid.UUID(bytes=data[32:48])
+    protocol = data[48]
+    port = struct.unpack(">H", data[49:51])[0]
+    slots, players, bots = struct.unpack(">HHH", data[51:57])
+    passworded = ((data[58] & 1) != 0)
+    infos = {}
+    kventries = struct.unpack(">H", data[59:61])[0]
+    kvtable = data[61:]
+    for i in range(kventries):
+        if(len(kvtable) < 1): return None
+        keylen = kvtable[0]
+        valueoffset = keylen+3
+        if(len(kvtable) < valueoffset): return None
+        key = kvtable[1:keylen+1]
+        valuelen = struct.unpack(">H", kvtable[keylen+1:valueoffset])[0]
+        if(len(kvtable) < valueoffset+valuelen): return None
+        infos[key] = kvtable[valueoffset:valueoffset+valuelen]
+        kvtable = kvtable[valueoffset+valuelen:]
+    return server_id, lobby_id, protocol, port, slots, players, bots, passworded, infos
+
+def parses_per_sec(func, data, seconds=1.0):
+    count = 0
+    start = time.perf_counter()
+    while(time.perf_counter()-start < seconds):
+        func(data)
+        count += 1
+    return count/(time.perf_counter()-start)
+
+def main():
+    for name, data in (("small", small_datagram()), ("64KB", large_datagram())):
+        keys = len(regparser.parse_registration(data).infos)
+        assert old_parse(data)[-1] == regparser.parse_registration(data).infos
+        before = parses_per_sec(old_parse, data)
+        after = parses_per_sec(regparser.parse_registration, data)
+        print("%-5s (%5u bytes, %4u keys): %10.1f parses/s old, %10.1f parses/s regparser" % (name, len(data), keys, before, after))
+
+if __name__ == "__main__":
+    main()
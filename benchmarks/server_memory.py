@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Reports the memory used per registered server for the slotted, interned GameServer
+# layout and for the previous layout (plain object, per-server copies of every value).
+
+import os, sys, uuid, struct, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import regparser
+from serverlist import GameServer, INFO_INTERN
+from lobbycore import GG2_BASE_UUID, GG2_LOBBY_ID
+
+REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+MAPS = [b"ctf_truefort", b"ctf_2dfort", b"cp_dirtbowl", b"koth_harvest", b"arena_montane"]
+
+class DictGameServer:
+    # The GameServer layout before __slots__ and interning
+    def __init__(self, server_id, lobby_id):
+        self.server_id = server_id
+        self.lobby_id = lobby_id
+        self.protocol = 0
+        self.ipv4_endpoint = None
+        self.ipv6_endpoint = None
+        self.name = b""
+        self.slots = 0
+        self.players = 0
+        self.bots = 0
+        self.passworded = False
+        self.infos = {}
+
+def make_datagram(i):
+    kvpairs = [(b"name", b"Benchmark server %u" % i), (b"game", b"Gang Garrison 2"), (b"game_short", b"gg2"),
+               (b"game_ver", b"v2.3.7"), (b"map", MAPS[i % len(MAPS)]),
+               (b"protocol_id", uuid.UUID(int=GG2_BASE_UUID.int+1).bytes)]
+    data = REG_PROTOCOL_ID.bytes + uuid.uuid4().bytes + GG2_LOBBY_ID.bytes
+    data += struct.pack(">BHHHHHH", 1, 8190, 24, i % 24, 0, 0, len(kvpairs))
+    return data + b"".join([bytes([len(k)]) + k + struct.pack(">H", len(v)) + v for (k, v) in kvpairs])
+
+def build(datagrams, server_class, interned):
+    servers = []
+    for i, data in enumerate(datagrams):
+        registration = regparser.parse_registration(data)
+        server = server_class(registration.server_id, registration.lobby_id)
+        server.protocol = registration.protocol
+        server.ipv4_endpoint = (i.to_bytes(4, "big"), registration.port)
+        server.slots, server.players, server.bots = registration.slots, registration.players, registration.bots
+        server.passworded = registration.passworded
+        server.infos = INFO_INTERN.intern_infos(registration.infos) if interned else registration.infos
+        server.name = server.infos.pop(b"name")
+        servers.append(server)
+    return servers
+
+def bytes_per_server(datagrams, server_class, interned):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    servers = build(datagrams, server_class, interned)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del servers
+    return used/len(datagrams)
+
+def main():
+    for count in (10000, 100000):
+        datagrams = [make_datagram(i) for i in range(count)]
+        before = bytes_per_server(datagrams, DictGameServer, False)
+        after = bytes_per_server(datagrams, GameServer, True)
+        print("%6u servers: %6.0f bytes/server before, %6.0f bytes/server now" % (count, before, after))
+
+if __name__ == "__main__":
+    main()
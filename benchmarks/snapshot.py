@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Measures the cost of writing a server list snapshot, split into taking the records (on
+# the reactor thread) and encoding and writing them (on a thread), and of restoring it.
+
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import snapshot
+from serverlist import GameServerList
+from list_query import make_server_list
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "lobby.snapshot")
+        for count in (10000, 100000):
+            serverList = make_server_list(count)
+            start = time.perf_counter()
+            records = serverList.get_servers_with_regtime()
+            records_time = time.perf_counter()-start
+            start = time.perf_counter()
+            size = snapshot.write_records(records, path)
+            write_time = time.perf_counter()-start
+
+            restoredList = GameServerList()
+            start = time.perf_counter()
+            restored = snapshot.load_snapshot(restoredList, path)
+            load_time = time.perf_counter()-start
+            assert restored == count
+            print("%6u servers: %6.0f KB snapshot, records %6.1f ms, encode and write %7.1f ms, restore %7.1f ms" % (
+                count, size/1024, records_time*1e3, write_time*1e3, load_time*1e3))
+
+if __name__ == "__main__":
+    main()
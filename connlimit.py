@@ -0,0 +1,84 @@
+# Connection management for the TCP query ports.
+#
+# TimeoutWheel closes idle connections with one timer for all of them instead of one
+# timer per connection: entries are kept in a ring of slots, one per `resolution`
+# seconds, and each tick expires the slot it reaches. An entry therefore expires between
+# timeout and timeout+resolution seconds after it was added.
+#
+# ConnectionLimits counts the open connections per source IP and in total, so a flood of
+# connections is rejected as soon as it is accepted, before any per-connection state
+# is set up.
+
+import math
+
+class TimeoutWheel:
+    def __init__(self, clock, timeout, resolution=1.0):
+        self._clock = clock
+        self.resolution = resolution
+        self._slots = [{} for i in range(int(math.ceil(timeout/resolution))+1)]
+        self._position = 0      # index of the slot expired by the next tick
+        self._slot_of = {}      # key -> slot dict
+        self._timer = None
+        self.expired = 0
+
+    def add(self, key, func):
+        """ Call func() after the timeout unless key is removed before. """
+        slot = self._slots[(self._position-1) % len(self._slots)]
+        slot[key] = func
+        self._slot_of[key] = slot
+        if(self._timer is None):
+            self._timer = self._clock.callLater(self.resolution, self._tick)
+
+    def remove(self, key):
+        slot = self._slot_of.pop(key, None)
+        if(slot is not None):
+            del slot[key]
+
+    def _tick(self):
+        slot = self._slots[self._position]
+        # Entries added by func() go into the fresh slot, which is expired last
+        self._slots[self._position] = {}
+        self._position = (self._position+1) % len(self._slots)
+        while(slot):
+            key, func = slot.popitem()
+            del self._slot_of[key]
+            self.expired += 1
+            func()
+        self._timer = self._clock.callLater(self.resolution, self._tick) if self._slot_of else None
+
+    def __len__(self):
+        return len(self._slot_of)
+
+class ConnectionLimits:
+    def __init__(self, per_ip=32, total=1000):
+        self.per_ip = per_ip
+        self.total = total
+        self._open = {}     # host -> open connections
+        self.open = 0
+        self.rejected_ip = 0
+        self.rejected_total = 0
+
+    def acquire(self, host):
+        """ Count a new connection from host. Returns False if it exceeds a limit. """
+        if(self.open >= self.total):
+            self.rejected_total += 1
+            return False
+        count = self._open.get(host, 0)
+        if(count >= self.per_ip):
+            self.rejected_ip += 1
+            return False
+        self._open[host] = count+1
+        self.open += 1
+        return True
+
+    def release(self, host):
+        count = self._open[host]-1
+        if(count):
+            self._open[host] = count
+        else:
+            del self._open[host]
+        self.open -= 1
+
+    @property
+    def full(self):
+        return self.open >= self.total
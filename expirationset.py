@@ -1,19 +1,42 @@
 # dict-like class with automatic expiration of entries.
+#
+# By default, stale entries are removed whenever the set is accessed. If a clock
+# (e.g. the Twisted reactor) is passed, expiration is driven by a timer instead:
+# entries are swept in batches every sweep_interval seconds, so add and __contains__
+# never pay for it. In that mode entries may linger for up to sweep_interval
+# seconds after their retention time has passed.
 
 from collections import OrderedDict
 from time import time
+from lobbylog import LOG
 
 class expirationset:
-    def __init__(self, retention_secs, callback=None):
+    def __init__(self, retention_secs, callback=None, clock=None, sweep_interval=1.0, batch_size=1000):
         self._retention_secs = retention_secs
         self._data = OrderedDict()
         self._callback = callback
+        self._clock = clock
+        self._sweep_interval = sweep_interval
+        self._batch_size = batch_size
+        self._sweep_call = None
+        if(clock is None):
+            self._time = time
+        else:
+            self._time = clock.seconds
+            self._sweep_call = clock.callLater(sweep_interval, self._sweep)
 
-    def add(self, key):
-        self.cleanup_stale()
+    @property
+    def timer_driven(self):
+        return self._clock is not None
+
+    def add(self, key, timestamp=None):
+        """ Add or renew key. timestamp defaults to now, and must not be older than any
+            timestamp already in the set. """
+        if(self._clock is None):
+            self.cleanup_stale()
         if(key in self._data):
             del self._data[key]
-        self._data[key] = time()
+        self._data[key] = self._time() if timestamp is None else timestamp
 
     def discard(self, key):
         if(key in self._data):
@@ -22,20 +45,61 @@ class expirationset:
                 self._callback(key, False)
 
     def __contains__(self, key):
-        self.cleanup_stale()
+        if(self._clock is None):
+            self.cleanup_stale()
         return key in self._data
 
-    def cleanup_stale(self):
-        curtime = time()
-        while(True):
-            try:
-                key, regtime = next(iter(self._data.items()))
-            except StopIteration:
-                break
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        """ Iterate over (key, timestamp) pairs, oldest first. """
+        return self._data.items()
+
+    def expired(self, timestamp):
+        """ Check whether an entry added at timestamp would be stale now. """
+        return self._time()-timestamp >= self._retention_secs
+
+    def lazy_cleanup(self):
+        """ Remove stale entries now, unless that is taken care of by the timer. """
+        if(self._clock is None):
+            self.cleanup_stale()
 
-            if(curtime-regtime < self._retention_secs):
+    def cleanup_stale(self, limit=None):
+        """ Remove stale entries, at most limit of them if given.
+
+            Returns True if stale entries might remain."""
+        deadline = self._time()-self._retention_secs
+        stale = []
+        for key, regtime in self._data.items():
+            if(regtime > deadline):
+                break
+            if(limit is not None and len(stale) >= limit):
                 break
-            
+            stale.append(key)
+
+        for key in stale:
             del self._data[key]
             if(self._callback is not None):
                 self._callback(key, True)
+        return limit is not None and len(stale) >= limit
+
+    def _sweep(self):
+        more = True
+        try:
+            more = self.cleanup_stale(self._batch_size)
+        except Exception as e:
+            # The entry was removed before its callback failed, the next sweep continues after it
+            LOG.error("expiration_callback_failed", error=repr(e))
+        finally:
+            if(more):
+                # More work left, continue as soon as the reactor had a chance to serve requests
+                self._sweep_call = self._clock.callLater(0, self._sweep)
+            else:
+                self._sweep_call = self._clock.callLater(self._sweep_interval, self._sweep)
+
+    def stop(self):
+        """ Stop the expiration timer. """
+        if(self._sweep_call is not None and self._sweep_call.active()):
+            self._sweep_call.cancel()
+        self._sweep_call = None
@@ -0,0 +1,103 @@
+# Token bucket flood control for the registration listeners.
+#
+# Every source endpoint (IP and port), every source IP and every source network prefix
+# (/24 for IPv4, /48 for IPv6) gets a token bucket. A packet is only accepted if all
+# three buckets still have a token left. A game server sends its heartbeats from its own
+# port, so the endpoint bucket keeps a single misbehaving source in check, while the
+# looser IP and prefix buckets leave room for hosts and hosting ranges running many
+# servers.
+# The number of tracked buckets is capped; when the cap is reached, the least recently
+# used bucket is forgotten, so a flood of spoofed source addresses cannot grow memory
+# without limit.
+
+from collections import OrderedDict
+from time import time
+import socket
+
+# Default rates in packets per second, and bursts in packets. A host with 600 servers
+# sending a heartbeat every 30 seconds fits into the IP bucket.
+ENDPOINT_RATE, ENDPOINT_BURST = 0.2, 3
+IP_RATE, IP_BURST = 20.0, 200
+PREFIX_RATE, PREFIX_BURST = 100.0, 1000
+
+class TokenBuckets:
+    def __init__(self, rate, burst, max_entries):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.evicted = 0
+        self._buckets = OrderedDict()  # key -> [tokens, last update time]
+
+    def consume(self, key, now):
+        """ Take a token from the bucket for key. Returns False if the bucket is empty. """
+        bucket = self._buckets.get(key)
+        if(bucket is None):
+            if(len(self._buckets) >= self.max_entries):
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+            self._buckets[key] = [self.burst-1, now]
+            return True
+
+        self._buckets.move_to_end(key)
+        tokens = min(self.burst, bucket[0] + (now-bucket[1])*self.rate)
+        bucket[1] = now
+        if(tokens < 1):
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens-1
+        return True
+
+    def __len__(self):
+        return len(self._buckets)
+
+def address_prefix(host):
+    """ Return the /24 (IPv4) or /48 (IPv6) network of a host address string. """
+    if(":" in host):
+        return socket.inet_pton(socket.AF_INET6, host)[:6]
+    return host.rpartition(".")[0]
+
+class FloodControl:
+    def __init__(self, endpoint_rate=ENDPOINT_RATE, endpoint_burst=ENDPOINT_BURST, ip_rate=IP_RATE, ip_burst=IP_BURST,
+                 prefix_rate=PREFIX_RATE, prefix_burst=PREFIX_BURST, max_entries=100000, clock=None):
+        self._endpoint_buckets = TokenBuckets(endpoint_rate, endpoint_burst, max_entries)
+        self._ip_buckets = TokenBuckets(ip_rate, ip_burst, max_entries)
+        self._prefix_buckets = TokenBuckets(prefix_rate, prefix_burst, max_entries)
+        self._time = time if clock is None else clock.seconds
+        self.accepted = 0
+        self.dropped_endpoint = 0
+        self.dropped_ip = 0
+        self.dropped_prefix = 0
+
+    @property
+    def evicted(self):
+        return self._endpoint_buckets.evicted + self._ip_buckets.evicted + self._prefix_buckets.evicted
+
+    def allow(self, host, port):
+        """ Account for a packet from (host, port) and return whether it should be processed. """
+        now = self._time()
+        if(not self._endpoint_buckets.consume((host, port), now)):
+            self.dropped_endpoint += 1
+            return False
+        if(not self._ip_buckets.consume(host, now)):
+            self.dropped_ip += 1
+            return False
+        if(not self._prefix_buckets.consume(address_prefix(host), now)):
+            self.dropped_prefix += 1
+            return False
+        self.accepted += 1
+        return True
+
+def add_arguments(parser):
+    """ Add options for the rates and bursts of FloodControl to an argparse parser. """
+    for name, rate, burst, what in (("endpoint", ENDPOINT_RATE, ENDPOINT_BURST, "source IP and port"),
+                                    ("ip", IP_RATE, IP_BURST, "source IP"),
+                                    ("prefix", PREFIX_RATE, PREFIX_BURST, "source /24 (IPv4) or /48 (IPv6) network")):
+        parser.add_argument("--flood-%s-rate" % name, type=float, default=rate, metavar="PACKETS",
+                            help="registration datagrams accepted per second and %s (default: %s)" % (what, rate))
+        parser.add_argument("--flood-%s-burst" % name, type=int, default=burst, metavar="PACKETS",
+                            help="registration datagrams accepted at once per %s (default: %s)" % (what, burst))
+
+def from_arguments(args):
+    """ Create the FloodControl configured by the options of add_arguments. """
+    return FloodControl(args.flood_endpoint_rate, args.flood_endpoint_burst, args.flood_ip_rate, args.flood_ip_burst,
+                        args.flood_prefix_rate, args.flood_prefix_burst)
@@ -0,0 +1,64 @@
+# Parsing of the info strings sent by legacy GG2 servers, e.g. "!private![ctf_eiger] Bacon Town [3/10] - OHU".
+#
+# A server sends the same info string with every heartbeat until its name, map or player
+# count changes, so parsed results are kept in a bounded LRU cache keyed by the raw string.
+# The results are immutable and shared by all registrations with the same info string.
+
+import re
+from collections import OrderedDict, namedtuple
+from serverlist import INFO_INTERN
+
+INFO_PATTERN = re.compile(rb"\A(!private!)?(?:\[([^\]]*)\])?\s*(.*?)\s*(?:\[(\d+)/(\d+)\])?(?: - (.*))?\Z", re.DOTALL)
+
+# infos is a tuple of (key, value) pairs, in the order in which they are listed
+ParsedInfo = namedtuple("ParsedInfo", "passworded name players slots infos")
+
+LEGACY_GAME = b"Legacy Gang Garrison 2 version or mod"
+OHU_INFOS = ((b"game", b"Orpheon's Hosting Utilities"), (b"game_short", b"ohu"),
+             (b"game_url", b"http://www.ganggarrison.com/forums/index.php?topic=28839.0"))
+
+def parse_info(infostr):
+    """ Parse a legacy info string into a ParsedInfo. """
+    matcher = INFO_PATTERN.match(infostr)
+    if(not matcher):
+        return ParsedInfo(False, infostr, 0, 0, ((b"game", LEGACY_GAME), (b"game_short", b"old")))
+
+    infos = {b"game": LEGACY_GAME, b"game_short": b"old"}
+    if(matcher.group(2) is not None): infos[b"map"] = INFO_INTERN.intern(matcher.group(2))
+    mod = matcher.group(6)
+    if(mod is not None):
+        if(mod==b"OHU"):
+            infos.update(OHU_INFOS)
+        else:
+            infos[b"game"] = INFO_INTERN.intern(mod)
+            if(len(mod)<=10): del infos[b"game_short"]
+    players = int(matcher.group(4)) if matcher.group(4) is not None else 0
+    slots = int(matcher.group(5)) if matcher.group(5) is not None else 0
+    return ParsedInfo(matcher.group(1) is not None, matcher.group(3), players, slots, tuple(infos.items()))
+
+class InfoCache:
+    """ Bounded LRU cache of parse_info results. """
+    def __init__(self, max_entries=4096):
+        self._cache = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def parse(self, infostr):
+        parsed = self._cache.get(infostr)
+        if(parsed is not None):
+            self.hits += 1
+            self._cache.move_to_end(infostr)
+            return parsed
+
+        self.misses += 1
+        parsed = parse_info(infostr)
+        if(len(self._cache) >= self.max_entries):
+            self._cache.popitem(last=False)
+            self.evicted += 1
+        self._cache[infostr] = parsed
+        return parsed
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,677 @@
+# The lobby's protocol logic, without any I/O.
+#
+# Front ends (lobby.py for Twisted, aiolobby.py for asyncio) own the sockets, timers and
+# the reachability checker. They feed received datagrams and connection data into the
+# registration and query objects here, and carry out the actions these return, in order:
+#
+#   Write(parts)                    send the concatenation of parts on the connection
+#   Close()                         close the connection once everything written has been sent
+#   SendDatagram(data, addr)        send a UDP datagram from the port the request came in on
+#   CheckReachability(servers, host)
+#                                   put servers into the list once their TCP ports (from their
+#                                   IPv4 endpoints) on host accept connections
+#
+# The GameServerList is updated directly, it does not do any I/O either.
+
+import time, itertools, uuid, struct, socket, os, hmac, hashlib, banlist, connlimit, legacyinfo, regparser
+from collections import namedtuple
+from serverlist import GameServer, INFO_INTERN, INDEXED_INFO_KEYS, encode_server_block
+from floodcontrol import FloodControl, TokenBuckets
+from metrics import METRICS, SIZE_BUCKETS
+from lobbylog import LOG
+
+Write = namedtuple("Write", "parts")
+Close = namedtuple("Close", "")
+SendDatagram = namedtuple("SendDatagram", "data addr")
+CheckReachability = namedtuple("CheckReachability", "servers host")
+CLOSE = Close()
+
+LEGACY_PORT = 29942
+NEWSTYLE_PORT = 29944
+REPLICATION_PORT = 29946
+WEB_PORT = 29950
+
+SERVER_DURATION = 70
+QUERY_TIMEOUT = 5   # Seconds a query connection may stay open
+
+GG2_BASE_UUID = uuid.UUID("dea41970-4cea-a588-df40-62faef6f1738")
+GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+def gg2_version_to_uuid(data):
+    simplever = data[0]
+    if(simplever==128):
+        return uuid.UUID(bytes=data[1:17])
+    else:
+        return uuid.UUID(int=GG2_BASE_UUID.int+simplever)
+
+
+class QueryMetrics(object):
+    def __init__(self, protocol):
+        self.queries = METRICS.counter("lobby_queries_total", "List queries answered", protocol=protocol)
+        self.seconds = METRICS.histogram("lobby_query_seconds", "Time spent building and sending list replies", protocol=protocol)
+        self.reply_bytes = METRICS.histogram("lobby_query_reply_bytes", "Size of list replies", SIZE_BUCKETS, protocol=protocol)
+
+    def observe(self, started, size):
+        self.queries.inc()
+        self.seconds.observe(time.perf_counter()-started)
+        self.reply_bytes.observe(size)
+
+class RegistrationMetrics(object):
+    def __init__(self, protocol, reasons):
+        self.received = METRICS.counter("lobby_registration_packets_total", "Registration datagrams received", protocol=protocol)
+        self.dropped = {reason: METRICS.counter("lobby_registration_dropped_total", "Registration datagrams dropped", protocol=protocol, reason=reason)
+                        for reason in reasons}
+
+# Replaced by the frontends with the rates given on the command line
+FLOOD_CONTROL = FloodControl()
+LEGACY_INFO_CACHE = legacyinfo.InfoCache()
+
+# Example IP, replaced by the contents of the --ban-file if one is given
+BANS = banlist.BanList(["1.2.3.4"])
+BANNED_CONNECTIONS = METRICS.counter("lobby_banned_connections_total", "Query connections refused because of a ban")
+# Open connections to the query ports of this process, see --max-query-connections
+QUERY_LIMITS = connlimit.ConnectionLimits()
+
+def accept_query(host):
+    """ Check whether a query connection from host may be accepted. Accepted connections
+        must be passed to release_query when they are closed. """
+    if(BANS.banned_host(host)):
+        BANNED_CONNECTIONS.inc()
+        return False
+    return QUERY_LIMITS.acquire(host)
+
+def release_query(host):
+    QUERY_LIMITS.release(host)
+
+class LegacyQuery(object):
+    """ A connection to the legacy query port, answered with the servers of one GG2 version. """
+    REPLY_KEY = "legacy"
+    METRICS = QueryMetrics("legacy")
+
+    def __init__(self, serverList):
+        self.serverList = serverList
+        self.buffered = b""
+
+    def formatServerData(self, server):
+        infoparts = []
+        if(server.passworded): infoparts.append(b"!private!")
+        if(b"map" in server.infos): infoparts += (b"[", server.infos[b"map"], b"] ")
+        infoparts.append(server.name)
+        if(server.bots == 0):
+            infoparts.append(b" [%u/%u]" % (server.players, server.slots))
+        else:
+            infoparts.append(b" [%u+%u/%u]" % (server.players, server.bots, server.slots))
+        infostr = b"".join(infoparts)[:255]
+        return b"".join((bytes([len(infostr)]), infostr, server.ipv4_endpoint[0], struct.pack("<H",server.ipv4_endpoint[1])))
+
+    def buildReply(self, servers):
+        servers = [self.formatServerData(server) for server in itertools.islice(servers, 255)]
+        return bytes([len(servers)]) + b"".join(servers)
+
+    def reply(self, protocol_id):
+        started = time.perf_counter()
+        reply = self.serverList.get_protocol_reply(GG2_LOBBY_ID, protocol_id.bytes, LegacyQuery.REPLY_KEY, self.buildReply)
+        LegacyQuery.METRICS.observe(started, len(reply))
+        LOG.info("legacy_query", version=protocol_id.hex, servers=reply[0])
+        return [Write([reply]), CLOSE]
+
+    def data_received(self, data):
+        self.buffered += data
+        if(len(self.buffered) > 17):
+            return [CLOSE]
+
+        if(self.buffered[0] != 128 or len(self.buffered)==17):
+            return self.reply(gg2_version_to_uuid(self.buffered))
+        return []
+
+class NewStyleQuery(object):
+    """ A connection to the new-style query port, answered by the list protocol named in the request. """
+    LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+    LIST_PROTOCOLS = {}
+    MAX_REQUEST_LENGTH = 4096
+    METRICS = QueryMetrics("newstyle")
+
+    def __init__(self, serverList):
+        self.serverList = serverList
+        self.buffered = b""
+        self.list_protocol = None
+
+    def formatServerData(self, server):
+        return encode_server_block(server)
+
+    def buildReply(self, servers):
+        return struct.pack(">L",len(servers))+b"".join([self.formatServerData(server) for server in servers])
+
+    def reply(self, lobby_id):
+        started = time.perf_counter()
+        reply = self.serverList.get_lobby_reply(lobby_id, NewStyleQuery.LIST_PROTOCOL_ID, self.buildReply)
+        NewStyleQuery.METRICS.observe(started, len(reply))
+        LOG.info("newstyle_query", lobby=lobby_id.hex, servers=struct.unpack_from(">L", reply)[0])
+        return [Write([reply])]
+
+    def data_received(self, data):
+        self.buffered += data
+        if(self.list_protocol is None):
+            if(len(self.buffered) < 16): return []
+            proto_id = uuid.UUID(bytes=self.buffered[:16])
+            try:
+                self.list_protocol = NewStyleQuery.LIST_PROTOCOLS[proto_id]
+            except KeyError:
+                LOG.warning("wrong_list_protocol", protocol=proto_id.hex)
+                return [CLOSE]
+
+        request_length = self.list_protocol.request_length(self.buffered)
+        if(request_length is None): return []
+        if(request_length > NewStyleQuery.MAX_REQUEST_LENGTH):
+            LOG.warning("request_too_long", length=request_length)
+            return [CLOSE]
+        actions = []
+        if(len(self.buffered) == request_length):
+            actions = self.list_protocol.handle(self, self.buffered)
+        if(len(self.buffered) >= request_length):
+            if(len(self.buffered) > request_length):
+                LOG.warning("too_many_bytes", received=len(self.buffered), expected=request_length)
+            actions.append(CLOSE)
+        return actions
+
+class LobbyListHandler(object):
+    def request_length(self, request):
+        return 32
+
+    def handle(self, query, request):
+        return query.reply(uuid.UUID(bytes=request[16:32]))
+
+class DeltaListHandler(object):
+    """ List protocol which only sends the servers changed since the client's last reply.
+
+        Encoded deltas are cached per lobby and client generation until the lobby changes
+        again, in a cache of their own, bounded by size, so that clients sending arbitrary
+        tokens cannot push the full snapshots out of the list's reply cache."""
+    LIST_PROTOCOL_ID = uuid.UUID("7c1e5a4d-8f3b-4c2a-9d6e-3b1f0a2c5e84")
+    TOKEN = struct.Struct(">LQ")    # epoch, generation
+    FULL_SNAPSHOT = 0
+    DELTA = 1
+    EMPTY_DELTA = struct.pack(">LL", 0, 0)
+    MAX_CACHED_BYTES = 4*1024*1024
+    METRICS = QueryMetrics("delta")
+
+    def __init__(self):
+        self._deltas = {}   # (epoch, lobby_id, generation) -> (lobby generation, delta body)
+        self._cached_bytes = 0
+
+    def request_length(self, request):
+        return 32+DeltaListHandler.TOKEN.size
+
+    def buildSnapshotBody(self, query, servers):
+        blocks = [server.server_id.bytes + query.formatServerData(server) for server in servers]
+        return struct.pack(">L", len(blocks)) + b"".join(blocks) + struct.pack(">L", 0)
+
+    def buildDeltaBody(self, query, lobby_id, generation):
+        """ Return the delta body for the changes since generation, or None if a snapshot has to be sent instead. """
+        serverList = query.serverList
+        changes = serverList.get_changes_since(lobby_id, generation)
+        if(changes is None):
+            return None
+        changed, removed = changes
+        # Once every server in the lobby changed, the snapshot is not larger than the delta
+        if(len(changed) >= serverList.count_servers_in_lobby(lobby_id)):
+            return None
+        blocks = [server.server_id.bytes + query.formatServerData(server) for server in changed]
+        return b"".join([struct.pack(">L", len(blocks))] + blocks + [struct.pack(">L", len(removed))] + [server_id.bytes for server_id in removed])
+
+    def getDeltaBody(self, query, lobby_id, epoch, generation):
+        serverList = query.serverList
+        lobby_generation = serverList.get_lobby_generation(lobby_id)
+        # Empty lobbies have generation 0, whether they have just lost their last server or never had any
+        if(lobby_generation == 0):
+            return self.buildDeltaBody(query, lobby_id, generation)
+        if(lobby_generation <= generation <= serverList.get_generation()):
+            return DeltaListHandler.EMPTY_DELTA
+
+        key = (epoch, lobby_id, generation)
+        cached = self._deltas.get(key)
+        if(cached is not None and cached[0] == lobby_generation):
+            return cached[1]
+        body = self.buildDeltaBody(query, lobby_id, generation)
+        if(body is not None):
+            if(self._cached_bytes+len(body) > DeltaListHandler.MAX_CACHED_BYTES):
+                self._deltas.clear()
+                self._cached_bytes = 0
+            if(cached is not None):
+                self._cached_bytes -= len(cached[1])
+            self._deltas[key] = (lobby_generation, body)
+            self._cached_bytes += len(body)
+        return body
+
+    def handle(self, query, request):
+        started = time.perf_counter()
+        serverList = query.serverList
+        lobby_id = uuid.UUID(bytes=request[16:32])
+        epoch, generation = DeltaListHandler.TOKEN.unpack_from(request, 32)
+        current_token = DeltaListHandler.TOKEN.pack(serverList.get_epoch(), serverList.get_generation())
+
+        body = None
+        if(epoch == serverList.get_epoch()):
+            body = self.getDeltaBody(query, lobby_id, epoch, generation)
+        if(body is None):
+            body = serverList.get_lobby_reply(lobby_id, DeltaListHandler.LIST_PROTOCOL_ID, lambda servers: self.buildSnapshotBody(query, servers))
+            DeltaListHandler.METRICS.observe(started, 1+len(current_token)+len(body))
+            LOG.info("delta_query", lobby=lobby_id.hex, snapshot=struct.unpack_from(">L", body)[0])
+            return [Write([bytes([DeltaListHandler.FULL_SNAPSHOT]), current_token, body])]
+        else:
+            DeltaListHandler.METRICS.observe(started, 1+len(current_token)+len(body))
+            LOG.info("delta_query", lobby=lobby_id.hex, changed=struct.unpack_from(">L", body)[0])
+            return [Write([bytes([DeltaListHandler.DELTA]), current_token, body])]
+
+class FilteredListHandler(object):
+    """ List protocol which only sends the servers matching the client's filters, optionally with only some keys. """
+    LIST_PROTOCOL_ID = uuid.UUID("3f6a2b8e-1d4c-4e9a-8b7f-5c2d9e0a1b63")
+    EXCLUDE_FULL = 1
+    EXCLUDE_PASSWORDED = 2
+    KEY_LIST = 4
+    METRICS = QueryMetrics("filtered")
+
+    def parse(self, request):
+        """ Return (flags, filters, keys, end offset), or None if the request is incomplete. """
+        if(len(request) < 34): return None
+        flags, filtercount = request[32], request[33]
+        offset = 34
+        filters = []
+        for i in range(filtercount):
+            if(len(request) < offset+1): return None
+            keyend = offset+1+request[offset]
+            if(len(request) < keyend+1): return None
+            valueend = keyend+1+request[keyend]
+            if(len(request) < valueend): return None
+            filters.append((request[offset+1:keyend], request[keyend+1:valueend]))
+            offset = valueend
+        keys = None
+        if(flags & FilteredListHandler.KEY_LIST):
+            if(len(request) < offset+1): return None
+            keycount = request[offset]
+            offset += 1
+            keys = []
+            for i in range(keycount):
+                if(len(request) < offset+1): return None
+                keyend = offset+1+request[offset]
+                if(len(request) < keyend): return None
+                keys.append(request[offset+1:keyend])
+                offset = keyend
+            keys = tuple(keys)
+        return flags, filters, keys, offset
+
+    def request_length(self, request):
+        parsed = self.parse(request)
+        return None if parsed is None else parsed[3]
+
+    def matches(self, server, flags, filters):
+        if((flags & FilteredListHandler.EXCLUDE_FULL) and server.players+server.bots >= server.slots): return False
+        if((flags & FilteredListHandler.EXCLUDE_PASSWORDED) and server.passworded): return False
+        for key, value in filters:
+            if((server.name if key == b"name" else server.infos.get(key)) != value): return False
+        return True
+
+    def buildReply(self, servers, flags, filters, keys):
+        blocks = [encode_server_block(server, keys) for server in servers if self.matches(server, flags, filters)]
+        return struct.pack(">L", len(blocks)) + b"".join(blocks)
+
+    def handle(self, query, request):
+        started = time.perf_counter()
+        serverList = query.serverList
+        lobby_id = uuid.UUID(bytes=request[16:32])
+        flags, filters, keys, end = self.parse(request)
+        flags &= FilteredListHandler.EXCLUDE_FULL | FilteredListHandler.EXCLUDE_PASSWORDED
+        filters = tuple(sorted(set(filters)))
+        builder = lambda servers: self.buildReply(servers, flags, filters, keys)
+        cache_key = (FilteredListHandler.LIST_PROTOCOL_ID, flags)
+
+        # Start from the smallest index matching one of the filters, the others are checked per server.
+        # Only replies with all keys and no filters beyond the index are cached, as the clients could
+        # otherwise push the common replies out of the cache with arbitrary filter values and key lists.
+        indexed = [(key, value) for (key, value) in filters if key in INDEXED_INFO_KEYS]
+        if(indexed):
+            key, value = min(indexed, key=lambda kv: serverList.count_servers_by_info(lobby_id, kv[0], kv[1]))
+            if(keys is None and len(filters) == 1):
+                reply = serverList.get_info_reply(lobby_id, key, value, cache_key, builder)
+            else:
+                reply = builder(serverList.get_servers_by_info(lobby_id, key, value))
+        elif(keys is None and not filters):
+            reply = serverList.get_lobby_reply(lobby_id, cache_key, builder)
+        else:
+            reply = builder(serverList.get_servers_in_lobby(lobby_id))
+        FilteredListHandler.METRICS.observe(started, len(reply))
+        LOG.info("filtered_query", lobby=lobby_id.hex, filters=len(filters), servers=struct.unpack_from(">L", reply)[0])
+        return [Write([reply])]
+
+NewStyleQuery.LIST_PROTOCOLS[NewStyleQuery.LIST_PROTOCOL_ID] = LobbyListHandler()
+NewStyleQuery.LIST_PROTOCOLS[DeltaListHandler.LIST_PROTOCOL_ID] = DeltaListHandler()
+NewStyleQuery.LIST_PROTOCOLS[FilteredListHandler.LIST_PROTOCOL_ID] = FilteredListHandler()
+
+class LegacyRegistration(object):
+    """ Registration datagrams on the legacy port. """
+    MAGIC_NUMBERS = bytes([4, 8, 15, 16, 23, 42])
+    INFO_PATTERN = legacyinfo.INFO_PATTERN
+    METRICS = RegistrationMetrics("legacy", ("flood", "malformed", "banned"))
+
+    def __init__(self, serverList):
+        self.serverList = serverList
+
+    def datagram_received(self, data, addr):
+        host, origport = addr
+        metrics = LegacyRegistration.METRICS
+        metrics.received.inc()
+        if(not FLOOD_CONTROL.allow(host, origport)):
+            metrics.dropped["flood"].inc()
+            return []
+
+        if(not data.startswith(LegacyRegistration.MAGIC_NUMBERS)):
+            metrics.dropped["malformed"].inc()
+            return []
+        data = data[6:]
+
+        if((len(data) < 1) or (data[0]==128 and len(data) < 17)):
+            metrics.dropped["malformed"].inc()
+            return []
+        protocol_id = gg2_version_to_uuid(data)
+        if(data[0]==128): data = data[17:]
+        else: data = data[1:]
+
+        if((len(data) < 3)):
+            metrics.dropped["malformed"].inc()
+            return []
+        port = struct.unpack("<H", data[:2])[0]
+        infolen = data[2]
+        infostr = data[3:]
+        if(len(infostr) != infolen):
+            metrics.dropped["malformed"].inc()
+            return []
+
+        ip = socket.inet_aton(host)
+        if(ip in BANS):
+            metrics.dropped["banned"].inc()
+            return []
+        server_id = uuid.UUID(int=GG2_BASE_UUID.int+(struct.unpack("!L",ip)[0]<<16)+port)
+        server = GameServer(server_id, GG2_LOBBY_ID)
+        server.infos[b"protocol_id"] = INFO_INTERN.intern(protocol_id.bytes)
+        server.ipv4_endpoint = (ip, port)
+        info = LEGACY_INFO_CACHE.parse(infostr)
+        server.passworded, server.name, server.players, server.slots = info.passworded, info.name, info.players, info.slots
+        server.infos.update(info.infos)
+        return [CheckReachability([server], host)]
+
+class NewStyleRegistration(object):
+    """ Datagrams on the new-style port, dispatched to the handler for their message type.
+
+        Only the message types in REG_PROTOCOLS count as registration datagrams in the metrics,
+        the handlers in QUERY_PROTOCOLS keep their own counts. """
+    REG_PROTOCOLS = {}
+    QUERY_PROTOCOLS = {}
+    METRICS = RegistrationMetrics("newstyle", ("flood", "malformed", "unknown_type", "bad_protocol", "bad_port", "banned", "no_name"))
+
+    def __init__(self, serverList):
+        self.serverList = serverList
+
+    def datagram_received(self, data, addr):
+        if(len(data) < 16):
+            NewStyleRegistration.METRICS.received.inc()
+            NewStyleRegistration.METRICS.dropped["malformed"].inc()
+            return []
+        message_type = uuid.UUID(bytes=data[0:16])
+        query_protocol = NewStyleRegistration.QUERY_PROTOCOLS.get(message_type)
+        if(query_protocol is not None):
+            return query_protocol.handle(data, addr, self.serverList)
+
+        NewStyleRegistration.METRICS.received.inc()
+        try:
+            reg_protocol = NewStyleRegistration.REG_PROTOCOLS[message_type]
+        except KeyError:
+            NewStyleRegistration.METRICS.dropped["unknown_type"].inc()
+            return []
+
+        return reg_protocol.handle(data, addr, self.serverList)
+
+class GG2RegHandler(object):
+    def handle(self, data, addr, serverList):
+        host, origport = addr
+        dropped = NewStyleRegistration.METRICS.dropped
+        if(not FLOOD_CONTROL.allow(host, origport)):
+            dropped["flood"].inc()
+            return []
+
+        registration = regparser.parse_registration(data)
+        if(registration is None):
+            dropped["malformed"].inc()
+            return []
+        if(registration.protocol not in (0,1)):
+            dropped["bad_protocol"].inc()
+            return []
+        port = registration.port
+        if(port == 0):
+            dropped["bad_port"].inc()
+            return []
+        ip = socket.inet_aton(host)
+        if(ip in BANS):
+            dropped["banned"].inc()
+            return []
+        server = registration_to_server(registration, ip)
+        if(server is None):
+            dropped["no_name"].inc()
+            return []
+
+        if(server.protocol == 0):
+            return [CheckReachability([server], host)]
+        serverList.put(server)
+        return []
+
+def registration_to_server(registration, ip):
+    """ Build the GameServer for a parsed registration from the packed IPv4 address ip, or return None if it has no name. """
+    server = GameServer(registration.server_id, registration.lobby_id)
+    server.protocol = registration.protocol
+    server.ipv4_endpoint = (ip, registration.port)
+    server.slots, server.players, server.bots = registration.slots, registration.players, registration.bots
+    server.passworded = registration.passworded
+    server.infos = INFO_INTERN.intern_infos(registration.infos)
+
+    try:
+        server.name = server.infos.pop(b"name")
+    except KeyError:
+        return None
+    return server
+
+class GG2BulkRegHandler(object):
+    """ Registers several servers on the same host from one datagram, see "Protocol Spec.txt".
+
+        The whole datagram is rate limited, checked for bans and parsed once, and the servers
+        are put into the list as a batch. Servers with port 0 or without a name are skipped."""
+    SKIPPED = {reason: METRICS.counter("lobby_bulk_registration_skipped_total", "Servers skipped in bulk registration datagrams", reason=reason)
+               for reason in ("bad_port", "no_name")}
+    SERVERS = METRICS.counter("lobby_bulk_registration_servers_total", "Servers received in bulk registration datagrams")
+
+    def handle(self, data, addr, serverList):
+        host, origport = addr
+        dropped = NewStyleRegistration.METRICS.dropped
+        if(not FLOOD_CONTROL.allow(host, origport)):
+            dropped["flood"].inc()
+            return []
+
+        registrations = regparser.parse_bulk_registration(data)
+        if(registrations is None):
+            dropped["malformed"].inc()
+            return []
+        if(registrations and registrations[0].protocol not in (0,1)):
+            dropped["bad_protocol"].inc()
+            return []
+        ip = socket.inet_aton(host)
+        if(ip in BANS):
+            dropped["banned"].inc()
+            return []
+        GG2BulkRegHandler.SERVERS.inc(len(registrations))
+
+        servers = []
+        for registration in registrations:
+            if(registration.port == 0):
+                GG2BulkRegHandler.SKIPPED["bad_port"].inc()
+                continue
+            server = registration_to_server(registration, ip)
+            if(server is None):
+                GG2BulkRegHandler.SKIPPED["no_name"].inc()
+                continue
+            servers.append(server)
+
+        if(not servers):
+            return []
+        if(servers[0].protocol == 0):
+            return [CheckReachability(servers, host)]
+        serverList.put_many(servers)
+        return []
+
+# TODO: Prevent datagram reordering from re-registering a server (e.g. block the server ID for a few seconds)
+class GG2UnregHandler(object):
+    def handle(self, data, addr, serverList):
+        if(len(data) != 32):
+            NewStyleRegistration.METRICS.dropped["malformed"].inc()
+            return []
+        serverList.remove(uuid.UUID(bytes=data[16:32]))
+        return []
+
+class UDPListHandler(object):
+    """ List query in a single datagram, answered with one page of a compact list per request.
+
+        To keep the lobby from being used for amplification attacks, a client first gets a
+        cookie bound to its address in a reply smaller than its request, and only requests
+        carrying a valid cookie are answered with list pages. Requests without a valid cookie,
+        whose source address may be forged, are also limited per address, so the cookie
+        replies cannot be used to flood a victim either."""
+    QUERY_PROTOCOL_ID = uuid.UUID("9a4c1f7e-2b6d-4d83-a5e1-7f0c3b8d2e46")
+    REQUEST = struct.Struct(">16s16s8sH")   # protocol, lobby, cookie, page
+    PAGE_HEADER = struct.Struct(">BQHHH")   # reply type, lobby generation, page, page count, server count
+    ENTRY_HEADER = struct.Struct(">BHHH")   # flags, slots, players, bots
+    COOKIE_REPLY = 0
+    PAGE_REPLY = 1
+    FLAG_PASSWORDED = 1
+    FLAG_UDP = 2
+    FLAG_IPV4 = 4
+    FLAG_IPV6 = 8
+    MAX_PAGE_BYTES = 1200
+    COOKIE_LIFETIME = 30
+    # Cookie replies per second and at once for one address
+    COOKIE_RATE, COOKIE_BURST = 1.0, 5
+    RECEIVED = METRICS.counter("lobby_query_datagrams_total", "List query datagrams received on the new-style port", kind="udp_list")
+    METRICS = QueryMetrics("udp")
+
+    def __init__(self, clock=None):
+        self._time = time.time if clock is None else clock.seconds
+        self._secret = os.urandom(16)
+        self._cookie_buckets = TokenBuckets(UDPListHandler.COOKIE_RATE, UDPListHandler.COOKIE_BURST, 100000)
+        self.cookies_sent = METRICS.counter("lobby_udp_query_cookies_total", "Cookie replies to UDP list queries")
+        self.banned = METRICS.counter("lobby_udp_query_dropped_total", "UDP list queries dropped", reason="banned")
+        self.flooded = METRICS.counter("lobby_udp_query_dropped_total", "UDP list queries dropped", reason="flood")
+
+    def _cookie(self, host, window):
+        return hmac.new(self._secret, host.encode("ascii") + struct.pack(">Q", window), hashlib.sha256).digest()[:8]
+
+    def formatServerData(self, server):
+        flags = ((UDPListHandler.FLAG_PASSWORDED if server.passworded else 0) | (UDPListHandler.FLAG_UDP if server.protocol == 1 else 0)
+                 | (UDPListHandler.FLAG_IPV4 if server.ipv4_endpoint is not None else 0) | (UDPListHandler.FLAG_IPV6 if server.ipv6_endpoint is not None else 0))
+        parts = [UDPListHandler.ENTRY_HEADER.pack(flags, server.slots, server.players, server.bots)]
+        if(server.ipv4_endpoint is not None): parts.append(server.ipv4_endpoint[0] + struct.pack(">H", server.ipv4_endpoint[1]))
+        if(server.ipv6_endpoint is not None): parts.append(server.ipv6_endpoint[0] + struct.pack(">H", server.ipv6_endpoint[1]))
+        infos = [(b"name", server.name)] + list(itertools.islice(server.infos.items(), 254))
+        parts.append(bytes([len(infos)]))
+        for k, v in infos:
+            k, v = k[:255], v[:255]
+            parts += (bytes([len(k)]), k, bytes([len(v)]), v)
+        return b"".join(parts)
+
+    def buildPages(self, servers):
+        """ Split the servers into pages of at most MAX_PAGE_BYTES entry bytes, returned as lists of entries. """
+        pages = [[]]
+        size = 0
+        for entry in [self.formatServerData(server) for server in sorted(servers, key=lambda server: server.server_id.bytes)]:
+            if(pages[-1] and size+len(entry) > UDPListHandler.MAX_PAGE_BYTES):
+                pages.append([])
+                size = 0
+            pages[-1].append(entry)
+            size += len(entry)
+        return pages
+
+    def handle(self, data, addr, serverList):
+        host, port = addr
+        UDPListHandler.RECEIVED.inc()
+        if(len(data) != UDPListHandler.REQUEST.size): return []
+        if(BANS.banned_host(host)):
+            self.banned.inc()
+            return []
+        started = time.perf_counter()
+        protocol_id, lobby_id, cookie, page = UDPListHandler.REQUEST.unpack(data)
+        now = self._time()
+        window = int(now // UDPListHandler.COOKIE_LIFETIME)
+        if(not (hmac.compare_digest(cookie, self._cookie(host, window)) or hmac.compare_digest(cookie, self._cookie(host, window-1)))):
+            if(not self._cookie_buckets.consume(host, now)):
+                self.flooded.inc()
+                return []
+            self.cookies_sent.inc()
+            # 9 bytes, never more than the request
+            return [SendDatagram(bytes([UDPListHandler.COOKIE_REPLY]) + self._cookie(host, window), addr)]
+
+        lobby_id = uuid.UUID(bytes=lobby_id)
+        pages = serverList.get_lobby_reply(lobby_id, UDPListHandler.QUERY_PROTOCOL_ID, self.buildPages)
+        entries = pages[page] if page < len(pages) else []
+        reply = UDPListHandler.PAGE_HEADER.pack(UDPListHandler.PAGE_REPLY, serverList.get_lobby_generation(lobby_id),
+                                                page, len(pages), len(entries)) + b"".join(entries)
+        UDPListHandler.METRICS.observe(started, len(reply))
+        LOG.info("udp_query", lobby=lobby_id.hex, page=page, pages=len(pages), servers=len(entries))
+        return [SendDatagram(reply, addr)]
+
+NewStyleRegistration.REG_PROTOCOLS[uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")] = GG2RegHandler()
+NewStyleRegistration.REG_PROTOCOLS[uuid.UUID("488984ac-45dc-86e1-9901-98dd1c01c064")] = GG2UnregHandler()
+NewStyleRegistration.REG_PROTOCOLS[uuid.UUID("6d3f8a21-5c47-4b9e-8e12-a04f7c9b3d58")] = GG2BulkRegHandler()
+NewStyleRegistration.QUERY_PROTOCOLS[UDPListHandler.QUERY_PROTOCOL_ID] = UDPListHandler()
+
+class ServerListMetrics(object):
+    """ GameServerList listener counting how servers leave the list. """
+    def __init__(self):
+        self.expired = METRICS.counter("lobby_servers_removed_total", "Servers removed from the list", reason="expired")
+        self.unregistered = METRICS.counter("lobby_servers_removed_total", "Servers removed from the list", reason="unregistered")
+
+    def server_put(self, server):
+        pass
+
+    def server_refreshed(self, server):
+        pass
+
+    def server_removed(self, server, expired):
+        (self.expired if expired else self.unregistered).inc()
+
+def register_metrics(serverList, reachability):
+    """ Count removals from serverList and expose the statistics kept by the lobby's components. """
+    serverList.add_listener(ServerListMetrics())
+    METRICS.gauge_function("lobby_servers", "Servers currently listed", lambda: len(serverList))
+    METRICS.counter_function("lobby_registrations_applied_total", "Registrations put into the list",
+                             lambda: serverList.changed_puts, result="changed")
+    METRICS.counter_function("lobby_registrations_applied_total", "Registrations put into the list",
+                             lambda: serverList.refreshed_puts, result="refreshed")
+    METRICS.counter_function("lobby_flood_control_evicted_total", "Token buckets evicted from the flood control tables",
+                             lambda: FLOOD_CONTROL.evicted)
+    for bucket in ("endpoint", "ip", "prefix"):
+        METRICS.counter_function("lobby_flood_control_dropped_total", "Registration datagrams dropped by flood control, by the bucket which ran empty",
+                                 lambda bucket=bucket: getattr(FLOOD_CONTROL, "dropped_"+bucket), bucket=bucket)
+    for result in ("positive_hits", "negative_hits", "merged", "queue_dropped", "started"):
+        METRICS.counter_function("lobby_reachability_requests_total", "Reachability check requests by how they were handled",
+                                 lambda result=result: getattr(reachability, result), result=result)
+    METRICS.counter_function("lobby_reachability_checks_total", "Finished reachability checks",
+                             lambda: reachability.succeeded, outcome="success")
+    METRICS.counter_function("lobby_reachability_checks_total", "Finished reachability checks",
+                             lambda: reachability.failed, outcome="failure")
+    METRICS.gauge_function("lobby_reachability_active", "Reachability checks in progress", lambda: reachability.active)
+    METRICS.gauge_function("lobby_reachability_queued", "Reachability checks waiting to start", lambda: reachability.queue_depth)
+    METRICS.gauge_function("lobby_query_connections", "Open query connections", lambda: QUERY_LIMITS.open)
+    METRICS.counter_function("lobby_query_connections_rejected_total", "Query connections refused because of a connection limit",
+                             lambda: QUERY_LIMITS.rejected_ip, limit="per_ip")
+    METRICS.counter_function("lobby_query_connections_rejected_total", "Query connections refused because of a connection limit",
+                             lambda: QUERY_LIMITS.rejected_total, limit="total")
+    for result in ("hits", "misses", "evicted"):
+        METRICS.counter_function("lobby_legacy_info_cache_total", "Legacy info string lookups by cache result, and evictions",
+                                 lambda result=result: getattr(LEGACY_INFO_CACHE, result), result=result)
+    for result in ("logged", "suppressed", "dropped"):
+        METRICS.counter_function("lobby_log_events_total", "Log events by whether they were written or rate-limited",
+                                 lambda result=result: getattr(LOG, result), result=result)
@@ -0,0 +1,139 @@
+# Structured logging which stays off the reactor thread.
+#
+# A log call only checks the level and the rate limit of its event and appends the raw
+# event to a queue. A background thread formats the queued events and writes them in
+# batches, so a slow terminal or a full pipe never blocks request handling.
+#
+# Every event is rate-limited by its name: at most rate_limit events of one name are
+# logged per rate_interval seconds, the rest are counted and reported in a summary line
+# when the next event of that name arrives after the interval. If the writer falls
+# behind by more than max_queued events, new events are dropped and counted as well.
+#
+# Output lines look like:
+# 2024-01-01 12:00:00.000 INFO newstyle_query lobby=1ccf16b1... servers=12
+
+import sys, threading, atexit
+from collections import deque
+from time import time, monotonic, strftime, localtime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR, "off": OFF}
+
+def format_field(value):
+    if(isinstance(value, bytes)):
+        value = value.decode("utf-8", "replace")
+    else:
+        value = str(value)
+    if(value == "" or any(c in value for c in ' "=\n')):
+        return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return value
+
+def format_event(timestamp, level, event, fields):
+    parts = ["%s.%03u" % (strftime("%Y-%m-%d %H:%M:%S", localtime(timestamp)), int(timestamp*1000)%1000),
+             LEVEL_NAMES.get(level, str(level)), event]
+    parts += ["%s=%s" % (key, format_field(value)) for (key, value) in fields.items()]
+    return " ".join(parts)
+
+class Logger:
+    def __init__(self, stream=None, level=INFO, rate_limit=20, rate_interval=1.0, max_queued=10000, flush_interval=0.2):
+        """ stream defaults to whatever sys.stdout is when the writer thread writes. """
+        self.stream = stream
+        self.level = level
+        self.rate_limit = rate_limit
+        self.rate_interval = rate_interval
+        self.max_queued = max_queued
+        self.flush_interval = flush_interval
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._windows = {}  # event -> [window start, logged in window, suppressed in window]
+
+        self.logged = 0
+        self.suppressed = 0
+        self.dropped = 0
+
+    def set_level(self, level):
+        self.level = level
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, event, **fields):
+        if(level < self.level):
+            return
+        now = monotonic()
+        window = self._windows.get(event)
+        if(window is None or now-window[0] >= self.rate_interval):
+            if(window is not None and window[2] > 0):
+                self._enqueue(WARNING, event+"_suppressed", {"count": window[2], "seconds": round(now-window[0], 1)})
+            window = self._windows[event] = [now, 0, 0]
+        if(window[1] >= self.rate_limit):
+            window[2] += 1
+            self.suppressed += 1
+            return
+        window[1] += 1
+        self._enqueue(level, event, fields)
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, **fields)
+
+    def _enqueue(self, level, event, fields):
+        if(len(self._queue) >= self.max_queued):
+            self.dropped += 1
+            return
+        self._queue.append((time(), level, event, fields))
+        self.logged += 1
+        if(self._thread is None):
+            self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="lobbylog", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while(True):
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._write_queued()
+            if(self._closed):
+                return
+
+    def _write_queued(self):
+        lines = []
+        queue = self._queue
+        while(queue):
+            lines.append(format_event(*queue.popleft()))
+        if(not lines):
+            return
+        stream = self.stream if self.stream is not None else sys.stdout
+        try:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def close(self):
+        """ Stop the writer thread after it has written all queued events. """
+        if(self._thread is not None and not self._closed):
+            self._closed = True
+            self._wakeup.set()
+            self._thread.join()
+
+LOG = Logger()
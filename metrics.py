@@ -0,0 +1,110 @@
+# In-process metrics with a text exposition in the Prometheus format.
+#
+# Counters and histograms are created once, usually at import time, and then updated
+# with a plain attribute increment or a bisect, so they are cheap enough for the hot
+# paths. Values which are already tracked elsewhere (e.g. queue depths) can be exposed
+# with gauge functions that are only called when the metrics are scraped.
+
+from bisect import bisect_left
+
+# Buckets for durations in seconds and for reply sizes in bytes
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+def format_labels(labels):
+    if(not labels):
+        return ""
+    return "{" + ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for (k, v) in sorted(labels.items())]) + "}"
+
+def format_value(value):
+    if(value == float("inf")):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets)+1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield name+"_bucket", dict(labels, le=format_value(bound)), cumulative
+        yield name+"_sum", labels, self.sum
+        yield name+"_count", labels, self.count
+
+class GaugeFunction:
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def samples(self, name, labels):
+        yield name, labels, self.func()
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = {}     # name -> (type, help, {label items: metric})
+
+    def _get(self, kind, name, help, labels, factory):
+        family = self._families.setdefault(name, (kind, help, {}))
+        if(family[0] != kind):
+            raise ValueError("Metric %s is already registered as %s" % (name, family[0]))
+        key = tuple(sorted(labels.items()))
+        try:
+            return family[2][key]
+        except KeyError:
+            metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name, help, **labels):
+        return self._get("counter", name, help, labels, Counter)
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS, **labels):
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def gauge_function(self, name, help, func, **labels):
+        """ Expose the return value of func as a gauge. Replaces a previous function with the same labels. """
+        family = self._families.setdefault(name, ("gauge", help, {}))
+        family[2][tuple(sorted(labels.items()))] = GaugeFunction(func)
+
+    def counter_function(self, name, help, func, **labels):
+        """ Expose the return value of func, which must only ever increase, as a counter. """
+        family = self._families.setdefault(name, ("counter", help, {}))
+        family[2][tuple(sorted(labels.items()))] = GaugeFunction(func)
+
+    def expose(self):
+        """ Return all metrics in the text exposition format. """
+        lines = []
+        for name in sorted(self._families):
+            kind, help, metrics = self._families[name]
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for key, metric in metrics.items():
+                for samplename, labels, value in metric.samples(name, dict(key)):
+                    lines.append("%s%s %s" % (samplename, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
@@ -0,0 +1,137 @@
+# Checks whether TCP game servers can be reached before they are listed.
+#
+# Results are cached per endpoint: a successful check is trusted for positive_ttl
+# seconds, a failed one suppresses further checks for negative_ttl seconds.
+# Registrations arriving while a check for the same endpoint is in flight are merged
+# into it, and at most max_concurrent connection attempts run at the same time, with
+# the rest waiting in a bounded queue.
+#
+# The connection attempts are made by the front end: connect(host, port, timeout, done)
+# must try to open a TCP connection and call done(success) exactly once.
+
+from collections import deque
+from expirationset import expirationset
+from metrics import METRICS
+from lobbylog import LOG
+
+# Defaults for the cache lifetimes in seconds and the number of simultaneous connection attempts
+POSITIVE_TTL = 300
+NEGATIVE_TTL = 20
+MAX_CONCURRENT = 100
+
+CHECK_SECONDS = {success: METRICS.histogram("lobby_reachability_check_seconds", "Duration of TCP reachability checks",
+                                            outcome="success" if success else "failure")
+                 for success in (True, False)}
+
+class ReachabilityChecker:
+    def __init__(self, clock, connect, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL, max_concurrent=MAX_CONCURRENT,
+                 max_queued=10000, timeout=5):
+        self._clock = clock
+        self._connect = connect
+        self._positive = expirationset(positive_ttl, clock=clock)
+        self._negative = expirationset(negative_ttl, clock=clock)
+        self._pending = {}  # endpoint -> (server, serverList) of the latest registration waiting for the check
+        self._started_at = {}   # endpoint -> start time of its connection attempt
+        self._queue = deque()
+        self._active = 0
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.timeout = timeout
+
+        self.requests = 0
+        self.positive_hits = 0
+        self.negative_hits = 0
+        self.merged = 0
+        self.queue_dropped = 0
+        self.started = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def hit_rate(self):
+        """ Fraction of requests answered without a new connection attempt. """
+        if(self.requests == 0):
+            return 0.0
+        return (self.positive_hits+self.negative_hits+self.merged)/self.requests
+
+    def check(self, server, host, port, serverList):
+        """ Put server into serverList once (host, port) is known to accept TCP connections. """
+        if(self._check((host, port), server, serverList)):
+            serverList.put(server)
+
+    def check_many(self, servers, host, serverList):
+        """ Like check for each of servers, which all run on host, with their ports taken from their IPv4 endpoints.
+
+            The servers whose endpoints are already known to be reachable are put as one batch."""
+        reachable = [server for server in servers if self._check((host, server.ipv4_endpoint[1]), server, serverList)]
+        if(reachable):
+            serverList.put_many(reachable)
+
+    def _check(self, endpoint, server, serverList):
+        """ Start or join a check of endpoint, returning True if it is already known to be reachable. """
+        self.requests += 1
+        if(endpoint in self._positive):
+            self.positive_hits += 1
+            return True
+        if(endpoint in self._negative):
+            self.negative_hits += 1
+            return False
+        if(endpoint in self._pending):
+            self.merged += 1
+            self._pending[endpoint] = (server, serverList)
+            return False
+
+        if(self._active < self.max_concurrent):
+            self._start(endpoint)
+        elif(len(self._queue) < self.max_queued):
+            self._queue.append(endpoint)
+        else:
+            self.queue_dropped += 1
+            return False
+        self._pending[endpoint] = (server, serverList)
+        return False
+
+    def _start(self, endpoint):
+        self._active += 1
+        self.started += 1
+        host, port = endpoint
+        self._started_at[endpoint] = self._clock.seconds()
+        self._connect(host, port, self.timeout, lambda success: self._check_finished(endpoint, success))
+
+    def _check_finished(self, endpoint, success):
+        self._active -= 1
+        server, serverList = self._pending.pop(endpoint)
+        CHECK_SECONDS[success].observe(self._clock.seconds()-self._started_at.pop(endpoint))
+        if(success):
+            self.succeeded += 1
+            self._positive.add(endpoint)
+            LOG.info("reachability_check", result="success", server=server)
+            serverList.put(server)
+        else:
+            self.failed += 1
+            self._negative.add(endpoint)
+            LOG.info("reachability_check", result="failure", server=server)
+
+        while(self._queue and self._active < self.max_concurrent):
+            self._start(self._queue.popleft())
+
+def add_arguments(parser):
+    """ Add options for the cache lifetimes and concurrency of ReachabilityChecker to an argparse parser. """
+    parser.add_argument("--reachability-positive-ttl", type=float, default=POSITIVE_TTL, metavar="SECONDS",
+                        help="how long a successful reachability check is trusted for an endpoint (default: %s)" % POSITIVE_TTL)
+    parser.add_argument("--reachability-negative-ttl", type=float, default=NEGATIVE_TTL, metavar="SECONDS",
+                        help="how long a failed reachability check suppresses new checks of an endpoint (default: %s)" % NEGATIVE_TTL)
+    parser.add_argument("--reachability-max-concurrent", type=int, default=MAX_CONCURRENT, metavar="N",
+                        help="reachability checks running at the same time, the others wait in a queue (default: %s)" % MAX_CONCURRENT)
+
+def from_arguments(args, clock, connect):
+    """ Create the ReachabilityChecker configured by the options of add_arguments. """
+    return ReachabilityChecker(clock, connect, args.reachability_positive_ttl, args.reachability_negative_ttl, args.reachability_max_concurrent)
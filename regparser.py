@@ -0,0 +1,77 @@
+# Parser for new-style registration datagrams (see "Protocol Spec.txt").
+#
+# The datagram is walked with offsets and struct.unpack_from, so only the keys and
+# values themselves are copied out of it, no matter how large the key/value table is.
+
+import struct, uuid
+from collections import namedtuple
+
+Registration = namedtuple("Registration", "server_id lobby_id protocol port slots players bots passworded infos")
+
+HEADER = struct.Struct(">16s16sBHHHHHH")
+HEADER_OFFSET = 16  # Skip the message type UUID
+KVTABLE_OFFSET = HEADER_OFFSET + HEADER.size
+VALUE_LENGTH = struct.Struct(">H")
+
+def parse_kvtable(data, offset, entries, datalen=None):
+    """ Parse a key/value table with the given number of entries starting at offset.
+
+        The table must end before datalen, which defaults to the end of data.
+        Returns a (dict, end offset) tuple, or None if the table is truncated."""
+    infos = {}
+    if(datalen is None): datalen = len(data)
+    unpack_valuelen = VALUE_LENGTH.unpack_from
+    for i in range(entries):
+        if(offset >= datalen): return None
+        keyend = offset+1+data[offset]
+        valueoffset = keyend+2
+        if(valueoffset > datalen): return None
+        valueend = valueoffset+unpack_valuelen(data, keyend)[0]
+        if(valueend > datalen): return None
+        infos[data[offset+1:keyend]] = data[valueoffset:valueend]
+        offset = valueend
+    return infos, offset
+
+def parse_registration(data):
+    """ Parse a registration datagram into a Registration, or return None if it is malformed.
+
+        Only the structure is checked here, the values are not validated."""
+    if(len(data) < KVTABLE_OFFSET): return None
+    server_id, lobby_id, protocol, port, slots, players, bots, flags, kventries = HEADER.unpack_from(data, HEADER_OFFSET)
+    kvtable = parse_kvtable(data, KVTABLE_OFFSET, kventries)
+    if(kvtable is None): return None
+    return Registration(uuid.UUID(bytes=server_id), uuid.UUID(bytes=lobby_id), protocol, port,
+                        slots, players, bots, (flags & 1) != 0, kvtable[0])
+
+BULK_HEADER = struct.Struct(">16sBH")           # lobby, transport protocol, shared key/value entries
+BULK_SERVER = struct.Struct(">16sHHHHHH")       # server ID, port, slots, players, bots, flags, key/value entries
+SERVER_COUNT = struct.Struct(">H")
+
+def parse_bulk_registration(data):
+    """ Parse a bulk registration datagram into a list of Registrations, or return None if it is malformed.
+
+        The shared key/value table is merged into each server's infos, with the server's
+        own entries taking precedence. Like parse_registration, values are not validated."""
+    if(len(data) < HEADER_OFFSET+BULK_HEADER.size): return None
+    lobby_id, protocol, sharedentries = BULK_HEADER.unpack_from(data, HEADER_OFFSET)
+    kvtable = parse_kvtable(data, HEADER_OFFSET+BULK_HEADER.size, sharedentries)
+    if(kvtable is None): return None
+    shared, offset = kvtable
+    if(offset+SERVER_COUNT.size > len(data)): return None
+    servercount = SERVER_COUNT.unpack_from(data, offset)[0]
+    offset += SERVER_COUNT.size
+
+    lobby_id = uuid.UUID(bytes=lobby_id)
+    registrations = []
+    unpack_server = BULK_SERVER.unpack_from
+    for i in range(servercount):
+        if(offset+BULK_SERVER.size > len(data)): return None
+        server_id, port, slots, players, bots, flags, kventries = unpack_server(data, offset)
+        kvtable = parse_kvtable(data, offset+BULK_SERVER.size, kventries)
+        if(kvtable is None): return None
+        infos, offset = kvtable
+        if(shared):
+            infos = {**shared, **infos}
+        registrations.append(Registration(uuid.UUID(bytes=server_id), lobby_id, protocol, port,
+                                          slots, players, bots, (flags & 1) != 0, infos))
+    return registrations
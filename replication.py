@@ -0,0 +1,188 @@
+# Replication of the server list between several lobby nodes.
+#
+# Every node forwards the registrations it accepted itself, and explicit unregistrations,
+# to all configured peers. Updates are collected for a short time and sent in batched
+# UDP datagrams. Replicated registrations are put into the local list directly, without
+# another reachability check, and are not forwarded again, so every node needs every
+# other node configured as peer. Expiration is not replicated, each node expires
+# servers on its own.
+#
+# Datagrams are authenticated with an HMAC keyed with a secret shared by all nodes
+# (--peer-secret), since the source address of a UDP datagram is easily forged. The
+# servers of replicated registrations are checked against the ban list of the receiving
+# node, like local registrations.
+#
+# Each update carries a version, the time the update was accepted by its origin node in
+# milliseconds. A node only applies an update if it is newer than the last version it
+# has seen for that server, and drops registrations which would already have expired.
+# Reordered or duplicated datagrams can therefore not resurrect unregistered or expired
+# servers. This relies on the clocks of the nodes being roughly synchronized.
+#
+# Datagram layout:
+# +  0    Message type (UUID = 5b0f6d2e-9c1a-4e37-b8f4-2a6c0d9e7f13)
+# + 16    Sending node ID (UUID)
+# + 32    HMAC-SHA256 of the datagram without this field
+# + 64    Number of updates (uint16)
+# + 66    Updates, each:
+#         + 0     Update type (uint8, 0 = put, 1 = remove)
+#         + 1     Version (uint64)
+#         + 9     put: Server ID, lobby ID and server data block (see serverlist.pack_server)
+#                 remove: Server ID
+
+import socket, struct, uuid, hmac, hashlib
+from twisted.internet.protocol import DatagramProtocol
+from serverlist import pack_server, unpack_server
+
+REPLICATION_PROTOCOL_ID = uuid.UUID("5b0f6d2e-9c1a-4e37-b8f4-2a6c0d9e7f13")
+DATAGRAM_HEADER = struct.Struct(">16s16s32sH")
+MAC_OFFSET = 32
+MAC_END = 64
+UPDATE_HEADER = struct.Struct(">BQ")
+UPDATE_PUT = 0
+UPDATE_REMOVE = 1
+MAX_BATCH_BYTES = 8192
+MAX_DATAGRAM_BYTES = 65000
+
+def parse_peer(peer):
+    """ Parse a "host:port" peer address into a (ip, port) tuple. """
+    host, sep, port = peer.rpartition(":")
+    return (socket.gethostbyname(host), int(port))
+
+def datagram_mac(secret, data):
+    """ The HMAC of a replication datagram, over everything except the HMAC field. """
+    mac = hmac.new(secret, data[:MAC_OFFSET], hashlib.sha256)
+    mac.update(data[MAC_END:])
+    return mac.digest()
+
+class ReplicationNode(DatagramProtocol):
+    def __init__(self, serverList, peers, secret, bans, duration, clock, flush_delay=0.2):
+        self.serverList = serverList
+        self.peers = list(peers)
+        self._peer_hosts = {host for (host, port) in self.peers}
+        self._secret = secret
+        self.bans = bans
+        self.node_id = uuid.uuid4()
+        self.duration_ms = int(duration*1000)
+        self.flush_delay = flush_delay
+        self._clock = clock
+        self._versions = {}     # server_id -> latest applied version
+        self._batch = []
+        self._batch_bytes = 0
+        self._flush_call = None
+        self._applying = False
+
+        self.sent_updates = 0
+        self.sent_datagrams = 0
+        self.applied_updates = 0
+        self.stale_updates = 0
+        self.rejected_datagrams = 0
+        self.banned_updates = 0
+
+        serverList.add_listener(self)
+        self._prune_call = clock.callLater(duration, self._prune_versions)
+
+    def _now_ms(self):
+        return int(self._clock.seconds()*1000)
+
+    # GameServerList listener interface: forward local changes
+
+    def server_put(self, server):
+        if(not self._applying):
+            self._queue_local(UPDATE_PUT, server.server_id, pack_server(server))
+
+    def server_refreshed(self, server):
+        # Peers have to renew their entry too, and may not know the server at all yet
+        self.server_put(server)
+
+    def server_removed(self, server, expired):
+        if(not self._applying and not expired):
+            self._queue_local(UPDATE_REMOVE, server.server_id, server.server_id.bytes)
+
+    def _queue_local(self, update_type, server_id, payload):
+        version = self._now_ms()
+        self._versions[server_id] = max(version, self._versions.get(server_id, 0))
+        update = UPDATE_HEADER.pack(update_type, version) + payload
+        if(len(update) > MAX_DATAGRAM_BYTES-DATAGRAM_HEADER.size):
+            return
+        if(self._batch_bytes+len(update) > MAX_BATCH_BYTES):
+            self.flush()
+        self._batch.append(update)
+        self._batch_bytes += len(update)
+        if(self._flush_call is None):
+            self._flush_call = self._clock.callLater(self.flush_delay, self.flush)
+
+    def flush(self):
+        if(self._flush_call is not None and self._flush_call.active()):
+            self._flush_call.cancel()
+        self._flush_call = None
+        if(not self._batch):
+            return
+        datagram = DATAGRAM_HEADER.pack(REPLICATION_PROTOCOL_ID.bytes, self.node_id.bytes, b"", len(self._batch)) + b"".join(self._batch)
+        datagram = datagram[:MAC_OFFSET] + datagram_mac(self._secret, datagram) + datagram[MAC_END:]
+        self.sent_updates += len(self._batch)
+        self._batch = []
+        self._batch_bytes = 0
+        if(self.transport is None):
+            return
+        for peer in self.peers:
+            self.transport.write(datagram, peer)
+            self.sent_datagrams += 1
+
+    # Incoming updates from peers
+
+    def datagramReceived(self, data, addr):
+        host, port = addr
+        if(host not in self._peer_hosts or len(data) < DATAGRAM_HEADER.size):
+            self.rejected_datagrams += 1
+            return
+        protocol_id, node_id, mac, count = DATAGRAM_HEADER.unpack_from(data, 0)
+        if(protocol_id != REPLICATION_PROTOCOL_ID.bytes or node_id == self.node_id.bytes
+           or not hmac.compare_digest(mac, datagram_mac(self._secret, data))):
+            self.rejected_datagrams += 1
+            return
+
+        offset = DATAGRAM_HEADER.size
+        now = self._now_ms()
+        self._applying = True
+        try:
+            for i in range(count):
+                if(len(data) < offset+UPDATE_HEADER.size):
+                    return
+                update_type, version = UPDATE_HEADER.unpack_from(data, offset)
+                offset += UPDATE_HEADER.size
+                if(update_type == UPDATE_PUT):
+                    unpacked = unpack_server(data, offset)
+                    if(unpacked is None):
+                        return
+                    server, offset = unpacked
+                    if(self._banned(server)):
+                        self.banned_updates += 1
+                        continue
+                    self._apply(server.server_id, version, now, lambda: self.serverList.put(server), True)
+                elif(update_type == UPDATE_REMOVE):
+                    if(len(data) < offset+16):
+                        return
+                    server_id = uuid.UUID(bytes=data[offset:offset+16])
+                    offset += 16
+                    self._apply(server_id, version, now, lambda: self.serverList.remove(server_id), False)
+                else:
+                    return
+        finally:
+            self._applying = False
+
+    def _banned(self, server):
+        return any(endpoint is not None and endpoint[0] in self.bans for endpoint in (server.ipv4_endpoint, server.ipv6_endpoint))
+
+    def _apply(self, server_id, version, now, action, is_put):
+        if(version <= self._versions.get(server_id, 0) or (is_put and now-version >= self.duration_ms)):
+            self.stale_updates += 1
+            return
+        self._versions[server_id] = version
+        self.applied_updates += 1
+        action()
+
+    def _prune_versions(self):
+        # Versions older than the list duration are rejected anyway, no need to remember them
+        cutoff = self._now_ms()-self.duration_ms
+        self._versions = {server_id: version for (server_id, version) in self._versions.items() if version > cutoff}
+        self._prune_call = self._clock.callLater(self.duration_ms/1000, self._prune_versions)
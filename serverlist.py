@@ -0,0 +1,415 @@
+# The list of registered game servers, and their wire encoding.
+
+import collections, random, socket, struct, uuid
+from expirationset import expirationset
+from lobbylog import LOG
+import regparser
+
+class InternTable:
+    """ Shares equal bytes objects between servers to save memory.
+
+        The table is bounded and simply starts over when it is full."""
+    SHARED_INFO_KEYS = frozenset([b"protocol_id", b"game", b"game_short", b"game_ver", b"game_url", b"map"])
+
+    def __init__(self, max_entries=10000):
+        self._table = {}
+        self.max_entries = max_entries
+
+    def intern(self, value):
+        try:
+            return self._table[value]
+        except KeyError:
+            if(len(self._table) >= self.max_entries):
+                self._table.clear()
+            self._table[value] = value
+            return value
+
+    def intern_infos(self, infos):
+        """ Return a copy of infos with interned keys and interned values for the well-known keys. """
+        intern = self.intern
+        shared = InternTable.SHARED_INFO_KEYS
+        return {intern(k): (intern(v) if k in shared else v) for (k, v) in infos.items()}
+
+INFO_INTERN = InternTable()
+
+class GameServer:
+    __slots__ = ("server_id", "lobby_id", "protocol", "ipv4_endpoint", "ipv6_endpoint",
+                 "name", "slots", "players", "bots", "passworded", "infos")
+
+    def __init__(self, server_id, lobby_id):
+        self.server_id = server_id
+        self.lobby_id = lobby_id
+        self.protocol = 0           # 0 = TCP, 1 = UDP
+        self.ipv4_endpoint = None   # Tuple: (ipv4, port), as binary string and int
+        self.ipv6_endpoint = None   # Tuple: (ipv6, port), as binary string and int
+
+        self.name = b""
+        self.slots = 0
+        self.players = 0
+        self.bots = 0
+        self.passworded = False
+        
+        self.infos = {}
+
+    def __repr__(self):
+        retstr = "<GameServer, name="+self.name.decode('utf-8', 'replace')+", lobby_id="+str(self.lobby_id)
+        if(self.ipv4_endpoint is not None):
+            anonip = self.ipv4_endpoint[0][:-1]+b"\0"
+            retstr += ", ipv4_endpoint=" + socket.inet_ntoa(anonip)+":"+str(self.ipv4_endpoint[1])
+        if(self.ipv6_endpoint is not None):
+            anonip = (self.ipv6_endpoint[0][:-10]+b"\0"*10, self.ipv6_endpoint[1])
+            retstr += ", ipv6_endpoint=" + str(anonip)
+        return retstr+">"
+
+    def same_data(self, other):
+        """ Check whether other describes this server exactly as it is listed. """
+        return (self.server_id == other.server_id and self.lobby_id == other.lobby_id
+                and self.protocol == other.protocol and self.ipv4_endpoint == other.ipv4_endpoint
+                and self.ipv6_endpoint == other.ipv6_endpoint and self.name == other.name
+                and self.slots == other.slots and self.players == other.players and self.bots == other.bots
+                and self.passworded == other.passworded and self.infos == other.infos)
+
+# Info keys for which GameServerList keeps an index per lobby and value
+INDEXED_INFO_KEYS = (b"protocol_id", b"game_short", b"map")
+MAX_CACHED_REPLIES = 64    # per lobby or index entry
+
+class GameServerList:
+    def __init__(self, duration=70, clock=None, changelog_size=10000):
+        self._expirationset = expirationset(duration, self._remove_callback, clock)
+        self._server_id_dict = {}
+        self._endpoint_dict = {}
+        self._lobby_dict = {}
+        self._info_index = {}   # (lobby_id, key, value) -> set of servers, for the INDEXED_INFO_KEYS
+        self._generation = 0
+        self._epoch = random.randrange(1, 1<<32)   # Distinguishes generations of different lobby runs
+        self._changelog = collections.deque(maxlen=changelog_size)   # (generation, lobby_id, server_id)
+        self._lobby_generation = {}
+        self._reply_cache = {}
+        self._listeners = []
+        self._replacing = False
+        self.refreshed_puts = 0     # Registrations which only renewed an unchanged entry
+        self.changed_puts = 0
+
+    def add_listener(self, listener):
+        """ Notify listener of all changes to the list.
+
+            listener.server_put(server) is called for new and changed entries,
+            listener.server_refreshed(server) when an unchanged entry is renewed and
+            listener.server_removed(server, expired) when an entry is unregistered or
+            expires. Replacing an entry only results in a server_put call."""
+        self._listeners.append(listener)
+
+    def _server_changed(self, server):
+        self._generation += 1
+        self._lobby_generation[server.lobby_id] = self._generation
+        self._changelog.append((self._generation, server.lobby_id, server.server_id))
+        self._reply_cache.pop(server.lobby_id, None)
+        for key in INDEXED_INFO_KEYS:
+            self._reply_cache.pop((server.lobby_id, key, server.infos.get(key)), None)
+
+    def _remove_callback(self, server_id, expired):
+        server = self._server_id_dict.pop(server_id)
+        if(server.ipv4_endpoint is not None):
+            del self._endpoint_dict[server.ipv4_endpoint]
+        if(server.ipv6_endpoint is not None):
+            del self._endpoint_dict[server.ipv6_endpoint]
+        lobbyset = self._lobby_dict[server.lobby_id]
+        lobbyset.remove(server)
+        for key in INDEXED_INFO_KEYS:
+            value = server.infos.get(key)
+            if(value is not None):
+                index_key = (server.lobby_id, key, value)
+                indexset = self._info_index[index_key]
+                indexset.remove(server)
+                if(not indexset):
+                    del self._info_index[index_key]
+        self._server_changed(server)
+        if(not lobbyset):
+            del self._lobby_dict[server.lobby_id]
+            del self._lobby_generation[server.lobby_id]
+        if(not self._replacing):
+            for listener in self._listeners:
+                listener.server_removed(server, expired)
+
+    def put(self, server):
+        """ Register a server in the lobby list.
+
+            This server will replace any existing entries for this server ID.
+            If an entry for this server ID is already present, its endpoint
+            information will be used to complement the known endpoint(s) of the
+            new entry, but the old entry itself will be discarded.
+            The new server will be rejected if a server with a different ID is
+            already known for the same endpoint.
+
+            Returns whether the server was accepted.
+
+            Warning: Do not modify the server's uuid, lobby or endpoint information
+            after registering the server. Make a new server instead and register that."""
+
+        self._expirationset.lazy_cleanup()
+        return self._put(server)
+
+    def put_many(self, servers):
+        """ Register several servers as with put, e.g. those of a bulk registration.
+
+            Returns the number of servers which were accepted."""
+        self._expirationset.lazy_cleanup()
+        put = self._put
+        return sum(1 for server in servers if put(server))
+
+    def _put(self, server):
+        # Abort if there is a server with the same endpoint and different ID
+        if(server.ipv4_endpoint in self._endpoint_dict and self._endpoint_dict[server.ipv4_endpoint] != server.server_id
+                or server.ipv6_endpoint in self._endpoint_dict and self._endpoint_dict[server.ipv6_endpoint] != server.server_id):
+            LOG.warning("wrong_server_id", server=server)
+            return False
+            
+        # If we already know an alternative endpoint for the server, copy it over.
+        try:
+            oldserver = self._server_id_dict[server.server_id]
+            if(server.ipv4_endpoint is None):
+                server.ipv4_endpoint = oldserver.ipv4_endpoint
+            if(server.ipv6_endpoint is None):
+                server.ipv6_endpoint = oldserver.ipv6_endpoint
+        except KeyError:
+            pass
+        else:
+            # Unchanged heartbeat: keep the old entry and all indexes and caches, just renew it.
+            if(oldserver.same_data(server)):
+                self.refreshed_puts += 1
+                self._expirationset.add(server.server_id)
+                for listener in self._listeners:
+                    listener.server_refreshed(oldserver)
+                return True
+        self.changed_puts += 1
+
+        # Remove old entry for the server, if present.
+        self._replacing = True
+        try:
+            self._expirationset.discard(server.server_id)
+        finally:
+            self._replacing = False
+
+        # Add the new entry
+        self._server_id_dict[server.server_id] = server
+        if(server.ipv4_endpoint):
+            self._endpoint_dict[server.ipv4_endpoint] = server.server_id
+        if(server.ipv6_endpoint):
+            self._endpoint_dict[server.ipv6_endpoint] = server.server_id
+        self._lobby_dict.setdefault(server.lobby_id, set()).add(server)
+        for key in INDEXED_INFO_KEYS:
+            value = server.infos.get(key)
+            if(value is not None):
+                self._info_index.setdefault((server.lobby_id, key, value), set()).add(server)
+        self._server_changed(server)
+        self._expirationset.add(server.server_id)
+        for listener in self._listeners:
+            listener.server_put(server)
+        return True
+
+    def refresh(self, server_id):
+        """ Renew the entry for server_id, if present, as if it had been registered again unchanged. """
+        self._expirationset.lazy_cleanup()
+        server = self._server_id_dict.get(server_id)
+        if(server is not None):
+            self._expirationset.add(server_id)
+            for listener in self._listeners:
+                listener.server_refreshed(server)
+
+    def remove(self, server_id):
+        self._expirationset.discard(server_id)
+
+    def get_all_servers(self):
+        self._expirationset.lazy_cleanup()
+        return list(self._server_id_dict.values())
+
+    def __len__(self):
+        self._expirationset.lazy_cleanup()
+        return len(self._server_id_dict)
+
+    def get_servers_with_regtime(self):
+        """ Return (server, registration time) pairs for all servers, oldest registration first. """
+        self._expirationset.lazy_cleanup()
+        return [(self._server_id_dict[server_id], regtime) for (server_id, regtime) in self._expirationset.items()]
+
+    def restore(self, server, regtime):
+        """ Put a server which was registered at regtime, e.g. one loaded from a snapshot.
+
+            Servers must be restored oldest registration first, before any other servers
+            are put. Returns whether the server was listed, i.e. it was accepted and
+            has not expired yet."""
+        if(self._expirationset.expired(regtime) or not self.put(server)):
+            return False
+        self._expirationset.add(server.server_id, regtime)
+        return True
+    
+    def get_servers_in_lobby(self, lobby_id):
+        self._expirationset.lazy_cleanup()
+        try:
+            return self._lobby_dict[lobby_id].copy()
+        except KeyError:
+            return set()
+
+    def count_servers_in_lobby(self, lobby_id):
+        self._expirationset.lazy_cleanup()
+        return len(self._lobby_dict.get(lobby_id, ()))
+
+    def get_servers_by_info(self, lobby_id, key, value):
+        """ Return the servers in the lobby whose info for key, one of INDEXED_INFO_KEYS, is value. """
+        self._expirationset.lazy_cleanup()
+        try:
+            return self._info_index[(lobby_id, key, value)].copy()
+        except KeyError:
+            return set()
+
+    def get_servers_by_protocol(self, lobby_id, protocol_id):
+        """ Return the servers in the lobby which announce the given binary protocol_id. """
+        return self.get_servers_by_info(lobby_id, b"protocol_id", protocol_id)
+
+    def count_servers_by_info(self, lobby_id, key, value):
+        self._expirationset.lazy_cleanup()
+        return len(self._info_index.get((lobby_id, key, value), ()))
+
+    def get_lobbies(self):
+        return self._lobby_dict.keys()
+
+    def get_generation(self):
+        """ Return a number which changes whenever the server set of any lobby changes. """
+        self._expirationset.lazy_cleanup()
+        return self._generation
+
+    def get_epoch(self):
+        return self._epoch
+
+    def continue_generations(self, epoch, generation):
+        """ Continue numbering changes after generation of epoch, e.g. those of another list whose
+            changes are applied to this one. The change log is forgotten, so changes since older
+            generations are not known anymore. """
+        self._epoch = epoch
+        self._generation = generation
+        self._changelog.clear()
+        for lobby_id in self._lobby_generation:
+            self._lobby_generation[lobby_id] = generation
+
+    def get_changes_since(self, lobby_id, generation):
+        """ Return the changes to a lobby since the given generation as (changed servers, removed server IDs).
+
+            Returns None if the changes are not known anymore, e.g. because the
+            generation is older than the change log or belongs to a different epoch."""
+        self._expirationset.lazy_cleanup()
+        if(generation > self._generation):
+            return None
+        if(generation < self._generation and (not self._changelog or self._changelog[0][0] > generation+1)):
+            return None
+
+        server_ids = set()
+        for (changegen, changelobby, server_id) in reversed(self._changelog):
+            if(changegen <= generation):
+                break
+            if(changelobby == lobby_id):
+                server_ids.add(server_id)
+
+        changed = []
+        removed = []
+        for server_id in server_ids:
+            server = self._server_id_dict.get(server_id)
+            if(server is not None and server.lobby_id == lobby_id):
+                changed.append(server)
+            else:
+                removed.append(server_id)
+        return changed, removed
+
+    def get_lobby_generation(self, lobby_id):
+        """ Return a number which changes whenever the server set of the lobby changes.
+
+            Empty lobbies always have generation 0."""
+        self._expirationset.lazy_cleanup()
+        return self._lobby_generation.get(lobby_id, 0)
+
+    def get_lobby_reply(self, lobby_id, key, builder):
+        """ Return builder(servers) for the servers in the lobby, memoized per lobby and key.
+
+            The cached result is dropped as soon as a server in the lobby is added,
+            replaced, removed or expires, so builder should only depend on the
+            server data and the key."""
+        self._expirationset.lazy_cleanup()
+        return self._cached_reply(self._lobby_dict, lobby_id, key, builder)
+
+    def get_info_reply(self, lobby_id, info_key, info_value, key, builder):
+        """ Like get_lobby_reply, but only for the servers returned by get_servers_by_info.
+
+            The cache is only dropped by changes to servers with this info value."""
+        self._expirationset.lazy_cleanup()
+        return self._cached_reply(self._info_index, (lobby_id, info_key, info_value), key, builder)
+
+    def get_protocol_reply(self, lobby_id, protocol_id, key, builder):
+        return self.get_info_reply(lobby_id, b"protocol_id", protocol_id, key, builder)
+
+    def _cached_reply(self, index, scope, key, builder):
+        try:
+            servers = index[scope]
+        except KeyError:
+            return builder(set())
+        cache = self._reply_cache.setdefault(scope, {})
+        try:
+            return cache[key]
+        except KeyError:
+            if(len(cache) >= MAX_CACHED_REPLIES):
+                cache.clear()
+            reply = cache[key] = builder(servers)
+            return reply
+
+SERVER_BLOCK_HEADER = struct.Struct(">BH4sH16sHHHHH")
+NO_IPV4_ENDPOINT = (b"\x00" * 4, 0)
+NO_IPV6_ENDPOINT = (b"\x00" * 16, 0)
+
+def encode_key_value(k, v):
+    k = k[:255]
+    v = v[:65535]
+    return bytes([len(k)]) + k + struct.pack(">H", len(v)) + v
+
+def encode_server_block(server, keys=None):
+    """ Encode a server as a length-prefixed server data block of the NewStyleList protocol.
+
+        If keys is given, the key/value table only contains those of the keys the server has."""
+    ipv4_endpoint = server.ipv4_endpoint or NO_IPV4_ENDPOINT
+    ipv6_endpoint = server.ipv6_endpoint or NO_IPV6_ENDPOINT
+    flags = (1 if server.passworded else 0)
+    infos = server.infos.copy()
+    infos[b"name"] = server.name
+    if(keys is not None):
+        infos = {k: infos[k] for k in keys if k in infos}
+    result = SERVER_BLOCK_HEADER.pack(server.protocol, ipv4_endpoint[1], ipv4_endpoint[0], ipv6_endpoint[1], ipv6_endpoint[0], server.slots, server.players, server.bots, flags, len(infos))
+    result += b"".join([encode_key_value(k, v) for (k, v) in infos.items()])
+    return struct.pack(">L", len(result))+result
+
+def decode_server_block(data, offset, server_id, lobby_id):
+    """ Decode a server data block written by encode_server_block.
+
+        Returns a (server, end offset) tuple, or None if the block is malformed."""
+    if(len(data) < offset+4+SERVER_BLOCK_HEADER.size): return None
+    end = offset+4+struct.unpack_from(">L", data, offset)[0]
+    if(len(data) < end): return None
+    (protocol, ipv4_port, ipv4_address, ipv6_port, ipv6_address, slots, players, bots,
+        flags, kventries) = SERVER_BLOCK_HEADER.unpack_from(data, offset+4)
+    kvtable = regparser.parse_kvtable(data, offset+4+SERVER_BLOCK_HEADER.size, kventries, end)
+    if(kvtable is None or b"name" not in kvtable[0]): return None
+
+    server = GameServer(server_id, lobby_id)
+    server.protocol = protocol
+    if(ipv4_port != 0): server.ipv4_endpoint = (ipv4_address, ipv4_port)
+    if(ipv6_port != 0): server.ipv6_endpoint = (ipv6_address, ipv6_port)
+    server.slots, server.players, server.bots = slots, players, bots
+    server.passworded = (flags & 1) != 0
+    server.infos = INFO_INTERN.intern_infos(kvtable[0])
+    server.name = server.infos.pop(b"name")
+    return server, end
+
+def pack_server(server):
+    """ Encode a server including its server and lobby ID. """
+    return server.server_id.bytes + server.lobby_id.bytes + encode_server_block(server)
+
+def unpack_server(data, offset=0):
+    """ Decode a server written by pack_server. Returns a (server, end offset) tuple or None. """
+    if(len(data) < offset+32): return None
+    return decode_server_block(data, offset+32, uuid.UUID(bytes=data[offset:offset+16]), uuid.UUID(bytes=data[offset+16:offset+32]))
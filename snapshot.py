@@ -0,0 +1,79 @@
+# Snapshots of the server list, so a restarted lobby does not start out empty.
+#
+# File layout (all integers big-endian):
+# +  0    Magic "FLSNAP01"
+# +  8    Time the snapshot was written (float64, seconds since the epoch)
+# + 16    Server count (uint32)
+# + 20    For each server, oldest registration first:
+#         + 0     Registration time (float64)
+#         + 8     Server ID, lobby ID and NewStyleList server data block (see serverlist.pack_server)
+#
+# Snapshots are written to a temporary file which then replaces the old snapshot,
+# so a crash while writing never leaves a truncated snapshot behind.
+#
+# Listed servers are replaced rather than changed, so the (server, registration time)
+# records can be taken on the reactor thread and encoded and written on another one with
+# write_records.
+
+import os, mmap, struct
+from time import time
+from serverlist import pack_server, unpack_server
+
+MAGIC = b"FLSNAP01"
+HEADER = struct.Struct(">8sdL")
+REGTIME = struct.Struct(">d")
+
+def encode_snapshot(records):
+    """ Encode a list of (server, registration time) records, oldest registration first. """
+    parts = [HEADER.pack(MAGIC, time(), len(records))]
+    for server, regtime in records:
+        parts.append(REGTIME.pack(regtime))
+        parts.append(pack_server(server))
+    return b"".join(parts)
+
+def write_snapshot(serverList, path):
+    """ Atomically replace the snapshot at path with the current contents of serverList. """
+    return write_records(serverList.get_servers_with_regtime(), path)
+
+def write_records(records, path):
+    """ Atomically replace the snapshot at path with records, as returned by
+        GameServerList.get_servers_with_regtime. Does not touch the server list. """
+    data = encode_snapshot(records)
+    tmppath = path + ".tmp"
+    with open(tmppath, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+    return len(data)
+
+def load_snapshot(serverList, path):
+    """ Restore the servers from the snapshot at path which have not expired yet.
+
+        Returns the number of restored servers. A missing, empty or invalid snapshot
+        restores nothing; if the snapshot is truncated, the servers before the damage
+        are restored."""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return 0
+    with f:
+        if(os.fstat(f.fileno()).st_size < HEADER.size):
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, written, count = HEADER.unpack_from(data, 0)
+            if(magic != MAGIC):
+                return 0
+            restored = 0
+            offset = HEADER.size
+            for i in range(count):
+                if(len(data) < offset+REGTIME.size):
+                    break
+                regtime = REGTIME.unpack_from(data, offset)[0]
+                unpacked = unpack_server(data, offset+REGTIME.size)
+                if(unpacked is None):
+                    break
+                server, offset = unpacked
+                if(serverList.restore(server, regtime)):
+                    restored += 1
+            return restored
@@ -0,0 +1,168 @@
+# The pages of the web port, independent of the web server serving them.
+#
+# Each page answers a GET request with a (status code, headers, body) tuple; the
+# Twisted resources in weblist and the asyncio front end only copy it into their response.
+
+from xml.sax.saxutils import escape, quoteattr
+import uuid, socket, gzip
+from time import time
+
+pageTemplate = u"""<!doctype html>
+<html>
+<head>
+    <title>Lobby status page</title>
+    <meta http-equiv="content-type" 
+        content="text/html;charset=utf-8" />
+    <link rel="stylesheet" type="text/css" href="style.css" />  
+</head>
+<body>
+    <img src="http://static.ganggarrison.com/Themes/GG2/images/smflogo.gif" alt="" id=smflogo><div id=head><img src="http://static.ganggarrison.com/GG2ForumLogo.png" alt="" id=logo></div>
+    %s
+</body>
+</html>"""
+
+tableTemplate = u"""
+    <h2>Active servers in the %s</h2>
+    <div id=desc><p>Game information links are provided by the game servers and are not in any way related to this site. You have been warned.</p></div>
+    <table class="serverlist">
+        <thead>
+            <tr>
+                <th>PW</th>
+                <th>Name</th>
+                <th>Map</th>
+                <th>Players</th>
+                <th>Game</th>
+                <th>Address</th>
+            </tr>
+        </thead><tbody>
+            %s
+        </tbody>
+    </table>
+"""
+
+rowTemplate = u"""
+                <tr>
+                    <td>%s</td>
+                    <td>%s</td>
+                    <td>%s</td>
+                    <td>%s</td>
+                    <td>%s</td>
+                    <td>%s</td>
+                </tr>
+"""
+
+knownLobbies = {
+    uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7") : u"Gang Garrison Lobby",
+    uuid.UUID("0e29560e-443a-93a3-e15e-7bd072df7506") : u"PyGG2 Testing Lobby",
+	uuid.UUID("4fd0319b-5868-4f24-8b77-568cbb18fde9") : u"Vanguard Lobby"
+}
+
+def htmlprep(utf8string):
+    if isinstance(utf8string, bytes):
+        return escape(utf8string.decode('utf-8', 'replace'))
+    else:
+        return escape(utf8string)
+
+def header_tokens(value):
+    """ Split a comma-separated HTTP header into its (lowercase) tokens, ignoring parameters. """
+    if value is None:
+        return []
+    return [token.split(b";")[0].strip().lower() for token in value.split(b",")]
+
+def accepts_encoding(accept_encoding, encoding):
+    """ Check whether an Accept-Encoding header value lists encoding (lowercase) with a q-value
+        above 0. A malformed q-value counts as refusal, the uncompressed page is always safe. """
+    if(accept_encoding is None):
+        return False
+    for entry in accept_encoding.split(b","):
+        params = entry.split(b";")
+        if(params[0].strip().lower() != encoding):
+            continue
+        for param in params[1:]:
+            name, sep, value = param.partition(b"=")
+            if(name.strip().lower() == b"q"):
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+class StatusPage:
+    """ The /status page.
+
+        The page is only regenerated when the server list has changed, and at most
+        once every min_render_interval seconds. Clients get an ETag to revalidate
+        with, and a gzip-compressed body if they accept it."""
+    def __init__(self, serverList, min_render_interval=2, clock=None):
+        self.serverList = serverList
+        self.min_render_interval = min_render_interval
+        self._time = time if clock is None else clock.seconds
+        self._etag_prefix = uuid.uuid4().hex[:8]
+        self._page = None   # (generation, etag, body, gzipped body)
+        self._rendered_at = 0
+        
+    def _format_server(self, server):
+        passworded = u"X" if server.passworded else u""
+        name = htmlprep(server.name.decode('utf-8', 'replace') if isinstance(server.name, bytes) else server.name)
+        map = htmlprep(server.infos[b"map"].decode('utf-8', 'replace')) if b"map" in server.infos else u""
+        if(server.bots == 0):
+            players = u"%u/%u" % (server.players, server.slots)
+        else:
+            players = u"%u+%u/%u" % (server.players, server.bots, server.slots)
+        if(b"game" in server.infos):
+            game = htmlprep(server.infos[b"game"].decode('utf-8', 'replace'))
+            game += (u" "+htmlprep(server.infos[b"game_ver"].decode('utf-8', 'replace'))) if (b"game_ver" in server.infos) else u""
+            if(b"game_url" in server.infos):
+                game = u'<a href=%s>%s</a>' % (quoteattr(server.infos[b"game_url"].decode('utf-8', 'replace')), game)
+        else:
+            game = u""
+        address = (u"%s:%u" % (socket.inet_ntoa(server.ipv4_endpoint[0]), server.ipv4_endpoint[1])) if server.ipv4_endpoint is not None else u""
+        return rowTemplate % (passworded, name, map, players, game, address)
+        
+    def _format_table(self, lobby):
+        if(lobby in knownLobbies):
+            lobbyname = escape(knownLobbies[lobby])
+        else:
+            lobbyname = u'unknown lobby "%s"' % lobby.hex
+            
+        servers = self.serverList.get_servers_in_lobby(lobby)
+        serverRows = u"".join([self._format_server(server) for server in servers])
+        
+        return tableTemplate % (lobbyname,serverRows)
+        
+    def _render_page(self):
+        lobbies = self.serverList.get_lobbies()
+        lobbyTables = u"".join([self._format_table(lobby) for lobby in lobbies])
+        return (pageTemplate % (lobbyTables,)).encode('utf8', 'replace')
+
+    def _current_page(self):
+        generation = self.serverList.get_generation()
+        now = self._time()
+        if(self._page is None or (self._page[0] != generation and now-self._rendered_at >= self.min_render_interval)):
+            body = self._render_page()
+            etag = (u'"%s-%u"' % (self._etag_prefix, generation)).encode('ascii')
+            self._page = (generation, etag, body, gzip.compress(body, 6))
+            self._rendered_at = now
+        return self._page
+
+    def respond(self, accept_encoding, if_none_match):
+        """ Answer a GET request with the given Accept-Encoding and If-None-Match header values (None if absent). """
+        generation, etag, body, gzipped = self._current_page()
+        use_gzip = accepts_encoding(accept_encoding, b"gzip")
+        if(use_gzip):
+            etag = etag[:-1] + b'-gz"'
+        headers = [(b"etag", etag), (b"vary", b"Accept-Encoding"), (b"cache-control", b"no-cache")]
+
+        if_none_match = header_tokens(if_none_match)
+        if(etag in if_none_match or b"w/"+etag in if_none_match or b"*" in if_none_match):
+            return 304, headers, b""
+        if(use_gzip):
+            headers.append((b"content-encoding", b"gzip"))
+            return 200, headers, gzipped
+        return 200, headers, body
+
+def metrics_response(registry):
+    """ Answer a GET request for /metrics with all metrics of a registry in the Prometheus text format. """
+    headers = [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8"), (b"cache-control", b"no-cache")]
+    return 200, headers, registry.expose().encode('utf8')
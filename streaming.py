@@ -0,0 +1,123 @@
+# Streams large replies to slow clients without buffering them in the transport.
+#
+# A ReplyProducer hands a reply to the transport one chunk at a time, and only when
+# the previous chunk has been sent, so each connection has at most chunk_size bytes
+# outstanding. A StreamBudget shared by all producers caps the outstanding bytes
+# over all connections; producers which would exceed it wait until another one
+# releases its chunk.
+
+from collections import deque
+from zope.interface import implementer
+from twisted.internet.interfaces import IPullProducer
+
+class StreamBudget:
+    def __init__(self, max_bytes=8*1024*1024):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.waits = 0
+        self._waiting = deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def acquire(self, producer, size):
+        """ Reserve size bytes. If they are not available, producer.budgetAvailable(size) is called once
+            they have been reserved for it, unless cancel(producer) is called before. """
+        # Always let a single chunk through, even if it is larger than the whole budget
+        if(self.used == 0 or (not self._waiting and self.used+size <= self.max_bytes)):
+            self.used += size
+            return True
+        self.waits += 1
+        self._waiting.append((producer, size))
+        return False
+
+    def release(self, size):
+        self.used -= size
+        while(self._waiting and (self.used == 0 or self.used+self._waiting[0][1] <= self.max_bytes)):
+            producer, size = self._waiting.popleft()
+            self.used += size
+            producer.budgetAvailable(size)
+
+    def cancel(self, producer):
+        self._waiting = deque([entry for entry in self._waiting if entry[0] is not producer])
+
+def split_chunks(parts, chunk_size):
+    """ Regroup a sequence of bytes objects into chunks of at most chunk_size bytes. """
+    pending = []
+    pending_len = 0
+    for part in parts:
+        offset = 0
+        while(offset < len(part)):
+            space = chunk_size-pending_len
+            if(offset == 0 and len(part) <= space):
+                piece = part
+            else:
+                piece = part[offset:offset+space]
+            offset += len(piece)
+            pending.append(piece)
+            pending_len += len(piece)
+            if(pending_len == chunk_size):
+                yield b"".join(pending)
+                pending = []
+                pending_len = 0
+    if(pending):
+        yield b"".join(pending)
+
+@implementer(IPullProducer)
+class ReplyProducer:
+    def __init__(self, transport, parts, budget, chunk_size=65536):
+        self._transport = transport
+        self._chunks = split_chunks(parts, chunk_size)
+        self._budget = budget
+        self._chunk = None
+        self._reserved = 0
+
+    def start(self):
+        self._transport.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if(self._chunk is not None):
+            # Still waiting for budget. The transport asks again whenever its buffer is empty,
+            # e.g. after loseConnection(), but the chunk is only taken once.
+            return
+        # The previous chunk has left the transport buffer
+        self._releaseChunk()
+        self._chunk = next(self._chunks, None)
+        if(self._chunk is None):
+            self._transport.unregisterProducer()
+            return
+        if(self._budget.acquire(self, len(self._chunk))):
+            self.budgetAvailable(len(self._chunk))
+
+    def budgetAvailable(self, size):
+        if(self._chunk is None):
+            # Stopped while the budget was handing out the reservation
+            self._budget.release(size)
+            return
+        self._reserved = size
+        chunk, self._chunk = self._chunk, None
+        self._transport.write(chunk)
+
+    def stopProducing(self):
+        """ Drop the rest of the reply and give back its reservation. Safe to call more than once. """
+        self._budget.cancel(self)
+        self._chunk = None
+        self._releaseChunk()
+        self._chunks = iter(())
+
+    def _releaseChunk(self):
+        if(self._reserved):
+            reserved, self._reserved = self._reserved, 0
+            self._budget.release(reserved)
+
+def write_reply(transport, parts, budget, chunk_size=65536):
+    """ Write the concatenation of parts to transport, streaming it if it is larger than one chunk.
+        Returns the ReplyProducer if the reply is streamed, otherwise None. """
+    if(sum(map(len, parts)) <= chunk_size):
+        transport.writeSequence(parts)
+    else:
+        producer = ReplyProducer(transport, parts, budget, chunk_size)
+        producer.start()
+        return producer
+    return None
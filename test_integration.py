@@ -8,8 +8,21 @@ import socket
 import threading
 import subprocess
 import os
+import io
+import tempfile
 import requests
 from contextlib import closing
+from twisted.internet.task import Clock
+from expirationset import expirationset
+from serverlist import GameServer, GameServerList
+from banlist import BanList, BanFile
+from legacyinfo import InfoCache, parse_info
+from reachability import ReachabilityChecker
+from streaming import StreamBudget, write_reply
+from replication import ReplicationNode
+import snapshot
+import lobbycore
+from lobbylog import Logger, INFO
 
 def wait_for_server(host, port, timeout=10):
     """Wait for server to start accepting connections"""
@@ -32,6 +45,15 @@ def read_fully(sock, length):
         result += chunk
     return result
 
+def fetch_metrics(port=29950):
+    """Fetch the /metrics page as a dict of sample name to value"""
+    samples = {}
+    for line in requests.get(f"http://127.0.0.1:{port}/metrics", timeout=5).text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
 def test_web_interface():
     """Test web interface returns 200 OK"""
     print("Testing web interface...")
@@ -47,6 +69,30 @@ def test_web_interface():
         print(f"✗ Web interface test FAILED: {e}")
         return False
 
+def test_web_interface_caching():
+    """Test the status page is served gzipped unless refused, and revalidated with its ETag"""
+    print("Testing web interface caching...")
+    try:
+        response = requests.get("http://127.0.0.1:29950/status", headers={"Accept-Encoding": "gzip"}, timeout=5)
+        etag = response.headers.get("ETag")
+        if response.headers.get("Content-Encoding") != "gzip" or etag is None:
+            print(f"✗ Web interface caching test FAILED (headers {dict(response.headers)})")
+            return False
+        response = requests.get("http://127.0.0.1:29950/status", headers={"Accept-Encoding": "deflate, gzip;q=0"}, timeout=5)
+        if "Content-Encoding" in response.headers:
+            print("✗ Web interface caching test FAILED (gzip sent although refused with q=0)")
+            return False
+        response = requests.get("http://127.0.0.1:29950/status", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}, timeout=5)
+        if response.status_code == 304:
+            print("✓ Web interface caching test PASSED (304 Not Modified)")
+            return True
+        else:
+            print(f"✗ Web interface caching test FAILED (status {response.status_code})")
+            return False
+    except Exception as e:
+        print(f"✗ Web interface caching test FAILED: {e}")
+        return False
+
 def test_newstyle_list_empty():
     """Test new-style list endpoint returns empty server list"""
     print("Testing new-style list endpoint (empty)...")
@@ -153,6 +199,238 @@ def test_server_registration():
         print(f"✗ Server registration test FAILED: {e}")
         return False
 
+def test_delta_list():
+    """Test delta list protocol returns a snapshot first and then only changes, and a snapshot again for unknown tokens"""
+    print("Testing delta list protocol...")
+    try:
+        DELTA_PROTOCOL_ID = uuid.UUID("7c1e5a4d-8f3b-4c2a-9d6e-3b1f0a2c5e84")
+        REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+        UNREG_PROTOCOL_ID = uuid.UUID("488984ac-45dc-86e1-9901-98dd1c01c064")
+        LOBBY_ID = uuid.uuid4()
+        updated, removed_id, unchanged = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+        def register(server_id, port, players):
+            packet = REG_PROTOCOL_ID.bytes + server_id.bytes + LOBBY_ID.bytes
+            packet += struct.pack(">BHHHHHH", 1, port, 8, players, 0, 0, 1)
+            packet += bytes([4]) + b"name" + struct.pack(">H", 10) + b"Delta Test"
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(packet, ("127.0.0.1", 29944))
+
+        def query(token):
+            with closing(socket.create_connection(("127.0.0.1", 29944), timeout=5)) as sock:
+                sock.sendall(DELTA_PROTOCOL_ID.bytes + LOBBY_ID.bytes + token)
+                reply_type = read_fully(sock, 1)[0]
+                token = read_fully(sock, 12)
+                changed = {}
+                for _ in range(struct.unpack('>L', read_fully(sock, 4))[0]):
+                    server_id = uuid.UUID(bytes=read_fully(sock, 16))
+                    blocklen = struct.unpack('>L', read_fully(sock, 4))[0]
+                    changed[server_id] = struct.unpack_from(">H", read_fully(sock, blocklen), 27)[0]   # players
+                removed = [uuid.UUID(bytes=read_fully(sock, 16)) for _ in range(struct.unpack('>L', read_fully(sock, 4))[0])]
+                return reply_type, token, changed, removed
+
+        register(updated, 13100, 1)
+        register(removed_id, 13101, 1)
+        register(unchanged, 13102, 1)
+        time.sleep(0.5)
+        failures = []
+        reply_type, token, changed, removed = query(bytes(12))
+        if reply_type != 0 or len(changed) != 3:
+            failures.append(f"expected a snapshot with 3 servers, got type {reply_type} with {len(changed)} servers")
+
+        reply_type, same_token, changed, removed = query(token)
+        if (reply_type, changed, removed) != (1, {}, []):
+            failures.append(f"expected an empty delta, got type {reply_type}, {len(changed)} changed, {len(removed)} removed")
+
+        register(updated, 13100, 5)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(UNREG_PROTOCOL_ID.bytes + removed_id.bytes, ("127.0.0.1", 29944))
+        time.sleep(0.5)
+        for attempt in range(2):
+            reply_type, new_token, changed, removed = query(token)
+            if (reply_type, changed, removed) != (1, {updated: 5}, [removed_id]):
+                failures.append(f"expected the update and the removal, got type {reply_type}, changed {changed}, removed {removed}")
+
+        # Tokens of another lobby run or from the future can only be answered with a snapshot
+        for stale in (struct.pack(">LQ", 0, 1), token[:4] + struct.pack(">Q", (1 << 64) - 1)):
+            reply_type, token, changed, removed = query(stale)
+            if reply_type != 0 or set(changed) != {updated, unchanged}:
+                failures.append(f"expected a snapshot for a stale token, got type {reply_type} with {len(changed)} servers")
+
+        if not failures:
+            print("✓ Delta list test PASSED (snapshot, empty delta, update and removal, stale tokens)")
+            return True
+        else:
+            print(f"✗ Delta list test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Delta list test FAILED: {e}")
+        return False
+
+def test_filtered_list():
+    """Test filtered list protocol returns only matching servers with the requested keys"""
+    print("Testing filtered list protocol...")
+    try:
+        REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+        FILTERED_PROTOCOL_ID = uuid.UUID("3f6a2b8e-1d4c-4e9a-8b7f-5c2d9e0a1b63")
+        GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+
+        kvpairs = [(b"name", b"Filtered Server"), (b"game_short", b"ftest"), (b"map", b"ctf_filter")]
+        packet = REG_PROTOCOL_ID.bytes + uuid.uuid4().bytes + GG2_LOBBY_ID.bytes
+        packet += struct.pack(">BHHHHHH", 1, 12346, 8, 3, 0, 0, len(kvpairs))
+        packet += b"".join([bytes([len(k)]) + k + struct.pack(">H", len(v)) + v for (k, v) in kvpairs])
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packet, ("127.0.0.1", 29944))
+        time.sleep(0.5)
+
+        def query(filters, keys):
+            request = FILTERED_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes + bytes([3 | 4, len(filters)])
+            request += b"".join([bytes([len(k)]) + k + bytes([len(v)]) + v for (k, v) in filters])
+            request += bytes([len(keys)]) + b"".join([bytes([len(k)]) + k for k in keys])
+            with closing(socket.create_connection(("127.0.0.1", 29944), timeout=5)) as sock:
+                sock.sendall(request)
+                servercount = struct.unpack('>L', read_fully(sock, 4))[0]
+                kventries = []
+                for _ in range(servercount):
+                    blocklen = struct.unpack('>L', read_fully(sock, 4))[0]
+                    block = read_fully(sock, blocklen)
+                    kventries.append(struct.unpack(">H", block[33:35])[0])
+                return kventries
+
+        matching = query([(b"game_short", b"ftest"), (b"map", b"ctf_filter")], [b"name"])
+        other = query([(b"game_short", b"ftest"), (b"map", b"ctf_other")], [b"name"])
+        if matching == [1] and other == []:
+            print("✓ Filtered list test PASSED (only the matching server, with only its name)")
+            return True
+        else:
+            print(f"✗ Filtered list test FAILED (key counts {matching} for matching and {other} for other map)")
+            return False
+    except Exception as e:
+        print(f"✗ Filtered list test FAILED: {e}")
+        return False
+
+def test_bulk_registration():
+    """Test several servers registered with one bulk datagram are listed with the shared keys"""
+    print("Testing bulk registration...")
+    try:
+        BULK_PROTOCOL_ID = uuid.UUID("6d3f8a21-5c47-4b9e-8e12-a04f7c9b3d58")
+        LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+        LOBBY_ID = uuid.uuid4()
+
+        def kvtable(kvpairs):
+            return struct.pack(">H", len(kvpairs)) + b"".join([bytes([len(k)]) + k + struct.pack(">H", len(v)) + v for (k, v) in kvpairs])
+
+        packet = BULK_PROTOCOL_ID.bytes + LOBBY_ID.bytes + bytes([1]) + kvtable([(b"game", b"Bulk Game"), (b"map", b"ctf_shared")])
+        packet += struct.pack(">H", 3)
+        for i in range(3):
+            packet += uuid.uuid4().bytes + struct.pack(">HHHHH", 13000 + i, 10, i, 0, 0)
+            packet += kvtable([(b"name", b"Bulk Server %u" % i)] + ([(b"map", b"ctf_own")] if i == 2 else []))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packet, ("127.0.0.1", 29944))
+        time.sleep(0.5)
+
+        with closing(socket.create_connection(("127.0.0.1", 29944), timeout=5)) as sock:
+            sock.sendall(LIST_PROTOCOL_ID.bytes + LOBBY_ID.bytes)
+            servercount = struct.unpack('>L', read_fully(sock, 4))[0]
+            blocks = []
+            for _ in range(servercount):
+                blocklen = struct.unpack('>L', read_fully(sock, 4))[0]
+                blocks.append(read_fully(sock, blocklen))
+
+        maps = sorted(b"ctf_own" in block for block in blocks)
+        if servercount == 3 and all(b"Bulk Game" in block for block in blocks) and maps == [False, False, True]:
+            print("✓ Bulk registration test PASSED (3 servers listed with shared and own keys)")
+            return True
+        else:
+            print(f"✗ Bulk registration test FAILED (expected 3 servers with shared keys, got {servercount})")
+            return False
+    except Exception as e:
+        print(f"✗ Bulk registration test FAILED: {e}")
+        return False
+
+def test_flood_control():
+    """Test 100 servers on one IP are all registered while a flood from one of its ports is dropped"""
+    print("Testing flood control...")
+    sockets = []
+    try:
+        REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+        LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+        LOBBY_ID = uuid.uuid4()
+        FLOOD_LOBBY_ID = uuid.uuid4()
+
+        def registration(lobby_id, port):
+            packet = REG_PROTOCOL_ID.bytes + uuid.uuid4().bytes + lobby_id.bytes
+            packet += struct.pack(">BHHHHHH", 1, port, 8, 0, 0, 0, 1)
+            return packet + bytes([4]) + b"name" + struct.pack(">H", 5) + b"Flood"
+
+        before = fetch_metrics()
+        for i in range(101):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.5", 0))
+            sockets.append(sock)
+        for sock in sockets[:100]:
+            sock.sendto(registration(LOBBY_ID, sock.getsockname()[1]), ("127.0.0.1", 29944))
+        flood = sockets[100]
+        for i in range(100):
+            flood.sendto(registration(FLOOD_LOBBY_ID, 14000), ("127.0.0.1", 29944))
+        time.sleep(0.5)
+        after = fetch_metrics()
+
+        with closing(socket.create_connection(("127.0.0.1", 29944), timeout=5)) as sock:
+            sock.sendall(LIST_PROTOCOL_ID.bytes + LOBBY_ID.bytes)
+            servercount = struct.unpack('>L', read_fully(sock, 4))[0]
+        dropped = {bucket: after[f'lobby_flood_control_dropped_total{{bucket="{bucket}"}}']
+                           - before[f'lobby_flood_control_dropped_total{{bucket="{bucket}"}}']
+                   for bucket in ("endpoint", "ip", "prefix")}
+        flood_dropped = (after['lobby_registration_dropped_total{protocol="newstyle",reason="flood"}']
+                         - before['lobby_registration_dropped_total{protocol="newstyle",reason="flood"}'])
+        if servercount == 100 and dropped == {"endpoint": 97, "ip": 0, "prefix": 0} and flood_dropped == 97:
+            print("✓ Flood control test PASSED (100 servers on one IP listed, 97 flood datagrams dropped)")
+            return True
+        else:
+            print(f"✗ Flood control test FAILED ({servercount} of 100 servers listed, dropped {dropped}, {flood_dropped} counted)")
+            return False
+    except Exception as e:
+        print(f"✗ Flood control test FAILED: {e}")
+        return False
+    finally:
+        for sock in sockets:
+            sock.close()
+
+def test_udp_list():
+    """Test UDP list query hands out a cookie first and then returns a page of servers"""
+    print("Testing UDP list query...")
+    try:
+        QUERY_PROTOCOL_ID = uuid.UUID("9a4c1f7e-2b6d-4d83-a5e1-7f0c3b8d2e46")
+        GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+        before = fetch_metrics()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(5)
+            request = QUERY_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes + bytes(8) + struct.pack(">H", 0)
+            sock.sendto(request, ("127.0.0.1", 29944))
+            reply = sock.recv(65536)
+            if reply[0] != 0 or len(reply) >= len(request):
+                print(f"✗ UDP list test FAILED (expected a short cookie reply, got {len(reply)} bytes of type {reply[0]})")
+                return False
+            sock.sendto(QUERY_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes + reply[1:9] + struct.pack(">H", 0), ("127.0.0.1", 29944))
+            reply = sock.recv(65536)
+            reply_type, generation, page, pages, servers = struct.unpack(">BQHHH", reply[:15])
+            after = fetch_metrics()
+            registrations = 'lobby_registration_packets_total{protocol="newstyle"}'
+            queries = 'lobby_query_datagrams_total{kind="udp_list"}'
+            if after[registrations] != before[registrations] or after[queries] - before[queries] != 2:
+                print("✗ UDP list test FAILED (queries not counted separately from registrations)")
+                return False
+            if reply_type == 1 and pages == 1 and servers >= 1:
+                print(f"✓ UDP list test PASSED ({servers} servers in one page)")
+                return True
+            else:
+                print(f"✗ UDP list test FAILED (type {reply_type}, page {page} of {pages} with {servers} servers)")
+                return False
+    except Exception as e:
+        print(f"✗ UDP list test FAILED: {e}")
+        return False
+
 def test_legacy_protocol():
     """Test legacy GG2 protocol registration and query"""
     print("Testing legacy GG2 protocol...")
@@ -261,6 +539,864 @@ def test_legacy_protocol():
         print(f"✗ Legacy protocol test FAILED: {e}")
         return False
 
+def test_metrics():
+    """Test the metrics page counts the queries and registrations of the earlier tests"""
+    print("Testing metrics...")
+    try:
+        response = requests.get("http://127.0.0.1:29950/metrics", timeout=5)
+        samples = {}
+        for line in response.text.splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        expected = ['lobby_queries_total{protocol="newstyle"}', 'lobby_queries_total{protocol="legacy"}',
+                    'lobby_registration_packets_total{protocol="newstyle"}', 'lobby_query_seconds_count{protocol="newstyle"}']
+        missing = [name for name in expected if samples.get(name, 0) < 1]
+        if response.status_code == 200 and not missing:
+            print("✓ Metrics test PASSED")
+            return True
+        else:
+            print(f"✗ Metrics test FAILED (status {response.status_code}, missing {missing})")
+            return False
+    except Exception as e:
+        print(f"✗ Metrics test FAILED: {e}")
+        return False
+
+def test_replication():
+    """Test registrations and unregistrations are replicated between two lobby nodes"""
+    print("Testing replication between lobby nodes...")
+    repo_root = os.path.dirname(os.path.abspath(__file__))
+    # Two extra nodes next to the main lobby, with all ports shifted by 100 and 200
+    nodes = [subprocess.Popen([sys.executable, "lobby.py", "--port-offset", str(offset), "--peer", "127.0.0.1:%u" % (29946 + peer_offset),
+                               "--peer-secret", "test secret"],
+                              cwd=repo_root, stdout=subprocess.DEVNULL)
+             for (offset, peer_offset) in ((100, 200), (200, 100))]
+    try:
+        REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+        UNREG_PROTOCOL_ID = uuid.UUID("488984ac-45dc-86e1-9901-98dd1c01c064")
+        LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+        GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+        SERVER_ID = uuid.uuid4()
+        if not (wait_for_server("127.0.0.1", 30044) and wait_for_server("127.0.0.1", 30144)):
+            print("✗ Replication test FAILED (nodes did not start)")
+            return False
+
+        def servercount(port):
+            with closing(socket.create_connection(("127.0.0.1", port), timeout=5)) as sock:
+                sock.sendall(LIST_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes)
+                return struct.unpack('>L', read_fully(sock, 4))[0]
+
+        packet = REG_PROTOCOL_ID.bytes + SERVER_ID.bytes + GG2_LOBBY_ID.bytes
+        packet += struct.pack(">BHHHHHH", 1, 12345, 8, 2, 0, 0, 1)
+        packet += bytes([4]) + b"name" + struct.pack(">H", 10) + b"Replicated"
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packet, ("127.0.0.1", 30044))
+        time.sleep(1)
+        if servercount(30144) != 1:
+            print("✗ Replication test FAILED (registration not replicated)")
+            return False
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(UNREG_PROTOCOL_ID.bytes + SERVER_ID.bytes, ("127.0.0.1", 30144))
+        time.sleep(1)
+        if servercount(30044) == 0:
+            print("✓ Replication test PASSED (registration and unregistration replicated)")
+            return True
+        else:
+            print("✗ Replication test FAILED (unregistration not replicated)")
+            return False
+    except Exception as e:
+        print(f"✗ Replication test FAILED: {e}")
+        return False
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait(timeout=5)
+
+def test_asyncio_frontend():
+    """Test registration, querying and the status page on the asyncio frontend"""
+    print("Testing asyncio frontend...")
+    repo_root = os.path.dirname(os.path.abspath(__file__))
+    # All ports shifted by 300, next to the main lobby and the replication nodes
+    node = subprocess.Popen([sys.executable, "aiolobby.py", "--port-offset", "300"], cwd=repo_root, stdout=subprocess.DEVNULL)
+    try:
+        REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+        LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+        GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+        if not (wait_for_server("127.0.0.1", 30244) and wait_for_server("127.0.0.1", 30250)):
+            print("✗ Asyncio frontend test FAILED (lobby did not start)")
+            return False
+
+        packet = REG_PROTOCOL_ID.bytes + uuid.uuid4().bytes + GG2_LOBBY_ID.bytes
+        packet += struct.pack(">BHHHHHH", 1, 12345, 8, 2, 0, 0, 1)
+        packet += bytes([4]) + b"name" + struct.pack(">H", 7) + b"Asyncio"
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packet, ("127.0.0.1", 30244))
+        time.sleep(0.5)
+
+        with closing(socket.create_connection(("127.0.0.1", 30244), timeout=5)) as sock:
+            sock.sendall(LIST_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes)
+            servercount = struct.unpack('>L', read_fully(sock, 4))[0]
+        response = requests.get("http://127.0.0.1:30250/status", timeout=5)
+        if servercount == 1 and response.status_code == 200 and "Asyncio" in response.text:
+            print("✓ Asyncio frontend test PASSED")
+            return True
+        else:
+            print(f"✗ Asyncio frontend test FAILED ({servercount} servers, status {response.status_code})")
+            return False
+    except Exception as e:
+        print(f"✗ Asyncio frontend test FAILED: {e}")
+        return False
+    finally:
+        node.terminate()
+        node.wait(timeout=5)
+
+def test_connection_limits():
+    """Test the per-IP query connection limit and that accepting pauses at the total limit"""
+    print("Testing query connection limits...")
+    repo_root = os.path.dirname(os.path.abspath(__file__))
+    node = subprocess.Popen([sys.executable, "lobby.py", "--port-offset", "400", "--max-query-connections", "3",
+                             "--max-query-connections-per-ip", "2"], cwd=repo_root, stdout=subprocess.DEVNULL)
+    sockets = []
+    try:
+        LIST_PROTOCOL_ID = uuid.UUID("297d0df4-430c-bf61-640a-640897eaef57")
+        GG2_LOBBY_ID = uuid.UUID("1ccf16b1-436d-856f-504d-cc1af306aaa7")
+        if not wait_for_server("127.0.0.1", 30350):
+            print("✗ Connection limits test FAILED (lobby did not start)")
+            return False
+
+        def connect(source):
+            sock = socket.create_connection(("127.0.0.1", 30344), timeout=5, source_address=(source, 0))
+            sockets.append(sock)
+            time.sleep(0.2)
+            return sock
+
+        connect("127.0.0.1")
+        connect("127.0.0.1")
+        if connect("127.0.0.1").recv(1) != b"":
+            print("✗ Connection limits test FAILED (per-IP limit not enforced)")
+            return False
+        connect("127.0.0.2")
+        # The total limit is reached, this connection waits in the listen backlog
+        waiting = connect("127.0.0.3")
+        waiting.sendall(LIST_PROTOCOL_ID.bytes + GG2_LOBBY_ID.bytes)
+        waiting.settimeout(0.5)
+        try:
+            waiting.recv(4)
+            print("✗ Connection limits test FAILED (accepted beyond the total limit)")
+            return False
+        except socket.timeout:
+            pass
+        sockets[0].close()
+        waiting.settimeout(5)
+        struct.unpack('>L', read_fully(waiting, 4))
+
+        samples = dict(line.rsplit(" ", 1) for line in requests.get("http://127.0.0.1:30350/metrics", timeout=5).text.splitlines()
+                       if line and not line.startswith("#"))
+        if (float(samples['lobby_query_connections_rejected_total{limit="per_ip"}']) >= 1
+                and float(samples["lobby_query_accept_pauses_total"]) >= 1):
+            print("✓ Connection limits test PASSED")
+            return True
+        else:
+            print("✗ Connection limits test FAILED (limits not counted)")
+            return False
+    except Exception as e:
+        print(f"✗ Connection limits test FAILED: {e}")
+        return False
+    finally:
+        for sock in sockets:
+            sock.close()
+        node.terminate()
+        node.wait(timeout=5)
+
+def test_expirationset_callback_error():
+    """Test a failing expiration callback does not stop the timer-driven sweep"""
+    print("Testing expirationset with a failing callback...")
+    try:
+        clock = Clock()
+        expired = []
+        def callback(key, is_expired):
+            if key == "bad":
+                raise ValueError(key)
+            expired.append(key)
+        s = expirationset(10, callback, clock=clock)
+        s.add("bad")
+        clock.advance(11)
+        s.add("later")
+        for i in range(12):
+            clock.advance(1)
+        if "bad" not in s and expired == ["later"] and len(s) == 0:
+            print("✓ Expirationset callback error test PASSED")
+            return True
+        else:
+            print(f"✗ Expirationset callback error test FAILED (expired {expired}, {len(s)} entries left)")
+            return False
+    except Exception as e:
+        print(f"✗ Expirationset callback error test FAILED: {e}")
+        return False
+
+def test_snapshot_round_trip():
+    """Test a saved server list restores only unexpired servers, with their remaining TTL"""
+    print("Testing snapshot round trip...")
+    try:
+        LOBBY_ID = uuid.uuid4()
+        clock = Clock()
+        serverList = GameServerList(duration=70, clock=clock)
+        servers = {}
+        for regtime in (0, 40, 60):
+            clock.advance(regtime - clock.seconds())
+            server = GameServer(uuid.uuid4(), LOBBY_ID)
+            server.ipv4_endpoint = (bytes([10, 0, 0, 1]), 13000 + regtime)
+            server.name = b"Snapshot %u" % regtime
+            server.players, server.slots = 3, 10
+            server.infos[b"map"] = b"ctf_snapshot"
+            serverList.put(server)
+            servers[regtime] = server
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "lobby.snapshot")
+            snapshot.write_records(serverList.get_servers_with_regtime(), path)
+            clock.advance(90 - clock.seconds())
+            restoredList = GameServerList(duration=70, clock=clock)
+            restored = snapshot.load_snapshot(restoredList, path)
+
+        def listed():
+            return sorted(int(server.name.split()[1]) for server in restoredList.get_all_servers())
+        # The server registered at 0 is stale, the others expire 70 seconds after their registration
+        after_restore = listed()
+        server = restoredList.get_all_servers()[0]
+        original = servers[int(server.name.split()[1])]
+        same_data = (server.server_id, server.ipv4_endpoint, server.infos) == (original.server_id, original.ipv4_endpoint, original.infos)
+        clock.advance(21)
+        after_first_ttl = listed()
+        clock.advance(20)
+        after_second_ttl = listed()
+        if (restored == 2 and after_restore == [40, 60] and same_data
+                and after_first_ttl == [60] and after_second_ttl == []):
+            print("✓ Snapshot round trip test PASSED")
+            return True
+        else:
+            print(f"✗ Snapshot round trip test FAILED (restored {restored}, listed {after_restore}, "
+                  f"{after_first_ttl} at 111 s and {after_second_ttl} at 131 s)")
+            return False
+    except Exception as e:
+        print(f"✗ Snapshot round trip test FAILED: {e}")
+        return False
+
+def test_reachability_checker():
+    """Test reachability checks are merged while in flight, cached for their TTL and limited in concurrency"""
+    print("Testing reachability checker...")
+    try:
+        clock = Clock()
+        attempts = []
+        def connect(host, port, timeout, done):
+            attempts.append(((host, port), done))
+        checker = ReachabilityChecker(clock, connect, positive_ttl=300, negative_ttl=20, max_concurrent=2)
+        serverList = GameServerList(clock=clock)
+
+        def server(port):
+            s = GameServer(uuid.uuid4(), uuid.uuid4())
+            s.ipv4_endpoint = (bytes([10, 0, 0, 1]), port)
+            s.name = b"Reachability %u" % port
+            return s
+
+        failures = []
+        # A second registration for the same endpoint joins the check in flight, and the
+        # latest registration is listed once it succeeds
+        first, second = server(13000), server(13000)
+        second.server_id = first.server_id
+        second.players = 5
+        checker.check(first, "10.0.0.1", 13000, serverList)
+        checker.check(second, "10.0.0.1", 13000, serverList)
+        if len(attempts) != 1 or checker.merged != 1:
+            failures.append(f"{len(attempts)} connection attempts for one endpoint")
+        attempts.pop()[1](True)
+        listed = serverList.get_all_servers()
+        if len(listed) != 1 or listed[0].players != 5:
+            failures.append("merged registration not listed")
+
+        # The result is reused until the positive TTL runs out
+        clock.advance(299)
+        checker.check(server(13000), "10.0.0.1", 13000, serverList)
+        if attempts or checker.positive_hits != 1:
+            failures.append("cached result not reused")
+        clock.advance(2)
+        checker.check(server(13000), "10.0.0.1", 13000, serverList)
+        if len(attempts) != 1:
+            failures.append("cached result used after its TTL")
+        attempts.pop()[1](False)
+
+        # At most max_concurrent checks run, the others wait until one finishes
+        for port in (14000, 14001, 14002):
+            checker.check(server(port), "10.0.0.1", port, serverList)
+        if [endpoint for endpoint, done in attempts] != [("10.0.0.1", 14000), ("10.0.0.1", 14001)] or checker.queue_depth != 1:
+            failures.append(f"{len(attempts)} checks started with a limit of 2")
+        attempts.pop(0)[1](True)
+        if [endpoint for endpoint, done in attempts] != [("10.0.0.1", 14001), ("10.0.0.1", 14002)] or checker.queue_depth != 0:
+            failures.append("queued check not started")
+
+        if not failures:
+            print("✓ Reachability checker test PASSED")
+            return True
+        else:
+            print(f"✗ Reachability checker test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Reachability checker test FAILED: {e}")
+        return False
+
+def test_heartbeat_refresh():
+    """Test an unchanged heartbeat renews a server without invalidating the lobby, and any change does"""
+    print("Testing heartbeat refresh...")
+    try:
+        LOBBY_ID = uuid.uuid4()
+        SERVER_ID = uuid.uuid4()
+        clock = Clock()
+        serverList = GameServerList(duration=70, clock=clock)
+
+        def heartbeat(**changes):
+            server = GameServer(SERVER_ID, LOBBY_ID)
+            server.ipv4_endpoint = (bytes([10, 0, 0, 1]), 13000)
+            server.name = b"Heartbeat"
+            server.slots, server.players = 10, 3
+            server.infos = {b"map": b"ctf_heartbeat"}
+            for name, value in changes.items():
+                setattr(server, name, value)
+            return server
+
+        builds = []
+        def builder(servers):
+            builds.append(len(servers))
+            return object()
+
+        failures = []
+        serverList.put(heartbeat())
+        generation = serverList.get_lobby_generation(LOBBY_ID)
+        reply = serverList.get_lobby_reply(LOBBY_ID, "test", builder)
+        clock.advance(60)
+        serverList.put(heartbeat())
+        if serverList.get_lobby_generation(LOBBY_ID) != generation:
+            failures.append("unchanged heartbeat changed the generation")
+        if serverList.get_lobby_reply(LOBBY_ID, "test", builder) is not reply or len(builds) != 1:
+            failures.append("unchanged heartbeat dropped the cached reply")
+        clock.advance(40)
+        if len(serverList) != 1:
+            failures.append("unchanged heartbeat did not renew the TTL")
+
+        for name, value in (("name", b"Renamed"), ("players", 4), ("slots", 12), ("bots", 1), ("passworded", True),
+                            ("protocol", 1), ("ipv4_endpoint", (bytes([10, 0, 0, 1]), 13001)), ("infos", {b"map": b"ctf_other"})):
+            serverList.put(heartbeat(**{name: value}))
+            new_generation = serverList.get_lobby_generation(LOBBY_ID)
+            if new_generation == generation:
+                failures.append(f"changing {name} did not change the generation")
+            generation = new_generation
+
+        if not failures:
+            print("✓ Heartbeat refresh test PASSED")
+            return True
+        else:
+            print(f"✗ Heartbeat refresh test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Heartbeat refresh test FAILED: {e}")
+        return False
+
+def test_ban_list():
+    """Test CIDR bans per prefix length, exemptions, malformed lines and reloading the ban file"""
+    print("Testing ban list...")
+    try:
+        bans = BanList(["10.0.0.0/8", "!10.1.2.0/24", "10.1.2.3  # banned again inside the exemption", "192.0.2.1/24",
+                        "2001:db8::/32", "!2001:db8:1::/48", "", "# only a comment", "not an address", "300.1.1.1", "10.0.0.0/33"])
+        expected = {"10.200.0.1": True, "10.1.2.4": False, "10.1.2.3": True, "11.0.0.1": False, "192.0.2.77": True,
+                    "2001:db8:ffff::1": True, "2001:db8:1::1": False, "2001:db9::1": False, "::ffff:10.200.0.1": True,
+                    "garbage": False}
+        failures = [host for host, banned in expected.items() if bans.banned_host(host) != banned]
+        if bans.count != 6 or bans.invalid_lines != 3:
+            failures.append(f"{bans.count} ranges and {bans.invalid_lines} invalid lines")
+        if socket.inet_aton("10.200.0.1") not in bans:
+            failures.append("packed address lookup")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "bans.txt")
+            with open(path, "w") as f:
+                f.write("198.51.100.0/24\n2001:db8::/32\n")
+            clock = Clock()
+            reloaded = BanList()
+            banfile = BanFile(reloaded, path, clock, poll_interval=5)
+            if not (reloaded.banned_host("198.51.100.7") and reloaded.banned_host("2001:db8::1")):
+                failures.append("ban file not loaded")
+            with open(path, "w") as f:
+                f.write("198.51.100.7\n")
+            clock.advance(5)
+            if reloaded.banned_host("198.51.100.8") or reloaded.banned_host("2001:db8::1") or not reloaded.banned_host("198.51.100.7"):
+                failures.append("reload did not replace the bans")
+            os.remove(path)
+            clock.advance(5)
+            if not reloaded.banned_host("198.51.100.7"):
+                failures.append("bans dropped when the file became unreadable")
+            banfile._poll_call.cancel()
+
+        if not failures:
+            print("✓ Ban list test PASSED")
+            return True
+        else:
+            print(f"✗ Ban list test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Ban list test FAILED: {e}")
+        return False
+
+def test_legacy_info_cache():
+    """Test that cached legacy info strings parse like fresh ones and are evicted least recently used first"""
+    print("Testing legacy info cache...")
+    try:
+        ohu = b"!private![ctf_eiger] Bacon Town [3/10] - OHU"
+        mod = b"[koth_harvest] Modded [1/8] - Vanguard"
+        plain = b"Just a name"
+        cache = InfoCache(max_entries=2)
+        failures = []
+        for infostr in (ohu, mod, ohu, mod):
+            if cache.parse(infostr) != parse_info(infostr):
+                failures.append(f"{infostr!r} differs from a fresh parse")
+        if [key for key, value in cache.parse(ohu).infos] != [b"game", b"game_short", b"map", b"game_url"]:
+            failures.append("OHU info key order")
+        if [key for key, value in cache.parse(mod).infos] != [b"game", b"map"]:
+            failures.append("mod info key order")
+        if (cache.hits, cache.misses, cache.evicted) != (4, 2, 0):
+            failures.append(f"counters after hits: {cache.hits}/{cache.misses}/{cache.evicted}")
+
+        # mod was used last, so inserting a third string evicts ohu
+        cache.parse(plain)
+        if len(cache) != 2 or (cache.hits, cache.misses, cache.evicted) != (4, 3, 1):
+            failures.append(f"counters after eviction: {cache.hits}/{cache.misses}/{cache.evicted}")
+        cache.parse(mod)
+        if cache.hits != 5:
+            failures.append("recently used entry was evicted")
+        cache.parse(ohu)
+        if (cache.hits, cache.misses, cache.evicted) != (5, 4, 2):
+            failures.append("least recently used entry was kept")
+
+        if not failures:
+            print("✓ Legacy info cache test PASSED")
+            return True
+        else:
+            print(f"✗ Legacy info cache test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Legacy info cache test FAILED: {e}")
+        return False
+
+class FakeStreamTransport:
+    """Mimics how a Twisted TCP transport drives a pull producer: it asks for more whenever its
+    buffer is empty, including after loseConnection(), and stops the producer when the connection is lost"""
+    def __init__(self):
+        self.producer = None
+        self.buffer = []
+        self.received = []
+        self.disconnecting = False
+        self.closed = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def doWrite(self):
+        self.received += self.buffer
+        self.buffer = []
+        if self.producer is not None:
+            self.producer.resumeProducing()
+        elif self.disconnecting:
+            self.closed = True
+
+    def connectionLost(self):
+        if self.producer is not None:
+            self.producer.stopProducing()
+            self.producer = None
+        self.closed = True
+
+def test_reply_streaming():
+    """Test streamed replies waiting for the shared budget are delivered whole, even when closed right after writing"""
+    print("Testing reply streaming...")
+    try:
+        chunk = 65536
+        budget = StreamBudget(max_bytes=chunk)
+        failures = []
+
+        # A client that stops reading holds the whole budget with its first chunk
+        stalled = FakeStreamTransport()
+        write_reply(stalled, [b"s" * (2 * chunk)], budget, chunk)
+        stalled.doWrite()
+
+        # Write followed by Close, as lobbycore does; the transport asks for data again on close
+        reply = bytes(range(256)) * 1024
+        waiting = FakeStreamTransport()
+        producer = write_reply(waiting, [reply[:1000], reply[1000:]], budget, chunk)
+        waiting.doWrite()
+        waiting.loseConnection()
+        waiting.doWrite()
+        waiting.doWrite()
+        if producer is None or waiting.received or budget.waiting != 1:
+            failures.append(f"reply did not wait for the budget ({budget.waiting} waiting)")
+
+        # A third reply is dropped while it waits
+        dropped = FakeStreamTransport()
+        write_reply(dropped, [b"d" * (2 * chunk)], budget, chunk)
+        dropped.doWrite()
+        dropped.connectionLost()
+
+        stalled.connectionLost()
+        for i in range(20):
+            if waiting.closed:
+                break
+            waiting.doWrite()
+        received = b"".join(waiting.received)
+        if received != reply:
+            failures.append(f"received {len(received)} of {len(reply)} bytes")
+        if not waiting.closed:
+            failures.append("connection not closed after the reply")
+        if budget.used != 0 or budget.waiting != 0:
+            failures.append(f"{budget.used} bytes still reserved")
+
+        # Small replies are written directly
+        direct = FakeStreamTransport()
+        direct.writeSequence = lambda parts: direct.buffer.extend(parts)
+        if write_reply(direct, [b"small"], budget, chunk) is not None or direct.buffer != [b"small"]:
+            failures.append("small reply streamed")
+
+        if not failures:
+            print("✓ Reply streaming test PASSED")
+            return True
+        else:
+            print(f"✗ Reply streaming test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Reply streaming test FAILED: {e}")
+        return False
+
+def test_replication_authentication():
+    """Test replication datagrams need the shared secret, and replicated servers are checked against the ban list"""
+    print("Testing replication authentication...")
+    try:
+        clock = Clock()
+        clock.advance(1000)
+        class Sent:
+            def __init__(self):
+                self.datagrams = []
+            def write(self, data, addr):
+                self.datagrams.append(data)
+
+        def node(secret, bans):
+            serverList = GameServerList(clock=clock)
+            replicator = ReplicationNode(serverList, [("127.0.0.1", 29946)], secret, bans, 60, clock)
+            replicator.transport = Sent()
+            return serverList, replicator
+
+        def registered(address, name):
+            s = GameServer(uuid.uuid4(), uuid.uuid4())
+            s.ipv4_endpoint = (socket.inet_aton(address), 8190)
+            s.name = name
+            return s
+
+        origin_list, origin = node(b"shared", BanList())
+        peer_list, peer = node(b"shared", BanList(["10.9.0.0/16"]))
+        forger_list, forger = node(b"guessed", BanList())
+        origin_list.put(registered("10.1.0.1", b"Allowed"))
+        origin_list.put(registered("10.9.0.1", b"Banned"))
+        origin.flush()
+        forger_list.put(registered("10.1.0.2", b"Forged"))
+        forger.flush()
+        datagram = origin.transport.datagrams[0]
+
+        failures = []
+        tampered = bytearray(datagram)
+        tampered[-1] ^= 1
+        peer.datagramReceived(bytes(tampered), ("127.0.0.1", 29946))
+        peer.datagramReceived(forger.transport.datagrams[0], ("127.0.0.1", 29946))
+        if peer_list.get_all_servers() or peer.rejected_datagrams != 2:
+            failures.append(f"{peer.rejected_datagrams} of 2 unauthenticated datagrams rejected")
+        peer.datagramReceived(datagram, ("127.0.0.1", 29946))
+        if [s.name for s in peer_list.get_all_servers()] != [b"Allowed"] or peer.banned_updates != 1:
+            failures.append("banned server replicated")
+
+        if not failures:
+            print("✓ Replication authentication test PASSED")
+            return True
+        else:
+            print(f"✗ Replication authentication test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Replication authentication test FAILED: {e}")
+        return False
+
+def test_udp_list_bans():
+    """Test UDP list queries from banned addresses are dropped like their query connections"""
+    print("Testing UDP list query bans...")
+    try:
+        clock = Clock()
+        clock.advance(1000)
+        handler = lobbycore.UDPListHandler(clock)
+        serverList = GameServerList(clock=Clock())
+        request = handler.QUERY_PROTOCOL_ID.bytes + uuid.uuid4().bytes + bytes(8) + struct.pack(">H", 0)
+        dropped = handler.banned.value
+        # lobbycore.BANS bans the example address 1.2.3.4 unless a ban file is loaded
+        banned = handler.handle(request, ("1.2.3.4", 5000), serverList)
+        allowed = handler.handle(request, ("1.2.3.5", 5000), serverList)
+        if not banned and len(allowed) == 1 and handler.banned.value == dropped + 1:
+            print("✓ UDP list query ban test PASSED")
+            return True
+        else:
+            print(f"✗ UDP list query ban test FAILED ({len(banned)} replies to a banned address)")
+            return False
+    except Exception as e:
+        print(f"✗ UDP list query ban test FAILED: {e}")
+        return False
+
+def test_udp_list_cookie_flood():
+    """Test UDP list requests without a valid cookie get short replies, limited per source address"""
+    print("Testing UDP list query flood control...")
+    try:
+        clock = Clock()
+        clock.advance(1000)
+        handler = lobbycore.UDPListHandler(clock)
+        serverList = GameServerList(clock=clock)
+        request = handler.QUERY_PROTOCOL_ID.bytes + uuid.uuid4().bytes + bytes(8) + struct.pack(">H", 0)
+        dropped = handler.flooded.value
+        failures = []
+        replies = [handler.handle(request, ("10.20.0.1", 5000 + i), serverList) for i in range(20)]
+        answered = [actions[0].data for actions in replies if actions]
+        if len(answered) != handler.COOKIE_BURST or handler.flooded.value - dropped != 20 - handler.COOKIE_BURST:
+            failures.append(f"{len(answered)} of 20 forged requests answered")
+        if any(len(reply) >= len(request) for reply in answered):
+            failures.append("cookie reply not smaller than the request")
+        if not handler.handle(request, ("10.20.0.2", 5000), serverList):
+            failures.append("other address limited too")
+
+        # A client with a valid cookie still gets its pages while the cookie replies are limited
+        cookie = answered[0][1:9]
+        paged = handler.handle(request[:32] + cookie + struct.pack(">H", 0), ("10.20.0.1", 5000), serverList)
+        if len(paged) != 1 or paged[0].data[0] != handler.PAGE_REPLY:
+            failures.append("request with a valid cookie limited")
+        clock.advance(1)
+        if not handler.handle(request, ("10.20.0.1", 5000), serverList):
+            failures.append("limit not lifted over time")
+
+        if not failures:
+            print("✓ UDP list query flood control test PASSED")
+            return True
+        else:
+            print(f"✗ UDP list query flood control test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ UDP list query flood control test FAILED: {e}")
+        return False
+
+def test_filtered_list_cache():
+    """Test filtered list replies with arbitrary filters and key lists do not push the common replies out of the cache"""
+    print("Testing filtered list reply cache...")
+    try:
+        handler = lobbycore.FilteredListHandler()
+        serverList = GameServerList(clock=Clock())
+        LOBBY_ID = uuid.uuid4()
+        for i in range(3):
+            s = GameServer(uuid.uuid4(), LOBBY_ID)
+            s.ipv4_endpoint = (bytes([10, 0, 0, 1]), 13000 + i)
+            s.name = b"Filtered %u" % i
+            s.slots = 8
+            s.infos = {b"map": b"ctf_cache", b"mode": b"ctf"}
+            serverList.put(s)
+        builds = []
+        build = handler.buildReply
+        handler.buildReply = lambda *args: builds.append(args[1:]) or build(*args)
+        class Query:
+            pass
+        query = Query()
+        query.serverList = serverList
+
+        def request(flags, filters, keys=None):
+            data = handler.LIST_PROTOCOL_ID.bytes + LOBBY_ID.bytes + bytes([flags | (4 if keys is not None else 0), len(filters)])
+            data += b"".join([bytes([len(k)]) + k + bytes([len(v)]) + v for (k, v) in filters])
+            if keys is not None:
+                data += bytes([len(keys)]) + b"".join([bytes([len(k)]) + k for k in keys])
+            return b"".join(handler.handle(query, data)[0].parts)
+
+        failures = []
+        common = [request(0, []), request(1, [(b"map", b"ctf_cache")])]
+        for i in range(100):
+            request(0, [], [b"key%u" % i])
+            request(1, [(b"map", b"ctf_cache"), (b"mode", b"mode%u" % i)])
+        builds.clear()
+        if [request(0, []), request(1, [(b"map", b"ctf_cache")])] != common or builds:
+            failures.append(f"{len(builds)} common replies rebuilt")
+        # Undefined flag bits do not make up new cache entries either
+        if request(0x80, []) != common[0] or builds:
+            failures.append("undefined flags cached separately")
+        if struct.unpack_from(">L", request(0, [(b"mode", b"ctf")], [b"name"]))[0] != 3:
+            failures.append("uncached reply incomplete")
+
+        if not failures:
+            print("✓ Filtered list cache test PASSED")
+            return True
+        else:
+            print(f"✗ Filtered list cache test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Filtered list cache test FAILED: {e}")
+        return False
+
+def test_delta_list_cache():
+    """Test encoded deltas are reused for the same token until the lobby changes again"""
+    print("Testing delta list cache...")
+    try:
+        handler = lobbycore.DeltaListHandler()
+        serverList = GameServerList(clock=Clock())
+        query = lobbycore.NewStyleQuery(serverList)
+        LOBBY_ID = uuid.uuid4()
+
+        def server(port, players=0):
+            s = GameServer(uuid.UUID(int=port), LOBBY_ID)
+            s.ipv4_endpoint = (bytes([10, 0, 0, 1]), port)
+            s.name = b"Delta %u" % port
+            s.slots, s.players = 8, players
+            return s
+
+        for port in range(13200, 13210):
+            serverList.put(server(port))
+        lookups = []
+        get_changes_since = serverList.get_changes_since
+        serverList.get_changes_since = lambda *args: lookups.append(args) or get_changes_since(*args)
+
+        def request(token):
+            return b"".join(handler.handle(query, handler.LIST_PROTOCOL_ID.bytes + LOBBY_ID.bytes + token)[0].parts)
+
+        failures = []
+        token = request(bytes(12))[1:13]
+        serverList.put(server(13200, players=3))
+        # Changes to other lobbies move the global generation without touching this lobby's deltas
+        other = GameServer(uuid.uuid4(), uuid.uuid4())
+        other.ipv4_endpoint, other.name = (bytes([10, 0, 0, 2]), 13200), b"Other lobby"
+        serverList.put(other)
+        first = request(token)
+        if first[0] != handler.DELTA or request(token)[13:] != first[13:] or len(lookups) != 1:
+            failures.append(f"{len(lookups)} change log lookups for two identical delta queries")
+        # A client which is up to date gets an empty delta without a lookup
+        if request(first[1:13])[13:] != handler.EMPTY_DELTA or len(lookups) != 1:
+            failures.append("up to date client not answered with an empty delta")
+        serverList.put(server(13201, players=4))
+        if request(token)[13:] == first[13:] or len(lookups) != 2:
+            failures.append("cached delta reused after the lobby changed")
+        # Once every server changed, the snapshot is sent instead of a larger delta
+        for port in range(13200, 13210):
+            serverList.put(server(port, players=5))
+        if request(token)[0] != handler.FULL_SNAPSHOT:
+            failures.append("delta sent although it is not smaller than the snapshot")
+
+        if not failures:
+            print("✓ Delta list cache test PASSED")
+            return True
+        else:
+            print(f"✗ Delta list cache test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Delta list cache test FAILED: {e}")
+        return False
+
+def test_workers():
+    """Test a registration reaches all query processes with --workers, and delta tokens are valid in all of them"""
+    print("Testing query worker processes...")
+    repo_root = os.path.dirname(os.path.abspath(__file__))
+    # All ports shifted by 500, next to the other lobbies of the tests
+    node = subprocess.Popen([sys.executable, "lobby.py", "--port-offset", "500", "--workers", "2"], cwd=repo_root, stdout=subprocess.DEVNULL)
+    try:
+        REG_PROTOCOL_ID = uuid.UUID("b5dae2e8-424f-9ed0-0fcb-8c21c7ca1352")
+        DELTA_PROTOCOL_ID = uuid.UUID("7c1e5a4d-8f3b-4c2a-9d6e-3b1f0a2c5e84")
+        LOBBY_ID = uuid.uuid4()
+        if not (wait_for_server("127.0.0.1", 30444) and wait_for_server("127.0.0.1", 30450)):
+            print("✗ Workers test FAILED (lobby did not start)")
+            return False
+
+        packet = REG_PROTOCOL_ID.bytes + uuid.uuid4().bytes + LOBBY_ID.bytes
+        packet += struct.pack(">BHHHHHH", 1, 13300, 8, 2, 0, 0, 1)
+        packet += bytes([4]) + b"name" + struct.pack(">H", 7) + b"Workers"
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(packet, ("127.0.0.1", 30444))
+        time.sleep(1)
+
+        # Connections are spread over both processes; only the main process receives registrations
+        listed = {}
+        for attempt in range(50):
+            metrics = fetch_metrics(30450)
+            main = metrics['lobby_registration_packets_total{protocol="newstyle"}'] > 0
+            listed[main] = metrics["lobby_servers"]
+            if len(listed) == 2:
+                break
+        if listed != {True: 1, False: 1}:
+            print(f"✗ Workers test FAILED (servers listed by main process and worker: {listed})")
+            return False
+
+        def delta_query(token):
+            with closing(socket.create_connection(("127.0.0.1", 30444), timeout=5)) as sock:
+                sock.sendall(DELTA_PROTOCOL_ID.bytes + LOBBY_ID.bytes + token)
+                return read_fully(sock, 13)
+
+        token = delta_query(bytes(12))[1:]
+        reply_types = {delta_query(token)[0] for attempt in range(20)}
+        if reply_types == {1}:
+            print("✓ Workers test PASSED (registration listed by both processes, delta tokens valid in both)")
+            return True
+        else:
+            print(f"✗ Workers test FAILED (reply types {sorted(reply_types)} for a current delta token)")
+            return False
+    except Exception as e:
+        print(f"✗ Workers test FAILED: {e}")
+        return False
+    finally:
+        node.terminate()
+        node.wait(timeout=5)
+
+def test_logger():
+    """Test log events are rate-limited per name with a count of the suppressed ones, and close() writes the queue"""
+    print("Testing logger...")
+    try:
+        stream = io.StringIO()
+        # The writer thread would only write after a minute, close() has to flush the queue
+        log = Logger(stream, level=INFO, rate_limit=5, rate_interval=0.2, flush_interval=60)
+        for i in range(30):
+            log.info("burst", number=i)
+        log.debug("hidden")
+        log.warning("other_event", text="two words")
+        failures = []
+        if stream.getvalue():
+            failures.append("events written before the flush interval")
+        time.sleep(0.3)
+        log.info("burst", number=30)
+        log.close()
+
+        lines = stream.getvalue().splitlines()
+        events = [line.split(" ")[3] for line in lines]
+        if events != ["burst"] * 5 + ["other_event", "burst_suppressed", "burst"]:
+            failures.append(f"logged events {events}")
+        elif "count=25" not in lines[6] or not lines[5].endswith('text="two words"'):
+            failures.append(f"unexpected lines {lines[5]!r}, {lines[6]!r}")
+        if (log.logged, log.suppressed, log.dropped) != (8, 25, 0):
+            failures.append(f"counters {log.logged}/{log.suppressed}/{log.dropped}")
+
+        if not failures:
+            print("✓ Logger test PASSED")
+            return True
+        else:
+            print(f"✗ Logger test FAILED ({'; '.join(failures)})")
+            return False
+    except Exception as e:
+        print(f"✗ Logger test FAILED: {e}")
+        return False
+
 def run_tests():
     """Run all integration tests"""
     print("Starting Faucet Lobby integration tests...")
@@ -292,9 +1428,33 @@ def run_tests():
         # Run tests
         results = []
         results.append(test_web_interface())
+        results.append(test_web_interface_caching())
         results.append(test_newstyle_list_empty())
         results.append(test_server_registration())
+        results.append(test_delta_list())
+        results.append(test_filtered_list())
+        results.append(test_udp_list())
+        results.append(test_bulk_registration())
+        results.append(test_flood_control())
         results.append(test_legacy_protocol())
+        results.append(test_metrics())
+        results.append(test_replication())
+        results.append(test_asyncio_frontend())
+        results.append(test_connection_limits())
+        results.append(test_expirationset_callback_error())
+        results.append(test_heartbeat_refresh())
+        results.append(test_snapshot_round_trip())
+        results.append(test_reachability_checker())
+        results.append(test_ban_list())
+        results.append(test_legacy_info_cache())
+        results.append(test_reply_streaming())
+        results.append(test_replication_authentication())
+        results.append(test_udp_list_bans())
+        results.append(test_udp_list_cookie_flood())
+        results.append(test_filtered_list_cache())
+        results.append(test_delta_list_cache())
+        results.append(test_workers())
+        results.append(test_logger())
         
         print()
         print("=" * 50)
@@ -0,0 +1,163 @@
+# Multi-process mode.
+#
+# The main lobby process stays the only writer: it receives all registrations and
+# owns the authoritative GameServerList. Additional worker processes only serve
+# queries. All processes bind the TCP query ports with SO_REUSEPORT, so the kernel
+# spreads incoming connections over them. Each worker is connected to the main
+# process by a socketpair, over which the main process first sends all listed
+# servers and then every change to the list, in order.
+#
+# The workers number their changes like the main process, so that the tokens of the
+# delta list protocol are valid in all processes: the main process sends its epoch and
+# generation after the initial servers, and its generation with every change. A worker
+# whose generation lags behind after applying a change continues with the main process's
+# generation and forgets its change log, so older tokens get snapshots rather than wrong
+# deltas. A worker which got ahead by changing the list on its own, which only its
+# safety-net expiration does, moves to an epoch of its own, as its generations may
+# have been handed out in tokens already.
+
+import os, sys, socket, struct, random, subprocess, uuid
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.internet.protocol import Factory
+from lobbylog import LOG
+from serverlist import pack_server, unpack_server
+
+MSG_PUT = 0
+MSG_REFRESH = 1
+MSG_REMOVE = 2
+MSG_SYNC = 3
+GENERATION = struct.Struct(">Q")
+SYNC = struct.Struct(">LQ")     # epoch, generation
+
+def listen_tcp_reuseport(reactor, port, factory, backlog=50, interface=""):
+    """ Like reactor.listenTCP, but allow other processes to bind the same port. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        sock.close()    # adoptStreamPort duplicated the descriptor
+
+class ReplicationChannel(Int32StringReceiver):
+    MAX_LENGTH = 1 << 20
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+
+    def connectionMade(self):
+        self.publisher._attach(self)
+
+    def connectionLost(self, reason):
+        self.publisher._detach(self)
+
+class ReplicationPublisher(Factory):
+    """ Sends the contents and changes of a GameServerList to the connected workers. """
+    def __init__(self, serverList):
+        self.serverList = serverList
+        self._channels = []
+        serverList.add_listener(self)
+
+    def buildProtocol(self, addr):
+        return ReplicationChannel(self)
+
+    def _attach(self, channel):
+        generation = GENERATION.pack(self.serverList.get_generation())
+        for server in self.serverList.get_all_servers():
+            channel.sendString(bytes([MSG_PUT]) + generation + pack_server(server))
+        channel.sendString(bytes([MSG_SYNC]) + SYNC.pack(self.serverList.get_epoch(), self.serverList.get_generation()))
+        self._channels.append(channel)
+
+    def _detach(self, channel):
+        if(channel in self._channels):
+            self._channels.remove(channel)
+
+    def _broadcast(self, message):
+        for channel in self._channels:
+            channel.sendString(message)
+
+    def server_put(self, server):
+        self._broadcast(bytes([MSG_PUT]) + GENERATION.pack(self.serverList.get_generation()) + pack_server(server))
+
+    def server_refreshed(self, server):
+        self._broadcast(bytes([MSG_REFRESH]) + server.server_id.bytes)
+
+    def server_removed(self, server, expired):
+        self._broadcast(bytes([MSG_REMOVE]) + GENERATION.pack(self.serverList.get_generation()) + server.server_id.bytes)
+
+class ReplicationReceiver(Int32StringReceiver):
+    """ Worker side of the channel, applies the changes to the worker's GameServerList. """
+    MAX_LENGTH = 1 << 20
+
+    def __init__(self, serverList, reactor):
+        self.serverList = serverList
+        self.reactor = reactor
+        self.epoch = None   # of the main process, known once the initial servers are applied
+
+    def stringReceived(self, message):
+        if(message[0] == MSG_PUT):
+            unpacked = unpack_server(message, 1+GENERATION.size)
+            if(unpacked is not None):
+                self.serverList.put(unpacked[0])
+            self._follow(message)
+        elif(message[0] == MSG_REFRESH):
+            self.serverList.refresh(uuid.UUID(bytes=message[1:17]))
+        elif(message[0] == MSG_REMOVE):
+            self.serverList.remove(uuid.UUID(bytes=message[1+GENERATION.size:17+GENERATION.size]))
+            self._follow(message)
+        elif(message[0] == MSG_SYNC):
+            self.epoch, generation = SYNC.unpack_from(message, 1)
+            self.serverList.continue_generations(self.epoch, generation)
+
+    def _follow(self, message):
+        generation = GENERATION.unpack_from(message, 1)[0]
+        if(self.epoch is None or self.serverList.get_generation() == generation):
+            return
+        if(self.serverList.get_generation() > generation):
+            self.epoch = random.randrange(1, 1<<32)
+            LOG.warning("worker_generation_ahead", action="switching to an epoch of its own")
+        self.serverList.continue_generations(self.epoch, generation)
+
+    def connectionLost(self, reason):
+        # The main process is gone, so this worker's list won't be updated anymore
+        LOG.error("main_process_lost", action="shutting down worker")
+        if(self.reactor.running):
+            self.reactor.stop()
+
+class ReceiverFactory(Factory):
+    def __init__(self, serverList, reactor):
+        self.serverList = serverList
+        self.reactor = reactor
+
+    def buildProtocol(self, addr):
+        return ReplicationReceiver(self.serverList, self.reactor)
+
+def spawn_workers(reactor, count, serverList, args=()):
+    """ Start count worker processes running this script with --worker-fd and the given extra args. """
+    publisher = ReplicationPublisher(serverList)
+    processes = []
+    for i in range(count):
+        parent, child = socket.socketpair()
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]), "--worker-fd", str(child.fileno())] + list(args),
+                                          pass_fds=[child.fileno()]))
+        child.close()
+        parent.setblocking(False)
+        reactor.adoptStreamConnection(parent.fileno(), socket.AF_UNIX, publisher)
+        parent.close()
+
+    def stop_workers():
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    reactor.addSystemEventTrigger("before", "shutdown", stop_workers)
+    return processes
+
+def run_worker(reactor, fd, serverList):
+    """ Apply the updates arriving from the main process on fd to serverList. """
+    os.set_blocking(fd, False)
+    reactor.adoptStreamConnection(fd, socket.AF_UNIX, ReceiverFactory(serverList, reactor))
+    os.close(fd)